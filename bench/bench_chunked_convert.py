@@ -0,0 +1,78 @@
+# bench/bench_chunked_convert.py
+"""对比整本单次转换与按页段并发转换的耗时。
+
+使用 bench/fake_mineru.py 代替真实的 MinerU，无需模型即可运行::
+
+    python -m bench.bench_chunked_convert --pages 96 --chunk-pages 8 --workers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdfium2 as pdfium
+
+from bench import fake_mineru
+from server import ingest
+
+
+def make_pdf(path: str, pages: int):
+    doc = pdfium.PdfDocument.new()
+    for _ in range(pages):
+        doc.new_page(595, 842)
+    doc.save(path)
+    doc.close()
+
+
+def summarize(result) -> str:
+    with zipfile.ZipFile(result['archive_zip_path']) as zf:
+        image_count = sum(1 for n in zf.namelist() if '/images/' in f"/{n}")
+    page_count = result['md_content'].count('## Page ')
+    return f"{page_count} page sections, {image_count} images"
+
+
+async def run_single(pdf_path: str, options) -> float:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        result = await loop.run_in_executor(pool, ingest.convert_pdf, pdf_path, options, fake_mineru.to_markdown)
+        elapsed = time.perf_counter() - started
+    print(f"single call : {elapsed:7.2f}s  ({summarize(result)})")
+    shutil.rmtree(os.path.dirname(result['archive_zip_path']), ignore_errors=True)
+    return elapsed
+
+
+async def run_chunked(pdf_path: str, options, work_dir: str, chunk_pages: int, workers: int) -> float:
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        started = time.perf_counter()
+        result = await ingest.convert_pdf_chunked(pool, pdf_path, options, work_dir, chunk_pages,
+                                                  converter=fake_mineru.to_markdown)
+        elapsed = time.perf_counter() - started
+    print(f"chunked     : {elapsed:7.2f}s  ({summarize(result)}, {chunk_pages} pages/chunk, {workers} workers)")
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=96)
+    parser.add_argument('--chunk-pages', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, 'book.pdf')
+        make_pdf(pdf_path, args.pages)
+        options = {'max_pages': args.pages, 'backend': 'pipeline', 'language': 'ch'}
+        print(f"{args.pages} pages, {fake_mineru.PAGE_SECONDS * 1000:.0f} ms CPU per page (fake MinerU)")
+        single = await run_single(pdf_path, options)
+        chunked = await run_chunked(pdf_path, options, os.path.join(tmp, 'work'), args.chunk_pages, args.workers)
+        print(f"speedup     : {single / chunked:7.2f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+# bench/bench_context.py
+"""对比首轮提问发送全文与发送检索片段时的提示词大小和耗时。
+
+默认生成一本合成的中英混排"教科书"，每节有自己的关键词，问题针对随机抽取的
+小节提出；也可以用 ``--md`` 指定一份真实文档（此时不统计命中率）::
+
+    python -m bench.bench_context --sections 400 --questions 50
+    python -m bench.bench_context --md data/documents/<doc>/<doc>.md
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+
+from server import textindex
+
+FILLER = "本节讨论的内容与前后章节相互关联，读者可以结合例题理解其中的推导过程与适用条件。"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符每字约 1 个，其余约 4 个字符 1 个。"""
+    cjk = len(re.findall('[\u3400-\u9fff\uf900-\ufaff]', text))
+    return cjk + (len(text) - cjk) // 4
+
+
+def make_book(sections: int, rng: random.Random):
+    parts, keywords = [], []
+    for i in range(sections):
+        keyword = f"concept{i:04d}"
+        keywords.append(keyword)
+        paragraphs = [f"## 第 {i + 1} 节 {keyword}"]
+        for p in range(rng.randint(3, 6)):
+            paragraphs.append(f"{keyword} 的第 {p + 1} 个要点：" + FILLER * rng.randint(2, 5))
+        parts.append("\n\n".join(paragraphs))
+    return "\n\n".join(parts), keywords
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--md', help='使用已有的 Markdown 文档')
+    parser.add_argument('--sections', type=int, default=400)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--top-k', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.md:
+        with open(args.md, 'r', encoding='utf-8') as f:
+            md = f.read()
+        keywords = None
+    else:
+        md, keywords = make_book(args.sections, rng)
+
+    started = time.perf_counter()
+    index = textindex.ChunkIndex.build(md)
+    build_seconds = time.perf_counter() - started
+
+    chunks = index.chunks
+    payload = json.dumps(index.to_dict(), ensure_ascii=False, separators=(',', ':'))
+    started = time.perf_counter()
+    textindex.ChunkIndex.from_dict(json.loads(payload))
+    load_seconds = time.perf_counter() - started
+
+    sizes, tokens, select_times, hits = [], [], [], 0
+    for _ in range(args.questions):
+        start, end = chunks[rng.randrange(len(chunks))]
+        focused = md[start:end]
+        if keywords:
+            keyword = rng.choice(re.findall(r'concept\d{4}', focused) or keywords)
+            question = f"请解释 {keyword} 的第二个要点是什么意思？"
+        else:
+            question = focused[:60]
+        t0 = time.perf_counter()
+        context = textindex.select_context(md, index, question, focused, args.top_k)
+        select_times.append(time.perf_counter() - t0)
+        sizes.append(len(context))
+        tokens.append(estimate_tokens(context))
+        if keywords and keyword in context:
+            hits += 1
+
+    full_tokens = estimate_tokens(md)
+    avg_chars = statistics.mean(sizes)
+    avg_tokens = statistics.mean(tokens)
+    print(f"document     : {len(md):,} chars, ~{full_tokens:,} tokens, {len(chunks)} chunks")
+    print(f"index build  : {build_seconds * 1000:8.1f} ms ({len(payload):,} bytes on disk)")
+    print(f"index load   : {load_seconds * 1000:8.1f} ms")
+    print(f"select       : {statistics.mean(select_times) * 1000:8.2f} ms avg, {max(select_times) * 1000:.2f} ms max")
+    print(f"full context : {len(md):>10,} chars  ~{full_tokens:,} tokens")
+    print(f"retrieval    : {avg_chars:>10,.0f} chars  ~{avg_tokens:,.0f} tokens (top {args.top_k}, avg of {len(sizes)})")
+    print(f"reduction    : {full_tokens / avg_tokens:8.1f}x")
+    if keywords:
+        print(f"keyword hit  : {hits}/{len(sizes)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+# bench/bench_server.py
+"""端到端基准测试：启动 ``server.main:app``，按场景施加负载，报告延迟分位数与吞吐量。
+
+服务端使用 StubBackend（延迟、出字速度可调，回复确定）和 bench/fake_mineru.py，
+不需要 API Key 和模型；数据写在临时目录（``NBWEB_DATA_DIR``），不影响 data/::
+
+    python -m bench.bench_server
+    python -m bench.bench_server --scenarios chat_first,chat_follow_up --concurrency 16 --requests 400
+    python -m bench.bench_server --json before.json
+    python -m bench.bench_server --compare before.json
+
+场景：doc_load（文档列表 / HTML / 片段）、chat_first（首轮流式提问）、chat_follow_up
+（带 conversation_id 的后续提问）、node_drag（节点拖动的 PATCH 风暴）、drawings（追加、撤销
+笔画与读取绘图）、upload（PDF 上传直至转换完成，需要 pypdfium2）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from server import ingest
+from server.strokes import encode_points
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['doc_load', 'chat_first', 'chat_follow_up', 'node_drag', 'drawings', 'upload']
+WORDS = ["矩阵", "特征值", "向量空间", "线性变换", "行列式", "正交", "投影", "basis", "kernel", "rank", "eigen", "span"]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.wall: Dict[str, float] = {}
+        self.op_scenario: Dict[str, str] = {}
+
+    def add(self, scenario: str, op: str, seconds: float, ok: bool = True):
+        self.op_scenario[op] = scenario
+        if ok:
+            self.samples[op].append(seconds)
+        else:
+            self.errors[op] += 1
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for op in sorted(set(self.samples) | set(self.errors)):
+            values = sorted(self.samples[op])
+            wall = self.wall.get(self.op_scenario[op]) or 0
+            out[op] = {
+                'count': len(values),
+                'errors': self.errors[op],
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'mean_ms': statistics.fmean(values) * 1000 if values else 0.0,
+                'throughput_rps': len(values) / wall if wall else 0.0,
+            }
+        return out
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩法（nearest-rank）分位数。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def make_markdown(target_chars: int, rng: random.Random) -> str:
+    parts, n = [], 0
+    while n < target_chars:
+        section = len(parts) + 1
+        heading = f"## 第 {section} 节 {rng.choice(WORDS)}"
+        paragraphs = [heading]
+        for _ in range(rng.randint(3, 6)):
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+            paragraphs.append(f"{words}，其中 $a_{section} x^2 + b = 0$。")
+        text = "\n\n".join(paragraphs)
+        parts.append(text)
+        n += len(text) + 2
+    return "\n\n".join(parts)
+
+
+def make_pdf(path: str, pages: int, width: int):
+    import pypdfium2 as pdfium
+    doc = pdfium.PdfDocument.new()
+    for _ in range(pages):
+        doc.new_page(width, 842)
+    doc.save(path)
+    doc.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, data_dir: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        'NBWEB_DATA_DIR': data_dir,
+        'NBWEB_LLM_BACKEND': 'stub',
+        'NBWEB_STUB_LATENCY': str(args.stub_latency),
+        'NBWEB_STUB_TOKEN_RATE': str(args.stub_token_rate),
+        'NBWEB_STUB_REPLY_TOKENS': str(args.stub_reply_tokens),
+        'NBWEB_MINERU_MODULE': 'bench.fake_mineru',
+        'FAKE_MINERU_PAGE_SECONDS': str(args.page_seconds),
+        'NBWEB_LOG_LEVEL': 'WARNING',
+    })
+    log = open(os.path.join(data_dir, 'server.log'), 'wb')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server.main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning', '--no-access-log'],
+        cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, proc: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup, see server.log in the data directory")
+        try:
+            if (await client.get('/health')).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("server did not become ready")
+
+
+async def stream_chat(client: httpx.AsyncClient, payload: Dict[str, Any]):
+    """发送流式聊天请求，返回 ``(首个片段耗时, 总耗时, done 事件数据)``。"""
+    start = time.perf_counter()
+    ttfb, done = None, None
+    async with client.stream('POST', '/api/chat/stream', json=payload) as res:
+        res.raise_for_status()
+        event = None
+        async for line in res.aiter_lines():
+            if line.startswith('event:'):
+                event = line[6:].strip()
+                if ttfb is None and event == 'delta':
+                    ttfb = time.perf_counter() - start
+            elif line.startswith('data:') and event in ('done', 'error'):
+                done = json.loads(line[5:])
+                if event == 'error':
+                    raise RuntimeError(done.get('text'))
+    total = time.perf_counter() - start
+    return ttfb if ttfb is not None else total, total, done
+
+
+def message(text: str) -> Dict[str, Any]:
+    return {'role': 'user', 'text': text, 'timestamp': time.time()}
+
+
+class Bench:
+    def __init__(self, args, client: httpx.AsyncClient, document_id: str, rec: Recorder):
+        self.args = args
+        self.client = client
+        self.document_id = document_id
+        self.rec = rec
+        self.conversations: Dict[int, Dict[str, Any]] = {}
+        self.node_ids: List[str] = []
+        self.fragment_count = 0
+
+    async def timed(self, scenario: str, op: str, coro):
+        start = time.perf_counter()
+        try:
+            result = await coro
+            if isinstance(result, httpx.Response):
+                result.raise_for_status()
+        except Exception:
+            self.rec.add(scenario, op, 0, ok=False)
+            return None
+        self.rec.add(scenario, op, time.perf_counter() - start)
+        return result
+
+    def question(self, i: int) -> str:
+        rng = random.Random(i)
+        return f"请解释{rng.choice(WORDS)}与{rng.choice(WORDS)}的关系？"
+
+    # --- 场景 ---
+
+    async def setup_doc_load(self):
+        res = await self.client.get(f'/api/document/{self.document_id}/fragments')
+        self.fragment_count = len(res.json().get('fragments', [])) if res.status_code == 200 else 0
+
+    async def doc_load(self, worker: int, i: int):
+        c, doc = self.client, self.document_id
+        await self.timed('doc_load', 'documents.list', c.get('/api/documents'))
+        await self.timed('doc_load', 'document.html', c.get(f'/api/document/{doc}', headers={'Accept-Encoding': 'gzip'}))
+        await self.timed('doc_load', 'document.fragment_index', c.get(f'/api/document/{doc}/fragments'))
+        if self.fragment_count:
+            await self.timed('doc_load', 'document.fragment', c.get(f'/api/document/{doc}/fragments/{i % self.fragment_count}'))
+
+    async def _chat(self, scenario: str, op: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            ttfb, total, done = await stream_chat(self.client, payload)
+        except Exception:
+            self.rec.add(scenario, op, 0, ok=False)
+            return None
+        self.rec.add(scenario, op + '.ttfb', ttfb)
+        self.rec.add(scenario, op, total)
+        return done
+
+    async def chat_first(self, worker: int, i: int):
+        await self._chat('chat_first', 'chat.first',
+                         {'document_id': self.document_id, 'messages': [message(self.question(i))]})
+
+    async def chat_follow_up(self, worker: int, i: int):
+        state = self.conversations.get(worker)
+        if state is None or state['turns'] >= self.args.follow_ups:
+            done = await self._chat('chat_follow_up', 'chat.first',
+                                    {'document_id': self.document_id, 'messages': [message(self.question(i))]})
+            if done and done.get('conversation_id'):
+                self.conversations[worker] = {'id': done['conversation_id'], 'turns': 0}
+            return
+        state['turns'] += 1
+        await self._chat('chat_follow_up', 'chat.follow_up',
+                         {'document_id': self.document_id, 'conversation_id': state['id'],
+                          'messages': [message(self.question(i) + " 请再详细一些。")]})
+
+    async def setup_node_drag(self):
+        for n in range(self.args.nodes):
+            node_id = f"bench-node-{n}"
+            node = {'node_id': node_id, 'document_id': self.document_id, 'source_element_id': f"atom-{n + 1}",
+                    'canvas_position': {'x': n * 10.0, 'y': n * 5.0, 'zoom_level': 1.0},
+                    'conversation_log': [message(f"节点 {n}")], 'user_annotations': None}
+            await self.client.post(f'/api/nodes/{self.document_id}', json=node)
+            self.node_ids.append(node_id)
+
+    async def node_drag(self, worker: int, i: int):
+        rng = random.Random(i)
+        if i % 5 == 4:
+            batch = [{'node_id': rng.choice(self.node_ids),
+                      'canvas_position': {'x': rng.uniform(0, 2000), 'y': rng.uniform(0, 2000)}} for _ in range(20)]
+            await self.timed('node_drag', 'nodes.patch_batch', self.client.patch(f'/api/nodes/{self.document_id}', json=batch))
+        else:
+            node_id = rng.choice(self.node_ids)
+            await self.timed('node_drag', 'nodes.patch', self.client.patch(
+                f'/api/nodes/{self.document_id}/{node_id}',
+                json={'canvas_position': {'x': rng.uniform(0, 2000), 'y': rng.uniform(0, 2000)}}))
+
+    async def drawings(self, worker: int, i: int):
+        rng = random.Random(i)
+        # 一笔一次请求（与前端防抖后的提交相当），每 10 笔撤销一次
+        x, y = rng.uniform(0, 1000), rng.uniform(0, 1000)
+        points = []
+        for _ in range(self.args.stroke_points):
+            x, y = x + rng.uniform(-3, 3), y + rng.uniform(-3, 3)
+            points.append((x, y))
+        stroke = {'id': f"bench-{i}", 'tool': 'pen', 'color': '#333', 'width': 2, 'points': encode_points(points)}
+        url = f'/api/drawings/{self.document_id}/ops'
+        await self.timed('drawings', 'drawings.append', self.client.post(url, json=[{'op': 'add', 'stroke': stroke}]))
+        if i % 10 == 9:
+            await self.timed('drawings', 'drawings.undo', self.client.post(url, json=[{'op': 'delete', 'id': stroke['id']}]))
+        if i % 4 == 0:
+            await self.timed('drawings', 'drawings.get', self.client.get(f'/api/drawings/{self.document_id}'))
+
+    async def upload(self, worker: int, i: int):
+        tmp = os.path.join(self.args.data_dir, f"upload-{i}.pdf")
+        # 页面宽度随序号变化，保证每份 PDF 内容不同，不会命中转换去重
+        await asyncio.to_thread(make_pdf, tmp, self.args.upload_pages, 400 + i)
+        start = time.perf_counter()
+        try:
+            with open(tmp, 'rb') as f:
+                res = await self.client.post('/api/upload-pdf', files={'file': (f"bench-{i}.pdf", f, 'application/pdf')})
+            res.raise_for_status()
+            self.rec.add('upload', 'upload.accept', time.perf_counter() - start)
+            job_id = res.json()['job_id']
+            while True:
+                job = (await self.client.get(f'/api/jobs/{job_id}')).json()
+                if job['status'] in ('done', 'failed'):
+                    break
+                await asyncio.sleep(0.05)
+            self.rec.add('upload', 'upload.complete', time.perf_counter() - start, ok=job['status'] == 'done')
+        except Exception:
+            self.rec.add('upload', 'upload.complete', 0, ok=False)
+        finally:
+            os.remove(tmp)
+
+
+async def run_scenario(bench: Bench, name: str, requests: int, concurrency: int):
+    setup = getattr(bench, f'setup_{name}', None)
+    if setup:
+        await setup()
+    fn = getattr(bench, name)
+    counter = iter(range(requests))
+
+    async def worker(w: int):
+        for i in counter:
+            await fn(w, i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    bench.rec.wall[name] = time.perf_counter() - start
+
+
+def server_stage_means(metrics_text: str) -> Dict[str, float]:
+    sums, counts = {}, {}
+    for m in re.finditer(r'^nbweb_chat_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$', metrics_text, re.M):
+        (sums if m.group(1) == 'sum' else counts)[m.group(2)] = float(m.group(3))
+    return {stage: sums[stage] / counts[stage] * 1000 for stage in sums if counts.get(stage)}
+
+
+def print_report(results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Dict[str, Any]]] = None):
+    header = f"{'operation':<26}{'count':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'req/s':>9}"
+    print(header)
+    print('-' * len(header))
+    for op, r in results.items():
+        line = (f"{op:<26}{r['count']:>7}{r['errors']:>5}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}"
+                f"{r['p99_ms']:>10.1f}{r['mean_ms']:>10.1f}{r['throughput_rps']:>9.1f}")
+        base = (baseline or {}).get(op)
+        if base and base['p50_ms'] and base['p95_ms']:
+            line += (f"   p50 {100 * (r['p50_ms'] / base['p50_ms'] - 1):+.0f}%"
+                     f" p95 {100 * (r['p95_ms'] / base['p95_ms'] - 1):+.0f}%")
+        print(line)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    for s in scenarios:
+        if s not in SCENARIOS:
+            raise SystemExit(f"unknown scenario: {s} (choose from {', '.join(SCENARIOS)})")
+    if 'upload' in scenarios:
+        try:
+            import pypdfium2  # noqa: F401
+        except ImportError:
+            print("pypdfium2 is not installed, skipping the upload scenario")
+            scenarios.remove('upload')
+
+    # 先在数据目录里生成一份合成文档，服务启动时的目录对账会把它登记进来
+    docs_dir = os.path.join(args.data_dir, 'documents')
+    os.makedirs(docs_dir, exist_ok=True)
+    info = ingest.write_document(docs_dir, 'bench_doc', make_markdown(args.doc_chars, rng), None, title='Bench document')
+    document_id = info['document_id']
+
+    port = free_port()
+    proc = start_server(args, args.data_dir, port)
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+            await wait_ready(client, proc)
+            bench = Bench(args, client, document_id, rec)
+            for name in scenarios:
+                requests = args.uploads if name == 'upload' else args.requests
+                concurrency = min(args.concurrency, requests) or 1
+                print(f"running {name}: {requests} iterations, concurrency {concurrency}")
+                await run_scenario(bench, name, requests, concurrency)
+            metrics_text = (await client.get('/metrics')).text
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    results = rec.results()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print()
+    print_report(results, baseline)
+    stages = server_stage_means(metrics_text)
+    if stages:
+        print("\nserver-side chat stage means (ms): " + ", ".join(f"{k}={v:.1f}" for k, v in sorted(stages.items())))
+    if args.json:
+        config = {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'data_dir', 'keep_data')}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'results': results, 'server_stage_means_ms': stages}, f, indent=2)
+        print(f"\nresults written to {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma-separated, default: all")
+    parser.add_argument('--requests', type=int, default=200, help="iterations per scenario (default 200)")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--doc-chars', type=int, default=200_000, help="size of the synthetic document")
+    parser.add_argument('--follow-ups', type=int, default=5, help="follow-up turns per conversation")
+    parser.add_argument('--nodes', type=int, default=200, help="nodes created before the drag storm")
+    parser.add_argument('--stroke-points', type=int, default=40)
+    parser.add_argument('--uploads', type=int, default=4)
+    parser.add_argument('--upload-pages', type=int, default=8)
+    parser.add_argument('--page-seconds', type=float, default=0.02, help="fake MinerU CPU time per page")
+    parser.add_argument('--stub-latency', type=float, default=0.05, help="stub LLM delay before the first chunk")
+    parser.add_argument('--stub-token-rate', type=float, default=200, help="stub LLM chunks per second")
+    parser.add_argument('--stub-reply-tokens', type=int, default=40, help="padding tokens in stub replies")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="baseline results file to compare against")
+    parser.add_argument('--keep-data', action='store_true', help="keep the temporary data directory")
+    args = parser.parse_args()
+
+    args.data_dir = tempfile.mkdtemp(prefix='nbweb-bench-')
+    try:
+        asyncio.run(run(args))
+    finally:
+        if args.keep_data:
+            print(f"data kept in {args.data_dir}")
+        else:
+            shutil.rmtree(args.data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# bench/fake_mineru.py
+"""MinerU ``to_markdown`` 的本地桩实现，供基准测试使用。
+
+按页数消耗固定的 CPU 时间（``FAKE_MINERU_PAGE_SECONDS``，默认 0.05 秒/页），
+输出与 MinerU 相同结构的 zip：``<name>/auto/<name>.md`` 加 ``images/`` 目录，
+图片以内容的 SHA-256 命名。
+"""
+import hashlib
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import pypdfium2 as pdfium
+
+PAGE_SECONDS = float(os.environ.get("FAKE_MINERU_PAGE_SECONDS", "0.05"))
+
+
+def _burn_cpu(seconds: float):
+    deadline = time.perf_counter() + seconds
+    x = 0
+    while time.perf_counter() < deadline:
+        x += 1
+    return x
+
+
+async def to_markdown(file_path, end_pages=10, is_ocr=False, formula_enable=True, table_enable=True,
+                      language="ch", backend="pipeline", url=None):
+    doc = pdfium.PdfDocument(file_path)
+    try:
+        pages = min(len(doc), end_pages)
+    finally:
+        doc.close()
+
+    name = Path(file_path).stem
+    out_dir = tempfile.mkdtemp(prefix="fake_mineru_")
+    md_parts = []
+    images = {}
+    # 所有页共享的一张图片（例如页眉 logo），用于检验合并时的去重
+    logo = b"shared-logo"
+    for i in range(pages):
+        _burn_cpu(PAGE_SECONDS)
+        figure = f"{name}-figure-{i}".encode("utf-8")
+        figure_name = hashlib.sha256(figure).hexdigest() + ".jpg"
+        logo_name = hashlib.sha256(logo).hexdigest() + ".jpg"
+        images[figure_name] = figure
+        images[logo_name] = logo
+        md_parts.append(f"## Page {i + 1}\n\n![](images/{logo_name})\n\nSome text on page {i + 1}.\n\n![](images/{figure_name})")
+    md_content = "\n\n".join(md_parts)
+
+    archive_zip_path = os.path.join(out_dir, f"{name}.zip")
+    with zipfile.ZipFile(archive_zip_path, "w") as zf:
+        zf.writestr(f"{name}/auto/{name}.md", md_content)
+        for image_name, data in images.items():
+            zf.writestr(f"{name}/auto/images/{image_name}", data)
+    return md_content, md_content, archive_zip_path, file_path
@@ -0,0 +1,193 @@
+# server/atoms.py
+"""文档元素（atom）索引：按编号取元素的 Markdown，聊天时不必再解析前端发来的 HTML。
+
+编号与 ``fragments`` 写入的 ``data-atom-id`` 一致（复用同一个扫描器），每个元素的
+Markdown 在导入文档时预先转换好，写入 ``data/documents/<doc>/atoms.json``；
+旧文档在第一次按编号提问时补建。公式预留的两个编号（mjx-container 与其中的 svg）
+都对应公式元素本身。
+"""
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import html2text
+
+from server.fragments import VOID_TAGS, _AtomScanner
+from server.log import fields, get_logger
+
+INDEX_VERSION = 1
+INDEX_FILENAME = 'atoms.json'
+
+ATOM_ID_RE = re.compile(r'^atom-(\d+)$')
+
+logger = get_logger('atoms')
+
+_local = threading.local()
+
+
+def html_to_markdown(html: str) -> str:
+    """HTML 片段转 Markdown；转换器按线程复用（``HTML2Text`` 不是线程安全的）。"""
+    h = getattr(_local, 'converter', None)
+    if h is None:
+        h = _local.converter = html2text.HTML2Text()
+        h.ignore_links = True
+    return h.handle(html)
+
+
+class _AtomRangeScanner(_AtomScanner):
+    """在编号之外记录每个元素 outerHTML 在原文中的 ``(start, end)``。"""
+
+    def __init__(self, html: str):
+        super().__init__(html)
+        self._html = html
+        self.ranges: Dict[int, Tuple[int, int]] = {}
+        self._open: List[Tuple[str, int, int, int]] = []  # (标签, 起点, 首个编号, 编号数)
+
+    def _record(self, first: int, count: int, start: int, end: int):
+        for n in range(first, first + count):
+            self.ranges[n] = (start, end)
+
+    def _start(self, tag: str, attrs, void: bool):
+        start = self._offset()
+        before = self.atom_count
+        super()._start(tag, attrs, void)
+        count = self.atom_count - before
+        if void:
+            if count:
+                self._record(before + 1, count, start, start + len(self.get_starttag_text() or ''))
+        else:
+            self._open.append((tag, start, before + 1, count))
+
+    def handle_endtag(self, tag):
+        super().handle_endtag(tag)
+        if tag in VOID_TAGS:
+            return
+        for i in range(len(self._open) - 1, -1, -1):
+            if self._open[i][0] == tag:
+                break
+        else:
+            return
+        end = self._html.find('>', self._offset()) + 1 or len(self._html)
+        # 未闭合的内层元素随外层一起结束
+        for _, start, first, count in self._open[i:]:
+            self._record(first, count, start, end)
+        del self._open[i:]
+
+    def close(self):
+        super().close()
+        for _, start, first, count in self._open:
+            self._record(first, count, start, len(self._html))
+        self._open = []
+
+
+def build_markdown(html: str) -> List[str]:
+    """返回各元素的 Markdown，下标为编号减一。"""
+    scanner = _AtomRangeScanner(html)
+    scanner.feed(html)
+    scanner.close()
+    converted: Dict[Tuple[int, int], str] = {}
+    out = []
+    for n in range(1, scanner.atom_count + 1):
+        span = scanner.ranges.get(n)
+        if span is None:
+            out.append('')
+            continue
+        if span not in converted:
+            converted[span] = html_to_markdown(html[span[0]:span[1]]).strip()
+        out.append(converted[span])
+    return out
+
+
+def outer_markdown(html: str) -> List[Tuple[str, str]]:
+    """只取不在其他元素内部的元素，返回 ``[(编号, Markdown)]``；各段文字互不重复（用于全文检索）。"""
+    scanner = _AtomRangeScanner(html)
+    scanner.feed(html)
+    scanner.close()
+    out = []
+    covered = 0
+    for n in range(1, scanner.atom_count + 1):
+        span = scanner.ranges.get(n)
+        if span is None or span[0] < covered:
+            continue
+        covered = span[1]
+        text = html_to_markdown(html[span[0]:span[1]]).strip()
+        if text:
+            out.append((f"atom-{n}", text))
+    return out
+
+
+def index_path(doc_dir: str) -> str:
+    return os.path.join(doc_dir, INDEX_FILENAME)
+
+
+def build_and_save(doc_dir: str, html_path: str, html: Optional[str] = None) -> List[str]:
+    if html is None:
+        with open(html_path, 'r', encoding='utf-8') as f:
+            html = f.read()
+    markdown = build_markdown(html)
+    tmp_path = index_path(doc_dir) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': INDEX_VERSION, 'markdown': markdown}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, index_path(doc_dir))
+    return markdown
+
+
+_loaded: "OrderedDict[str, Tuple[int, List[str]]]" = OrderedDict()
+_loaded_lock = threading.Lock()
+_build_lock = threading.Lock()
+_LOADED_MAX = 16
+
+
+def _read_fresh(path: str, html_mtime: int) -> Optional[List[str]]:
+    try:
+        if os.stat(path).st_mtime_ns >= html_mtime:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                return data['markdown']
+    except (OSError, ValueError, KeyError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logger.warning("无法读取元素索引，将重建", extra=fields(path=path, error=str(e)))
+    return None
+
+
+def load_index(doc_dir: str, html_path: str) -> List[str]:
+    """读取（必要时重建）文档的元素索引；索引比 HTML 旧时视为过期。最近用过的保留在内存中。"""
+    html_mtime = os.stat(html_path).st_mtime_ns
+    with _loaded_lock:
+        cached = _loaded.get(html_path)
+        if cached and cached[0] == html_mtime:
+            _loaded.move_to_end(html_path)
+            return cached[1]
+
+    path = index_path(doc_dir)
+    markdown = _read_fresh(path, html_mtime)
+    if markdown is None:
+        with _build_lock:
+            # 没有任何元素的文档索引是空列表，同样是有效的索引
+            markdown = _read_fresh(path, html_mtime)
+            if markdown is None:
+                markdown = build_and_save(doc_dir, html_path)
+
+    with _loaded_lock:
+        _loaded[html_path] = (html_mtime, markdown)
+        _loaded.move_to_end(html_path)
+        while len(_loaded) > _LOADED_MAX:
+            _loaded.popitem(last=False)
+    return markdown
+
+
+def lookup(index: List[str], atom_ids: Sequence[str]) -> Tuple[List[str], List[str]]:
+    """按编号取 Markdown，返回 ``(各元素的 Markdown, 找不到的编号)``。"""
+    parts, missing = [], []
+    for atom_id in atom_ids:
+        m = ATOM_ID_RE.match(atom_id or '')
+        n = int(m.group(1)) if m else 0
+        if 1 <= n <= len(index):
+            parts.append(index[n - 1])
+        else:
+            missing.append(atom_id)
+    return parts, missing
@@ -0,0 +1,163 @@
+# server/cache.py
+"""持久化到磁盘的 LRU 缓存。
+
+每个条目是目录下的一个 ``<key>.json`` 文件，文件的 mtime 记录最近一次访问时间；
+进程内维护一个按访问顺序排列的索引，用于按总字节数 / 条目数淘汰最旧的条目。
+``get_or_create`` 会合并同一个 key 的并发请求，保证同一时间只有一次计算在进行。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import anyio
+
+
+def content_key(*parts: Any) -> str:
+    """把若干部分（bytes 或可转为字符串的值）组合成一个 SHA-256 key。"""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode('utf-8')
+        h.update(hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+
+class DiskLRUCache:
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 10000,
+                 ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self):
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fname))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, fname[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._index and (self._total_bytes > self.max_bytes or len(self._index) > self.max_entries):
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _drop_locked(self, key: str):
+        self._drop_index_locked(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _drop_index_locked(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except Exception:
+                self._drop_locked(key)
+                self.misses += 1
+                return None
+            if self.ttl is not None and time.time() - entry.get('created', 0) > self.ttl:
+                self._drop_locked(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self.hits += 1
+            return entry.get('value')
+
+    def set(self, key: str, value: Any):
+        payload = json.dumps({'created': time.time(), 'value': value}, ensure_ascii=False)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        with self._lock:
+            os.replace(tmp_path, self._path(key))
+            self._drop_index_locked(key)
+            size = len(payload.encode('utf-8'))
+            self._index[key] = size
+            self._total_bytes += size
+            self._evict_locked()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._index), 'bytes': self._total_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """命中则直接返回；否则调用 ``factory`` 计算并写入缓存。
+
+        同一个 key 的并发调用只会触发一次 ``factory``，其余调用等待同一个结果；
+        ``factory`` 抛出的异常会传给所有等待者，且不会写入缓存。
+        """
+        cached = await anyio.to_thread.run_sync(self.get, key)
+        if cached is not None:
+            return cached
+
+        while key in self._inflight:
+            inflight = self._inflight[key]
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # 发起计算的请求被取消了，由当前请求接手重新计算
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await factory()
+            await anyio.to_thread.run_sync(self.set, key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
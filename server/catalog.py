@@ -0,0 +1,99 @@
+# server/catalog.py
+"""文档目录：每个已转换文档一行，列表接口直接查询这张表，不再扫描 data/documents。
+
+导入、删除文档时更新目录；服务启动时与磁盘对账一次（补上缺失的文档、删掉已不存在的）。
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.storage import SqliteDatabase
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+
+def read_document_meta(docs_dir: str, document_id: str) -> Dict[str, Any]:
+    """从 data/documents/<doc>/meta.json 读取目录条目；旧文档缺少的字段从目录内容补齐。"""
+    doc_dir = os.path.join(docs_dir, document_id)
+    meta: Dict[str, Any] = {}
+    try:
+        with open(os.path.join(doc_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except Exception:
+        pass
+    image_count = meta.get('image_count')
+    if image_count is None:
+        images_dir = os.path.join(doc_dir, 'images')
+        image_count = sum(1 for n in os.listdir(images_dir) if n.lower().endswith(IMAGE_EXTENSIONS)) if os.path.isdir(images_dir) else 0
+    created_at = meta.get('created_at')
+    if created_at is None:
+        created_at = os.stat(doc_dir).st_mtime
+    return {
+        'document_id': document_id,
+        'title': meta.get('title') or document_id,
+        'total_chars': meta.get('total_chars', 0),
+        'page_count': meta.get('page_count'),
+        'image_count': image_count,
+        'created_at': created_at,
+    }
+
+
+class DocumentCatalog(SqliteDatabase):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            document_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            total_chars INTEGER NOT NULL DEFAULT 0,
+            page_count INTEGER,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS documents_by_title ON documents (title COLLATE NOCASE);
+    """
+    COLUMNS = ('document_id', 'title', 'total_chars', 'page_count', 'image_count', 'created_at')
+
+    def upsert(self, entry: Dict[str, Any]):
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO documents ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            tuple(entry.get(c) for c in self.COLUMNS),
+        )
+
+    def add_from_disk(self, docs_dir: str, document_id: str) -> Dict[str, Any]:
+        entry = read_document_meta(docs_dir, document_id)
+        self.upsert(entry)
+        return entry
+
+    def remove(self, document_id: str) -> bool:
+        return self._conn().execute("DELETE FROM documents WHERE document_id = ?", (document_id,)).rowcount > 0
+
+    def get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM documents WHERE document_id = ?", (document_id,)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def list(self, prefix: str = "", offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """按标题排序分页返回 ``(条目, 总数)``；``prefix`` 按标题或 id 前缀（不区分大小写）过滤。"""
+        where, args = "", []
+        if prefix:
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where = "WHERE title LIKE ? ESCAPE '\\' OR document_id LIKE ? ESCAPE '\\'"
+            args = [pattern, pattern]
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM documents {where}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM documents {where} "
+            "ORDER BY title COLLATE NOCASE, document_id LIMIT ? OFFSET ?",
+            (*args, -1 if limit is None else limit, offset),
+        ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows], total
+
+    def sync(self, docs_dir: str) -> Tuple[int, int]:
+        """与磁盘对账；返回 ``(新增数, 删除数)``。"""
+        on_disk = {n for n in os.listdir(docs_dir) if os.path.isdir(os.path.join(docs_dir, n))}
+        known = {row[0] for row in self._conn().execute("SELECT document_id FROM documents")}
+        for document_id in sorted(on_disk - known):
+            self.add_from_disk(docs_dir, document_id)
+        for document_id in known - on_disk:
+            self.remove(document_id)
+        return len(on_disk - known), len(known - on_disk)
@@ -0,0 +1,163 @@
+# server/conversations.py
+"""服务端保存的对话，后续提问只需带上 conversation_id 与新问题。
+
+每轮对话追加两行（用户、模型），不重写整段历史。发给模型的历史由三部分组成：
+首轮问答（含文档上下文，固定保留）、更早轮次的摘要、以及不超过 token 预算的
+最近若干轮；超出预算的旧轮次由 ``compaction_plan`` 选出，交给模型压缩进摘要。
+"""
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from server.storage import SqliteDatabase
+
+# 首轮的用户提问与模型回答，始终原样保留
+PINNED_TURNS = 2
+
+_CJK_RE = re.compile('[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 token 数：中日文每字约 1 个，其余每 4 个字符约 1 个。"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ConversationStore(SqliteDatabase):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            document_id TEXT NOT NULL,
+            summary TEXT,
+            summary_through INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversations_by_document ON conversations (document_id);
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            conversation_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            text TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (conversation_id, seq)
+        );
+    """
+    COLUMNS = ('conversation_id', 'document_id', 'summary', 'summary_through', 'created_at', 'updated_at')
+
+    def create(self, document_id: str) -> str:
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO conversations (conversation_id, document_id, summary_through, created_at, updated_at) "
+            "VALUES (?, ?, 0, ?, ?)",
+            (conversation_id, document_id, now, now),
+        )
+        return conversation_id
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def append(self, conversation_id: str, turns: Sequence[Tuple[str, str]]) -> int:
+        """按顺序追加 ``(role, text)``，返回最后一轮的序号。"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM conversation_turns WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()[0]
+            for role, text in turns:
+                seq += 1
+                conn.execute(
+                    "INSERT INTO conversation_turns (conversation_id, seq, role, text, tokens, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (conversation_id, seq, role, text, estimate_tokens(text), now),
+                )
+            conn.execute("UPDATE conversations SET updated_at = ? WHERE conversation_id = ?", (now, conversation_id))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    def live_turns(self, conversation: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """返回首轮问答以及尚未压缩进摘要的轮次。"""
+        rows = self._conn().execute(
+            "SELECT seq, role, text, tokens FROM conversation_turns "
+            "WHERE conversation_id = ? AND (seq <= ? OR seq > ?) ORDER BY seq",
+            (conversation['conversation_id'], PINNED_TURNS, conversation['summary_through']),
+        ).fetchall()
+        return [dict(zip(('seq', 'role', 'text', 'tokens'), row)) for row in rows]
+
+    def set_summary(self, conversation_id: str, summary: str, through_seq: int) -> bool:
+        """记录覆盖到 ``through_seq`` 的摘要；已有更新的摘要时不覆盖。"""
+        return self._conn().execute(
+            "UPDATE conversations SET summary = ?, summary_through = ?, updated_at = ? "
+            "WHERE conversation_id = ? AND summary_through < ?",
+            (summary, through_seq, time.time(), conversation_id, through_seq),
+        ).rowcount > 0
+
+    def delete(self, conversation_id: str) -> bool:
+        conn = self._conn()
+        conn.execute("DELETE FROM conversation_turns WHERE conversation_id = ?", (conversation_id,))
+        return conn.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,)).rowcount > 0
+
+    def delete_document(self, document_id: str):
+        conn = self._conn()
+        conn.execute(
+            "DELETE FROM conversation_turns WHERE conversation_id IN "
+            "(SELECT conversation_id FROM conversations WHERE document_id = ?)",
+            (document_id,),
+        )
+        conn.execute("DELETE FROM conversations WHERE document_id = ?", (document_id,))
+
+
+def _recent_window(turns: List[Dict[str, Any]], budget_tokens: int) -> int:
+    """返回最近一段不超过预算的轮次的起点（至少保留最后一轮问答，起点总是用户提问）。"""
+    start, used = len(turns), 0
+    while start > 0 and (used + turns[start - 1]['tokens'] <= budget_tokens or len(turns) - start < 2):
+        start -= 1
+        used += turns[start]['tokens']
+    while start < len(turns) and turns[start]['role'] != 'user':
+        start += 1
+    return start
+
+
+def build_history(conversation: Dict[str, Any], turns: List[Dict[str, Any]], budget_tokens: int) -> List[Dict[str, Any]]:
+    """组装发给模型的历史：首轮问答 + 摘要 + 预算内的最近轮次；更早且未摘要的轮次被截断。"""
+    pinned = [t for t in turns if t['seq'] <= PINNED_TURNS]
+    rest = [t for t in turns if t['seq'] > PINNED_TURNS]
+    history = [{'role': t['role'], 'parts': [{'text': t['text']}]} for t in pinned]
+    if conversation.get('summary'):
+        history.append({'role': 'user', 'parts': [{'text': f"[此前对话的摘要]\n{conversation['summary']}"}]})
+        history.append({'role': 'model', 'parts': [{'text': "好的，我会结合这些内容继续回答。"}]})
+    history.extend({'role': t['role'], 'parts': [{'text': t['text']}]} for t in rest[_recent_window(rest, budget_tokens):])
+    return history
+
+
+def compaction_plan(turns: List[Dict[str, Any]], budget_tokens: int) -> List[Dict[str, Any]]:
+    """未摘要的轮次超出预算时，返回应压缩进摘要的旧轮次（压缩后只留约一半预算），否则返回空列表。
+
+    每次压缩留出一半余量，之后几轮都不必再压缩。
+    """
+    rest = [t for t in turns if t['seq'] > PINNED_TURNS]
+    if sum(t['tokens'] for t in rest) <= budget_tokens:
+        return []
+    return rest[:_recent_window(rest, budget_tokens // 2)]
+
+
+def summary_prompt(previous_summary: Optional[str], turns: List[Dict[str, Any]]) -> str:
+    lines = ["请把下面这段对话压缩成一份简洁的摘要，保留用户关心的问题、已经给出的结论、"
+             "涉及的公式与术语，以便之后继续对话。只输出摘要本身。"]
+    if previous_summary:
+        lines += ["", "[已有摘要]", previous_summary]
+    lines += ["", "[对话]"]
+    for t in turns:
+        lines.append(f"{'用户' if t['role'] == 'user' else '助手'}：{t['text']}")
+    return "\n".join(lines)
@@ -0,0 +1,172 @@
+# server/doccache.py
+"""进程内的文档内容缓存（Markdown / HTML）。
+
+按路径缓存文件内容，以 ``(mtime_ns, size)`` 判断文件是否被改写；总字节数超过
+上限时淘汰最久未用的条目。超过 ``max_entry_bytes`` 的大文件不整份读入内存，
+而是返回 ``MappedText``：通过 mmap 按字符区间切片，只解码需要的那一段。
+"""
+import bisect
+import codecs
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Tuple, Union
+
+
+class MappedText:
+    """mmap 映射的 UTF-8 文本，支持 ``len()`` 和按字符下标切片 ``text[a:b]``。
+
+    打开时扫描一遍文件，每隔约 ``block_bytes`` 字节记录一个 (字符偏移, 字节偏移)
+    检查点；切片时从最近的检查点开始解码，至多多解码一个块。
+
+    ``close()`` 释放映射（正在切片的线程用完后才真正关闭）；关闭后再切片会临时重新映射。
+    """
+
+    def __init__(self, path: str, block_bytes: int = 64 * 1024):
+        self.path = path
+        self.block_bytes = block_bytes
+        self._lock = threading.Lock()
+        self._users = 0
+        self._closing = False
+        size = self._open()
+        self._char_offsets = []
+        self._byte_offsets = []
+        chars = 0
+        pos = 0
+        while pos < size:
+            end = self._char_boundary(min(pos + block_bytes, size))
+            if end <= pos:
+                end = min(pos + block_bytes, size)
+            self._char_offsets.append(chars)
+            self._byte_offsets.append(pos)
+            chars += len(self._map[pos:end].decode('utf-8', errors='replace'))
+            pos = end
+        self._length = chars
+
+    def _open(self) -> int:
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        return size
+
+    def _release_locked(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+        self._closing = False
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            if not self._users:
+                self._release_locked()
+
+    def _char_boundary(self, pos: int) -> int:
+        # 回退到 UTF-8 字符的起始字节，避免把一个字符切成两半
+        while 0 < pos < len(self._map) and (self._map[pos] & 0xC0) == 0x80:
+            pos -= 1
+        return pos
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, key) -> str:
+        if not isinstance(key, slice):
+            raise TypeError("MappedText only supports slicing")
+        start, stop, step = key.indices(self._length)
+        if step != 1:
+            raise ValueError("MappedText does not support slice steps")
+        if stop <= start:
+            return ""
+        with self._lock:
+            if self._map is None:
+                # 已从缓存中淘汰：为这次读取重新映射，读完即释放
+                self._open()
+                self._closing = True
+            self._users += 1
+            data = self._map
+        try:
+            i = bisect.bisect_right(self._char_offsets, start) - 1
+            chars = self._char_offsets[i]
+            pos = self._byte_offsets[i]
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            parts = []
+            collected = 0
+            need = stop - chars
+            while collected < need and pos < len(data):
+                text = decoder.decode(data[pos:pos + self.block_bytes])
+                pos += self.block_bytes
+                parts.append(text)
+                collected += len(text)
+            return "".join(parts)[start - chars:stop - chars]
+        finally:
+            with self._lock:
+                self._users -= 1
+                if self._closing and not self._users:
+                    self._release_locked()
+
+    def __str__(self) -> str:
+        return self[:]
+
+
+class DocumentCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_entry_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int], Union[str, MappedText], int]]" = OrderedDict()
+        self._total_bytes = 0
+
+    def get_text(self, path: str) -> Union[str, MappedText]:
+        """返回文件内容；大文件返回 ``MappedText``。文件不存在时抛出 ``FileNotFoundError``。"""
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        if st.st_size > self.max_entry_bytes:
+            # 只有检查点表常驻内存，按其规模计入缓存大小
+            text = MappedText(path)
+            cost = 16 * len(text._char_offsets)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            cost = st.st_size
+
+        dropped = []
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old:
+                self._total_bytes -= old[2]
+                dropped.append(old[1])
+            self._entries[path] = (version, text, cost)
+            self._total_bytes += cost
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted, evicted_cost) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_cost
+                dropped.append(evicted)
+        # 被替换或淘汰的大文件释放映射（及其文件句柄）
+        for item in dropped:
+            if isinstance(item, MappedText):
+                item.close()
+        return text
+
+    def read_text(self, path: str) -> str:
+        """返回完整的文件内容字符串。"""
+        text = self.get_text(path)
+        return text if isinstance(text, str) else text[:]
+
+    def read_slice(self, path: str, start: int, end: int) -> str:
+        return self.get_text(path)[start:end]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._total_bytes, 'hits': self.hits, 'misses': self.misses}
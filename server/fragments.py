@@ -0,0 +1,181 @@
+# server/fragments.py
+"""把转换后的长文档 HTML 切成按需加载的片段。
+
+切分只发生在顶层元素之间，并尽量落在标题处；每个片段写入
+``data/documents/<doc>/fragments/<序号>.html``，索引写入 ``fragments.json``。
+
+元素编号（atom id）在切分时由服务端写入 ``data-atom-id``，是编号的唯一来源：
+前端无论文档长短都通过片段加载，不再自行编号，因此无论先加载哪个片段，编号都不变，
+并与 ``atoms`` 的元素索引一致。
+公式（``.arithmatex``）由前端 MathJax 渲染成 ``mjx-container > svg``，这里为它们
+预留两个编号并记在 ``data-math-atom-id`` 上。
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+FRAGMENTS_VERSION = 1
+INDEX_FILENAME = 'fragments.json'
+FRAGMENTS_DIRNAME = 'fragments'
+FRAGMENT_CHARS = 120_000
+
+# 与 web/main.js 中 annotateAtoms 的选择器保持一致（mjx-container 由前端生成）
+ATOM_TAGS = {'p', 'img', 'table', 'thead', 'tbody', 'tr', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+             'li', 'blockquote', 'code', 'figure', 'figcaption', 'math', 'svg'}
+HEADING_TAGS = {'h1', 'h2', 'h3'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+# 旧文档在首次请求时补切分，避免并发请求同时改写同一个目录
+_build_lock = threading.Lock()
+
+
+class _AtomScanner(HTMLParser):
+    """记录需要插入的编号属性、顶层元素的起点以及标题文字。"""
+
+    def __init__(self, html: str):
+        super().__init__(convert_charrefs=True)
+        self._line_starts = [0] + [m.end() for m in re.finditer('\n', html)]
+        self.depth = 0
+        self.atom_count = 0
+        self.inserts: List[Tuple[int, str, int, int]] = []  # (插入位置, 属性文本, 首个编号, 占用的编号数)
+        self.top_level: List[Tuple[int, str]] = []  # (起点, 标签)
+        self.headings: Dict[int, str] = {}  # 顶层标题起点 -> 文字
+        self._heading_start: Optional[int] = None
+        self._heading_text: List[str] = []
+
+    def _offset(self) -> int:
+        line, col = self.getpos()
+        return self._line_starts[line - 1] + col
+
+    def _start(self, tag: str, attrs, void: bool):
+        start = self._offset()
+        if self.depth == 0:
+            self.top_level.append((start, tag))
+            if tag in HEADING_TAGS:
+                self._heading_start, self._heading_text = start, []
+        insert_at = start + 1 + len(tag)
+        classes = (dict(attrs).get('class') or '').split()
+        if tag in ATOM_TAGS:
+            self.atom_count += 1
+            self.inserts.append((insert_at, f' data-atom-id="atom-{self.atom_count}"', self.atom_count, 1))
+        elif 'arithmatex' in classes:
+            # 渲染后为 mjx-container（编号 N）及其中的 svg（编号 N+1）
+            self.inserts.append((insert_at, f' data-math-atom-id="atom-{self.atom_count + 1}"', self.atom_count + 1, 2))
+            self.atom_count += 2
+        if not void:
+            self.depth += 1
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, tag in VOID_TAGS)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS:
+            return
+        self.depth = max(self.depth - 1, 0)
+        if self.depth == 0 and self._heading_start is not None:
+            self.headings[self._heading_start] = ' '.join(''.join(self._heading_text).split())[:200]
+            self._heading_start = None
+
+    def handle_data(self, data):
+        if self._heading_start is not None:
+            self._heading_text.append(data)
+
+
+def _cut_points(scanner: _AtomScanner, length: int, fragment_chars: int) -> List[int]:
+    cuts = [0]
+    for start, tag in scanner.top_level[1:]:
+        size = start - cuts[-1]
+        if size >= fragment_chars or (tag in HEADING_TAGS and size >= fragment_chars // 2):
+            cuts.append(start)
+    return cuts + [length]
+
+
+def split_html(html: str, fragment_chars: int = FRAGMENT_CHARS) -> Tuple[List[str], Dict[str, Any]]:
+    """返回 ``(片段 HTML 列表, 索引)``；片段已写入 atom 编号。"""
+    scanner = _AtomScanner(html)
+    scanner.feed(html)
+    scanner.close()
+    cuts = _cut_points(scanner, len(html), fragment_chars)
+
+    fragments, entries = [], []
+    insert_i = 0
+    headings = sorted(scanner.headings.items())
+    heading_i = 0
+    atom_start = 0
+    for index, (start, end) in enumerate(zip(cuts, cuts[1:])):
+        parts, pos = [], start
+        atom_end = atom_start
+        while insert_i < len(scanner.inserts) and scanner.inserts[insert_i][0] < end:
+            at, attr, first, count = scanner.inserts[insert_i]
+            parts += [html[pos:at], attr]
+            pos = at
+            atom_end = first + count - 1
+            insert_i += 1
+        parts.append(html[pos:end])
+        fragments.append(''.join(parts))
+
+        heading = None
+        while heading_i < len(headings) and headings[heading_i][0] < end:
+            if heading is None and headings[heading_i][0] >= start:
+                heading = headings[heading_i][1]
+            heading_i += 1
+        entries.append({'index': index, 'chars': end - start, 'atom_start': atom_start,
+                        'atom_count': atom_end - atom_start, 'heading': heading})
+        atom_start = atom_end
+    index_data = {'version': FRAGMENTS_VERSION, 'total_chars': len(html), 'atom_count': scanner.atom_count,
+                  'fragments': entries}
+    return fragments, index_data
+
+
+def fragment_path(doc_dir: str, index: int) -> str:
+    return os.path.join(doc_dir, FRAGMENTS_DIRNAME, f"{index:05d}.html")
+
+
+def build_fragments(doc_dir: str, html_path: str, fragment_chars: int = FRAGMENT_CHARS) -> Dict[str, Any]:
+    """切分 ``html_path`` 并写出片段与索引；先写到临时目录，完成后整体替换。"""
+    with open(html_path, 'r', encoding='utf-8') as f:
+        html = f.read()
+    fragments, index_data = split_html(html, fragment_chars)
+    tmp_dir = tempfile.mkdtemp(dir=doc_dir, prefix='.fragments-')
+    for i, fragment in enumerate(fragments):
+        with open(os.path.join(tmp_dir, f"{i:05d}.html"), 'w', encoding='utf-8') as f:
+            f.write(fragment)
+    target = os.path.join(doc_dir, FRAGMENTS_DIRNAME)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.replace(tmp_dir, target)
+    tmp_index = os.path.join(doc_dir, INDEX_FILENAME + '.tmp')
+    with open(tmp_index, 'w', encoding='utf-8') as f:
+        json.dump(index_data, f, ensure_ascii=False)
+    os.replace(tmp_index, os.path.join(doc_dir, INDEX_FILENAME))
+    return index_data
+
+
+def load_fragment_index(doc_dir: str, html_path: str) -> Dict[str, Any]:
+    """读取片段索引；索引缺失、版本不符或比 HTML 旧时重新切分。"""
+    index_path = os.path.join(doc_dir, INDEX_FILENAME)
+    data = _read_fresh_index(index_path, html_path)
+    if data is not None:
+        return data
+    with _build_lock:
+        return _read_fresh_index(index_path, html_path) or build_fragments(doc_dir, html_path)
+
+
+def _read_fresh_index(index_path: str, html_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        if os.stat(index_path).st_mtime_ns >= os.stat(html_path).st_mtime_ns:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == FRAGMENTS_VERSION:
+                return data
+    except (OSError, ValueError):
+        pass
+    return None
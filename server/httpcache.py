@@ -0,0 +1,121 @@
+# server/httpcache.py
+"""HTTP 缓存校验（ETag / If-None-Match）与预压缩文件。
+
+文档 HTML 在导入时额外写出 ``.html.gz``（安装了 ``brotli`` 时还有 ``.html.br``），
+请求时按 Accept-Encoding 直接返回预压缩的文件，不必每次重新压缩。
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+# 按优先级排列的 (Content-Encoding, 文件后缀)
+SIDECAR_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def etag_for_stat(st: os.stat_result, suffix: str = "") -> str:
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}{suffix}"'
+
+
+def etag_for_bytes(data: bytes) -> str:
+    return f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+
+
+def _opaque(tag: str) -> str:
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def weak(etag: str) -> str:
+    return etag if etag.startswith('W/') else 'W/' + etag
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # If-None-Match 使用弱比较：双方都忽略 W/ 前缀
+    tags = [t.strip() for t in header.split(',')]
+    return _opaque(etag) in (_opaque(t) for t in tags)
+
+
+def _validator_headers(etag: str, extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # no-cache：浏览器可以保留副本，但每次使用前都要带 If-None-Match 重新校验
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    headers.update(extra or {})
+    return headers
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=_validator_headers(etag))
+
+
+def conditional_response(request: Request, body: bytes, media_type: str, etag: Optional[str] = None) -> Response:
+    """带 ETag 的响应；客户端的副本仍然有效时返回 304。
+
+    响应体之后可能被 GZipMiddleware 压缩，gzip 与原始表示共用同一个 ETag，
+    因此这里一律使用弱 ETag（强 ETag 必须随编码不同而不同）。
+    """
+    etag = weak(etag or etag_for_bytes(body))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    return Response(body, media_type=media_type, headers=_validator_headers(etag))
+
+
+def write_sidecars(path: str, data: Optional[bytes] = None):
+    """为 ``path`` 写出预压缩文件（先写临时文件再替换）。"""
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    for encoding, ext in SIDECAR_ENCODINGS:
+        if encoding == 'br':
+            if brotli is None:
+                continue
+            compressed = brotli.compress(data, quality=11)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, path + ext)
+
+
+def _accepts(request: Request, encoding: str) -> bool:
+    for part in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() == encoding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0')
+    return False
+
+
+def precompressed_response(request: Request, path: str, st: os.stat_result, media_type: str) -> Optional[Response]:
+    """客户端接受 br / gzip 时返回对应的预压缩文件（缺失或过期时就地补建），否则返回 None。
+
+    ETag 取自原文件的 mtime 与大小，不同编码的表示加上不同的后缀。
+    """
+    for encoding, ext in SIDECAR_ENCODINGS:
+        if not _accepts(request, encoding) or (encoding == 'br' and brotli is None):
+            continue
+        sidecar = path + ext
+        try:
+            fresh = os.stat(sidecar).st_mtime_ns >= st.st_mtime_ns
+        except OSError:
+            fresh = False
+        if not fresh:
+            write_sidecars(path)
+        etag = etag_for_stat(st, '-' + encoding)
+        if is_not_modified(request, etag):
+            return not_modified(etag)
+        return FileResponse(sidecar, media_type=media_type,
+                            headers=_validator_headers(etag, {'Content-Encoding': encoding}))
+    return None
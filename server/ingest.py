@@ -0,0 +1,387 @@
+# server/ingest.py
+"""PDF 入库流水线。
+
+``convert_pdf`` 在进程池的工作进程中调用 MinerU；``convert_pdf_chunked`` 先按页
+拆分 PDF，把各页段并发交给进程池，再把 Markdown 和图片合并成一份结果；
+``write_document`` 在主进程（线程池）中解压转换结果、生成 HTML 并写入
+data/documents/<doc>/。
+``ConversionJobs`` 记录每个转换任务的阶段与进度，并按 PDF 内容 + 转换参数
+去重，相同的上传直接复用已完成的文档。
+"""
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import markdown
+
+from server import atoms, fragments, httpcache, textindex
+from server.log import dump, fields, get_logger
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import MinerU gradio pipeline helpers directly
+MINERU_DIR = os.path.join(os.path.dirname(ROOT_DIR), 'MinerU')
+if MINERU_DIR not in sys.path:
+    sys.path.insert(0, MINERU_DIR)
+try:
+    from mineru.cli.gradio_app import to_markdown
+except Exception:
+    to_markdown = None
+
+# 基准测试等场景用 NBWEB_MINERU_MODULE 指定提供同签名 ``to_markdown`` 的替代模块（如 bench.fake_mineru）
+MINERU_MODULE = os.environ.get("NBWEB_MINERU_MODULE")
+if MINERU_MODULE:
+    to_markdown = importlib.import_module(MINERU_MODULE).to_markdown
+
+logger = get_logger('ingest')
+
+
+def mineru_available() -> bool:
+    return to_markdown is not None
+
+
+def convert_pdf(pdf_path: str, options: Dict[str, Any], converter: Optional[Callable[..., Awaitable]] = None) -> Dict[str, Any]:
+    """在工作进程中运行 MinerU，返回 ``{'md_content', 'archive_zip_path'}``。
+
+    ``converter`` 默认为 MinerU 的 ``to_markdown``，基准测试中可以换成签名相同的桩函数。
+    """
+    converter = converter or to_markdown
+    if converter is None:
+        raise RuntimeError("MinerU not available in server environment")
+    md_content, md_text, archive_zip_path, preview_pdf_path = asyncio.run(converter(
+        pdf_path, end_pages=options['max_pages'], is_ocr=False, formula_enable=True,
+        table_enable=True, language=options['language'], backend=options['backend'], url=None,
+    ))
+    return {'md_content': md_content, 'archive_zip_path': archive_zip_path}
+
+
+def pdf_page_count(pdf_path: str) -> Optional[int]:
+    if pdfium is None:
+        return None
+    try:
+        doc = pdfium.PdfDocument(pdf_path)
+    except Exception as e:
+        logger.warning("pypdfium2 无法读取 PDF", extra=fields(path=pdf_path, error=str(e)))
+        return None
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+
+def split_pdf(pdf_path: str, out_dir: str, chunk_pages: int, max_pages: int) -> List[Dict[str, Any]]:
+    """把前 ``max_pages`` 页按 ``chunk_pages`` 拆成若干个子 PDF。"""
+    src = pdfium.PdfDocument(pdf_path)
+    try:
+        total = min(len(src), max_pages)
+        chunks = []
+        for first in range(0, total, chunk_pages):
+            last = min(first + chunk_pages, total)
+            part = pdfium.PdfDocument.new()
+            part.import_pages(src, list(range(first, last)))
+            part_path = os.path.join(out_dir, f"pages_{first + 1:05d}-{last:05d}.pdf")
+            part.save(part_path)
+            part.close()
+            chunks.append({'path': part_path, 'first_page': first, 'pages': last - first})
+        return chunks
+    finally:
+        src.close()
+
+
+def _find_md_and_media(extract_dir: str):
+    for root, dirs, files in os.walk(extract_dir):
+        for f in files:
+            if f.endswith('.md'):
+                md_dir = root
+                for media_name in ('images', 'assets'):
+                    if os.path.isdir(os.path.join(md_dir, media_name)):
+                        return os.path.join(root, f), media_name
+                return os.path.join(root, f), None
+    return None, None
+
+
+def _same_file(a: str, b: str) -> bool:
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        return fa.read() == fb.read()
+
+
+def merge_converted_chunks(chunks: List[Dict[str, Any]], work_dir: str) -> Dict[str, Any]:
+    """按页序合并各页段的转换结果，打包成与单次转换相同结构的 zip。
+
+    MinerU 以图片内容的哈希命名图片，因此大多数文件名在各页段间天然唯一且稳定；
+    只有同名不同内容时才给后来的图片加上 ``p<起始页>_`` 前缀并改写引用。
+    """
+    merged_dir = os.path.join(work_dir, 'merged')
+    images_out = os.path.join(merged_dir, 'images')
+    os.makedirs(images_out, exist_ok=True)
+
+    md_parts = []
+    for chunk in sorted(chunks, key=lambda c: c['first_page']):
+        md = chunk['md_content'] or ""
+        archive = chunk.get('archive_zip_path')
+        if archive and os.path.exists(archive):
+            with tempfile.TemporaryDirectory(dir=work_dir) as extract_dir:
+                with zipfile.ZipFile(archive, 'r') as zip_ref:
+                    zip_ref.extractall(extract_dir)
+                md_path, media_name = _find_md_and_media(extract_dir)
+                if md_path and media_name:
+                    with open(md_path, 'r', encoding='utf-8') as f:
+                        md = f.read()
+                    media_dir = os.path.join(os.path.dirname(md_path), media_name)
+                    for fname in sorted(os.listdir(media_dir)):
+                        src = os.path.join(media_dir, fname)
+                        target = fname
+                        if os.path.exists(os.path.join(images_out, target)) and not _same_file(src, os.path.join(images_out, target)):
+                            target = f"p{chunk['first_page'] + 1}_{fname}"
+                        if not os.path.exists(os.path.join(images_out, target)):
+                            shutil.copyfile(src, os.path.join(images_out, target))
+                        md = md.replace(f"{media_name}/{fname}", f"images/{target}")
+            os.remove(archive)
+        md_parts.append(md.strip())
+
+    md_content = "\n\n".join(p for p in md_parts if p)
+    with open(os.path.join(merged_dir, 'merged.md'), 'w', encoding='utf-8') as f:
+        f.write(md_content)
+
+    archive_zip_path = os.path.join(work_dir, 'merged.zip')
+    with zipfile.ZipFile(archive_zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(merged_dir):
+            for f in files:
+                full = os.path.join(root, f)
+                zf.write(full, os.path.relpath(full, merged_dir))
+    shutil.rmtree(merged_dir, ignore_errors=True)
+    return {'md_content': md_content, 'archive_zip_path': archive_zip_path}
+
+
+async def convert_pdf_chunked(pool, pdf_path: str, options: Dict[str, Any], work_dir: str, chunk_pages: int,
+                              on_progress: Callable[[int, int], None] = lambda done, total: None,
+                              converter: Optional[Callable[..., Awaitable]] = None) -> Dict[str, Any]:
+    """按页段并发转换；页数不超过一个页段（或缺少 pypdfium2）时退回单次转换。"""
+    loop = asyncio.get_running_loop()
+    page_count = await asyncio.to_thread(pdf_page_count, pdf_path) if chunk_pages > 0 else None
+    if not page_count or min(page_count, options['max_pages']) <= chunk_pages:
+        if chunk_pages > 0 and pdfium is None:
+            logger.warning("未安装 pypdfium2，无法按页拆分，改为单次转换")
+        return await loop.run_in_executor(pool, convert_pdf, pdf_path, options, converter)
+
+    os.makedirs(work_dir, exist_ok=True)
+    chunks = await asyncio.to_thread(split_pdf, pdf_path, work_dir, chunk_pages, options['max_pages'])
+    logger.info("按页拆分并发转换", extra=fields(chunk_pages=chunk_pages, chunks=len(chunks)))
+    done = 0
+
+    async def convert_chunk(chunk):
+        nonlocal done
+        chunk_options = dict(options, max_pages=chunk['pages'])
+        result = await loop.run_in_executor(pool, convert_pdf, chunk['path'], chunk_options, converter)
+        done += 1
+        on_progress(done, len(chunks))
+        return dict(result, first_page=chunk['first_page'])
+
+    results = await asyncio.gather(*(convert_chunk(c) for c in chunks))
+    return await asyncio.to_thread(merge_converted_chunks, results, work_dir)
+
+
+def _unique_doc_dir(docs_dir: str, doc_foldername: str) -> str:
+    candidate, n = doc_foldername, 1
+    while os.path.exists(os.path.join(docs_dir, candidate)):
+        n += 1
+        candidate = f"{doc_foldername}_{n}"
+    return candidate
+
+
+def write_document(docs_dir: str, doc_foldername: str, md_content_from_mineru: str, archive_zip_path: Optional[str],
+                   on_stage: Callable[[str], None] = lambda stage: None, title: Optional[str] = None,
+                   page_count: Optional[int] = None) -> Dict[str, Any]:
+    """把 MinerU 的输出整理为 data/documents/<doc>/ 目录结构。"""
+    doc_foldername = _unique_doc_dir(docs_dir, doc_foldername)
+    doc_dir = os.path.join(docs_dir, doc_foldername)
+    os.makedirs(doc_dir)
+
+    html_filename = f"{doc_foldername}.html"
+    md_filename = f"{doc_foldername}.md"
+
+    md_content_for_html = md_content_from_mineru
+    clean_md_content = ""
+    found_media_dir_name = None
+
+    on_stage('extracting')
+    if archive_zip_path and os.path.exists(archive_zip_path):
+        with tempfile.TemporaryDirectory() as temp_extract_dir:
+            with zipfile.ZipFile(archive_zip_path, 'r') as zip_ref:
+                zip_ref.extractall(temp_extract_dir)
+
+            source_md_path = None
+            for root, dirs, files in os.walk(temp_extract_dir):
+                for f in files:
+                    if f.endswith('.md'):
+                        source_md_path = os.path.join(root, f)
+                        break
+                if source_md_path:
+                    break
+
+            if source_md_path:
+                md_dir = os.path.dirname(source_md_path)
+                source_media_path = None
+
+                potential_images_path = os.path.join(md_dir, 'images')
+                potential_assets_path = os.path.join(md_dir, 'assets')
+
+                if os.path.isdir(potential_images_path):
+                    source_media_path = potential_images_path
+                    found_media_dir_name = 'images'
+                elif os.path.isdir(potential_assets_path):
+                    source_media_path = potential_assets_path
+                    found_media_dir_name = 'assets'
+
+                if found_media_dir_name:
+                    with open(source_md_path, 'r', encoding='utf-8') as f:
+                        clean_md_content = f.read()
+
+                    md_content_for_html = clean_md_content
+                    md_for_ai_out_path = os.path.join(doc_dir, md_filename)
+                    with open(md_for_ai_out_path, 'w', encoding='utf-8') as f:
+                        f.write(clean_md_content)
+
+                    target_images_path = os.path.join(doc_dir, 'images')
+                    shutil.move(source_media_path, target_images_path)
+
+    if not clean_md_content:
+        clean_md_content = md_content_from_mineru
+        md_for_ai_out_path = os.path.join(doc_dir, md_filename)
+        with open(md_for_ai_out_path, 'w', encoding='utf-8') as f:
+            f.write(clean_md_content)
+
+    total_chars = len(clean_md_content)
+    # 导入时就建好检索索引，首次提问不必再等
+    textindex.build_and_save(os.path.join(doc_dir, md_filename), clean_md_content)
+    images_dir = os.path.join(doc_dir, 'images')
+    image_count = len(os.listdir(images_dir)) if os.path.isdir(images_dir) else 0
+    meta_path = os.path.join(doc_dir, 'meta.json')
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'total_chars': total_chars, 'title': title or doc_foldername, 'page_count': page_count,
+                   'image_count': image_count, 'created_at': time.time()}, f, ensure_ascii=False)
+
+    if found_media_dir_name:
+        web_accessible_path = f"/api/documents_assets/{doc_foldername}/images/"
+        search_string = f'src="{found_media_dir_name}/'
+        replace_string = f'src="{web_accessible_path}'
+        md_content_for_html = md_content_for_html.replace(search_string, replace_string)
+
+    on_stage('rendering')
+    dump(logger, "待渲染的 Markdown", md_content_for_html)
+
+    html_for_frontend = markdown.markdown(
+        md_content_for_html,
+        extensions=[ 'tables', 'fenced_code', 'nl2br', 'pymdownx.arithmatex' ],
+        extension_configs={ 'pymdownx.arithmatex': { 'generic': True } }
+    )
+    dump(logger, "渲染后的 HTML", html_for_frontend)
+
+    on_stage('writing')
+    html_out_path = os.path.join(doc_dir, html_filename)
+    with open(html_out_path, 'w', encoding='utf-8') as f:
+        f.write(html_for_frontend)
+    httpcache.write_sidecars(html_out_path)
+    fragments.build_fragments(doc_dir, html_out_path)
+    atoms.build_and_save(doc_dir, html_out_path, html_for_frontend)
+
+    if archive_zip_path and os.path.exists(archive_zip_path):
+        os.remove(archive_zip_path)
+
+    return {'document_id': doc_foldername, 'total_chars': total_chars, 'has_images': bool(found_media_dir_name)}
+
+
+class ConversionJobs:
+    """进程内的转换任务表，以及持久化的 “指纹 -> 文档” 去重索引。"""
+
+    STAGE_PERCENT = {
+        'queued': 0, 'converting': 10, 'extracting': 70, 'rendering': 85, 'writing': 95, 'done': 100, 'failed': 100,
+    }
+
+    def __init__(self, jobs_dir: str, docs_dir: str, max_jobs: int = 1000):
+        self.docs_dir = docs_dir
+        self.max_jobs = max_jobs
+        self.index_path = os.path.join(jobs_dir, 'index.json')
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._inflight: Dict[str, str] = {}
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._index: Dict[str, str] = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except Exception:
+                self._index = {}
+
+    def create(self, filename: str, fingerprint: str, **fields) -> Dict[str, Any]:
+        now = time.time()
+        job = {
+            'job_id': uuid.uuid4().hex, 'filename': filename, 'status': 'queued', 'stage': 'queued', 'percent': 0,
+            'document_id': None, 'error': None, 'reused': False, 'created_at': now, 'updated_at': now,
+        }
+        job.update(fields)
+        with self._lock:
+            self._jobs[job['job_id']] = job
+            if job['status'] in ('queued', 'running'):
+                self._inflight[fingerprint] = job['job_id']
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return dict(job)
+
+    def update(self, job_id: str, stage: str, percent: Optional[float] = None, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job['stage'] = stage
+            job['percent'] = self.STAGE_PERCENT.get(stage, job['percent']) if percent is None else percent
+            job['status'] = fields.pop('status', 'running' if stage not in ('done', 'failed') else stage)
+            job['updated_at'] = time.time()
+            job.update(fields)
+            if job['status'] in ('done', 'failed'):
+                for fp, jid in list(self._inflight.items()):
+                    if jid == job_id:
+                        del self._inflight[fp]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def find_inflight(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job_id = self._inflight.get(fingerprint)
+            return dict(self._jobs[job_id]) if job_id in self._jobs else None
+
+    def lookup_result(self, fingerprint: str) -> Optional[str]:
+        with self._lock:
+            document_id = self._index.get(fingerprint)
+        if document_id and os.path.isdir(os.path.join(self.docs_dir, document_id)):
+            return document_id
+        return None
+
+    def remember_result(self, fingerprint: str, document_id: str):
+        with self._lock:
+            self._index[fingerprint] = document_id
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
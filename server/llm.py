@@ -0,0 +1,270 @@
+# server/llm.py
+"""上游大模型后端。
+
+服务进程启动时（FastAPI lifespan）创建一个共享的后端实例，所有请求复用它的
+连接池；测试或离线调试时可以换成 ``StubBackend``，不需要网络和 API Key。
+"""
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from google import genai
+from google.genai import types
+
+from server.log import fields, get_logger
+
+logger = get_logger('llm')
+
+
+class LLMBackend:
+    """聊天服务依赖的最小模型接口。
+
+    ``contents`` 与 google-genai 的 ``generate_content`` 相同（字符串或 ``types.Part``）；
+    ``history`` 为 ``[{'role': 'user'|'model', 'parts': [{'text': ...}]}]``。
+    所有方法返回纯文本，流式方法逐段产出文本。
+
+    支持显式上下文缓存的后端把 ``supports_caching`` 设为 True：``create_cache`` 把一段
+    固定前缀存到上游并返回句柄，之后 ``generate(..., cached_content=句柄)`` 只需发送后缀。
+    """
+
+    supports_caching = False
+
+    async def generate(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> str:
+        raise NotImplementedError
+
+    def generate_stream(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def create_cache(self, model: str, contents: List[str], ttl: float) -> str:
+        raise NotImplementedError
+
+    async def update_cache_ttl(self, name: str, ttl: float):
+        raise NotImplementedError
+
+    async def delete_cache(self, name: str):
+        raise NotImplementedError
+
+    async def chat(self, model: str, history: List[Dict[str, Any]], message: str) -> str:
+        raise NotImplementedError
+
+    def chat_stream(self, model: str, history: List[Dict[str, Any]], message: str) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+def extract_response_text(response) -> str:
+    ai_response_text = ""  # 默认值，确保是字符串
+    try:
+        # 采用最稳健的方式来解析返回内容
+        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+            ai_response_text = response.candidates[0].content.parts[0].text or ""
+        else:
+            # 即使结构完整但内容为空，也记录一下，便于调试
+            logger.warning("Gemini API 返回了空的 candidates 或 parts")
+    except Exception as e:
+        # 捕获所有可能的解析错误
+        logger.warning("解析 Gemini API 响应时出错", extra=fields(error=str(e)))
+        ai_response_text = "[AI服务返回格式异常或无内容]"
+    return ai_response_text
+
+
+class GeminiBackend(LLMBackend):
+    """复用同一个 genai.Client 及其 keep-alive 连接池。"""
+
+    supports_caching = True
+
+    def __init__(self, api_key: str, timeout: float = 120.0, max_connections: int = 20,
+                 max_keepalive_connections: int = 10, keepalive_expiry: float = 60.0):
+        self._http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=int(timeout * 1000), httpx_async_client=self._http),
+        )
+
+    @staticmethod
+    def _config(cached_content: Optional[str]) -> Optional[types.GenerateContentConfig]:
+        return types.GenerateContentConfig(cached_content=cached_content) if cached_content else None
+
+    async def generate(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> str:
+        response = await self.client.aio.models.generate_content(model=model, contents=contents,
+                                                                 config=self._config(cached_content))
+        return extract_response_text(response)
+
+    async def generate_stream(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> AsyncIterator[str]:
+        stream = await self.client.aio.models.generate_content_stream(model=model, contents=contents,
+                                                                      config=self._config(cached_content))
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+    async def create_cache(self, model: str, contents: List[str], ttl: float) -> str:
+        cached = await self.client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role='user', parts=[types.Part(text=c) for c in contents])],
+                ttl=f"{int(ttl)}s",
+            ),
+        )
+        return cached.name
+
+    async def update_cache_ttl(self, name: str, ttl: float):
+        await self.client.aio.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{int(ttl)}s"))
+
+    async def delete_cache(self, name: str):
+        await self.client.aio.caches.delete(name=name)
+
+    async def chat(self, model: str, history: List[Dict[str, Any]], message: str) -> str:
+        chat_session = self.client.aio.chats.create(model=model, history=history)
+        response = await chat_session.send_message(message)
+        return extract_response_text(response)
+
+    async def chat_stream(self, model: str, history: List[Dict[str, Any]], message: str) -> AsyncIterator[str]:
+        chat_session = self.client.aio.chats.create(model=model, history=history)
+        stream = await chat_session.send_message_stream(message)
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+class StubBackend(LLMBackend):
+    """本地假模型：固定的首字延迟和吐字速度，回复内容可复现。
+
+    ``latency`` 为首个片段前的等待秒数，``token_rate`` 为每秒产出的片段数，
+    ``reply_tokens`` 为回复末尾追加的填充片段数（用于模拟长回答）。
+    ``prefill_rate`` 大于 0 时，未命中缓存的提示词每秒只能"读入"这么多字，用来模拟
+    长提示的首字延迟；显式缓存的前缀不计入。缓存保存在进程内并按 TTL 过期。
+    """
+
+    supports_caching = True
+
+    def __init__(self, latency: float = 0.05, token_rate: float = 200.0, reply_tokens: int = 0, chunk_size: int = 8,
+                 prefill_rate: float = 0.0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.chunk_size = chunk_size
+        self.prefill_rate = prefill_rate
+        self.calls: List[Dict[str, Any]] = []
+        self.caches: Dict[str, Dict[str, Any]] = {}
+        self._cache_seq = 0
+
+    def _reply_for(self, prompt: str) -> str:
+        question = prompt.strip().splitlines()[-1] if prompt.strip() else ""
+        reply = f"[stub] 收到 {len(prompt)} 字的提示，最后一行是: '{question[:80]}'。请设置 GOOGLE_API_KEY 环境变量以启用 Gemini AI。"
+        if self.reply_tokens:
+            reply += "\n\n" + " ".join(f"tok{i}" for i in range(self.reply_tokens))
+        return reply
+
+    @staticmethod
+    def _history_chars(history: List[Dict[str, Any]]) -> int:
+        return sum(len(part.get('text') or '') for msg in history for part in msg.get('parts', []))
+
+    @staticmethod
+    def _prompt_text(contents: List[Any]) -> str:
+        return "\n".join(c for c in contents if isinstance(c, str))
+
+    def _cached_prefix(self, cached_content: Optional[str]) -> str:
+        if not cached_content:
+            return ""
+        entry = self.caches.get(cached_content)
+        if entry is None or entry['expires_at'] <= time.time():
+            self.caches.pop(cached_content, None)
+            raise RuntimeError(f"404 NOT_FOUND: cached content {cached_content} not found or expired")
+        return entry['text']
+
+    async def _prefill(self, uncached_chars: int):
+        if self.prefill_rate > 0:
+            await asyncio.sleep(uncached_chars / self.prefill_rate)
+
+    async def create_cache(self, model: str, contents: List[str], ttl: float) -> str:
+        self._cache_seq += 1
+        name = f"cachedContents/stub-{self._cache_seq}"
+        text = "\n".join(contents)
+        self.calls.append({"method": "create_cache", "model": model, "name": name, "chars": len(text)})
+        await self._prefill(len(text))
+        self.caches[name] = {"model": model, "text": text, "expires_at": time.time() + ttl}
+        return name
+
+    async def update_cache_ttl(self, name: str, ttl: float):
+        self.calls.append({"method": "update_cache_ttl", "name": name, "ttl": ttl})
+        self._cached_prefix(name)
+        self.caches[name]['expires_at'] = time.time() + ttl
+
+    async def delete_cache(self, name: str):
+        self.calls.append({"method": "delete_cache", "name": name})
+        self.caches.pop(name, None)
+
+    async def _pieces(self, text: str) -> AsyncIterator[str]:
+        await asyncio.sleep(self.latency)
+        delay = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+        for i in range(0, len(text), self.chunk_size):
+            if i and delay:
+                await asyncio.sleep(delay)
+            yield text[i:i + self.chunk_size]
+
+    async def _collect(self, text: str) -> str:
+        return "".join([piece async for piece in self._pieces(text)])
+
+    async def generate(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> str:
+        self.calls.append({"method": "generate", "model": model, "contents": contents, "cached_content": cached_content})
+        prompt = self._prompt_text(contents)
+        prefix = self._cached_prefix(cached_content)
+        await self._prefill(len(prompt))
+        return await self._collect(self._reply_for(prefix + prompt))
+
+    async def generate_stream(self, model: str, contents: List[Any], cached_content: Optional[str] = None) -> AsyncIterator[str]:
+        self.calls.append({"method": "generate_stream", "model": model, "contents": contents, "cached_content": cached_content})
+        prompt = self._prompt_text(contents)
+        prefix = self._cached_prefix(cached_content)
+        await self._prefill(len(prompt))
+        async for piece in self._pieces(self._reply_for(prefix + prompt)):
+            yield piece
+
+    async def chat(self, model: str, history: List[Dict[str, Any]], message: str) -> str:
+        self.calls.append({"method": "chat", "model": model, "history": history, "message": message})
+        await self._prefill(self._history_chars(history) + len(message))
+        return await self._collect(self._reply_for(message))
+
+    async def chat_stream(self, model: str, history: List[Dict[str, Any]], message: str) -> AsyncIterator[str]:
+        self.calls.append({"method": "chat_stream", "model": model, "history": history, "message": message})
+        await self._prefill(self._history_chars(history) + len(message))
+        async for piece in self._pieces(self._reply_for(message)):
+            yield piece
+
+
+def create_backend_from_env(api_key: Optional[str] = None) -> LLMBackend:
+    """按环境变量创建后端；未设置 API Key 时默认使用 StubBackend。"""
+    api_key = api_key if api_key is not None else os.environ.get("GOOGLE_API_KEY")
+    kind = os.environ.get("NBWEB_LLM_BACKEND") or ("gemini" if api_key else "stub")
+    if kind == "stub":
+        return StubBackend(
+            latency=float(os.environ.get("NBWEB_STUB_LATENCY", "0.05")),
+            token_rate=float(os.environ.get("NBWEB_STUB_TOKEN_RATE", "200")),
+            reply_tokens=int(os.environ.get("NBWEB_STUB_REPLY_TOKENS", "0")),
+            prefill_rate=float(os.environ.get("NBWEB_STUB_PREFILL_RATE", "0")),
+        )
+    if kind == "gemini":
+        if not api_key:
+            raise RuntimeError("NBWEB_LLM_BACKEND=gemini requires GOOGLE_API_KEY")
+        return GeminiBackend(
+            api_key,
+            timeout=float(os.environ.get("NBWEB_LLM_TIMEOUT", "120")),
+            max_connections=int(os.environ.get("NBWEB_LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.environ.get("NBWEB_LLM_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(os.environ.get("NBWEB_LLM_KEEPALIVE_EXPIRY", "60")),
+        )
+    raise RuntimeError(f"Unknown NBWEB_LLM_BACKEND: {kind}")
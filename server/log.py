@@ -0,0 +1,81 @@
+# server/log.py
+"""服务端日志：分级、结构化，提示词与回复全文只在显式开启时输出（并截断）。
+
+用法::
+
+    logger = get_logger('chat')
+    logger.info("首轮提问", extra=fields(document_id=doc, prompt_chars=n))
+    dump(logger, "prompt", prompt_text)
+
+``NBWEB_LOG_FORMAT=json`` 时每条日志是一行 JSON，``fields`` 中的键值成为顶层字段；
+默认的 text 格式把它们写成 ``key=value``。
+"""
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict
+
+LOG_LEVEL = os.environ.get("NBWEB_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("NBWEB_LOG_FORMAT", "text")
+# 打印提示词 / 模型回复全文（调试用），每段最多 LOG_PROMPT_CHARS 字
+LOG_PROMPTS = os.environ.get("NBWEB_LOG_PROMPTS", "0") in ("1", "true", "True")
+LOG_PROMPT_CHARS = int(os.environ.get("NBWEB_LOG_PROMPT_CHARS", "2000"))
+
+ROOT_LOGGER = 'nbweb'
+
+
+def fields(**kwargs) -> Dict[str, Any]:
+    return {'fields': kwargs}
+
+
+def truncate(text: str, limit: int = LOG_PROMPT_CHARS) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}…[已截断，共 {len(text)} 字]"
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')} {record.levelname:<7} {record.name} {record.getMessage()}"
+        extra = getattr(record, 'fields', None)
+        if extra:
+            line += ' ' + ' '.join(f"{k}={v}" if '\n' not in str(v) else f"{k}=\n{v}" for k, v in extra.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'ts': round(record.created, 3), 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """给 ``nbweb`` 日志器装上输出到 stderr 的处理器；重复调用无副作用。"""
+    root = logging.getLogger(ROOT_LOGGER)
+    if getattr(root, '_nbweb_configured', False):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(_JsonFormatter() if fmt == 'json' else _TextFormatter())
+    root.addHandler(handler)
+    root.setLevel(level)
+    root.propagate = False
+    root._nbweb_configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def dump(logger: logging.Logger, label: str, text: Any):
+    """NBWEB_LOG_PROMPTS 开启时输出一段（截断后的）提示词或回复，否则什么也不做。"""
+    if not LOG_PROMPTS or not logger.isEnabledFor(logging.INFO):
+        return
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    logger.info(label, extra=fields(chars=len(text), text=truncate(text)))
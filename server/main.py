@@ -1,44 +1,61 @@
 # server/main.py
 import re 
-from fastapi import FastAPI, UploadFile, File, Form
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Form, Request, Depends, WebSocket
 from fastapi import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, field_validator, model_validator
+from typing import List, Literal, Optional, Dict, Any, Tuple
 import os
 import json
+import math
 import time
 import uuid
+import hashlib
 import shutil
 from pathlib import Path
-import zipfile
-import tempfile
-import requests
 import io
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import anyio
+import httpx
 
 import markdown
-from google import genai
 from google.genai import types
-import html2text
 
-ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+from server import atoms, ingest, strokes, textindex
+from server.doccache import DocumentCache
+from server import fragments, httpcache
+from server.catalog import IMAGE_EXTENSIONS, DocumentCatalog
+from server import conversations as conversation_history
+from server.conversations import ConversationStore
+from server.cache import DiskLRUCache, content_key
+from server import metrics
+from server.llm import LLMBackend, create_backend_from_env
+from server.log import dump, fields, get_logger, setup_logging
+from server.promptcache import PromptCache
+from server.realtime import SyncHub, create_pubsub
+from server.search import SearchIndex
+from server.storage import JsonFileWriter, Store, create_store
+
+setup_logging()
+logger = get_logger('main')
 
-# Import MinerU gradio pipeline helpers directly
-import sys
-MINERU_DIR = os.path.join(os.path.dirname(ROOT_DIR), 'MinerU')
-if MINERU_DIR not in sys.path:
-    sys.path.insert(0, MINERU_DIR)
-try:
-    from mineru.cli.gradio_app import to_markdown
-except Exception:
-    to_markdown = None
-DATA_DIR = os.path.join(ROOT_DIR, 'data')
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 数据目录可以用 NBWEB_DATA_DIR 改到别处（例如基准测试使用临时目录）
+DATA_DIR = os.environ.get("NBWEB_DATA_DIR") or os.path.join(ROOT_DIR, 'data')
 DOCS_DIR = os.path.join(DATA_DIR, 'documents')
 NODES_DIR = os.path.join(DATA_DIR, 'nodes')
 CHATS_DIR = os.path.join(DATA_DIR, 'chats')
 DRAWINGS_DIR = os.path.join(DATA_DIR, 'drawings') # 新增：绘图数据目录
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+JOBS_DIR = os.path.join(DATA_DIR, 'jobs')
+DB_PATH = os.path.join(DATA_DIR, 'nbweb.sqlite3')
 WEB_DIR = os.path.join(ROOT_DIR, 'web')
 
 os.makedirs(DOCS_DIR, exist_ok=True)
@@ -46,6 +63,48 @@ os.makedirs(NODES_DIR, exist_ok=True)
 os.makedirs(CHATS_DIR, exist_ok=True)
 os.makedirs(DRAWINGS_DIR, exist_ok=True) # 新增：创建绘图数据目录
 
+# 节点 / 对话的存储后端：sqlite（默认，按条读写）或 json（每个文档一个文件）
+STORAGE_BACKEND = os.environ.get("NBWEB_STORAGE", "sqlite")
+
+# 同时进行的上游 LLM 调用上限；超出的请求在信号量上排队，不占用线程池
+LLM_CONCURRENCY = int(os.environ.get("NBWEB_LLM_CONCURRENCY", "8"))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("NBWEB_IMAGE_FETCH_TIMEOUT", "30"))
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# PDF 转换在独立的进程池中执行，并行度可配置（MinerU 较吃内存/显存，默认 1）
+CONVERT_WORKERS = int(os.environ.get("NBWEB_CONVERT_WORKERS", "1"))
+# 大于 0 时把 PDF 按该页数拆段并发转换（需要 pypdfium2）；0 表示整本一次转换
+CONVERT_CHUNK_PAGES = int(os.environ.get("NBWEB_CONVERT_CHUNK_PAGES", "0"))
+conversion_jobs = ingest.ConversionJobs(JOBS_DIR, DOCS_DIR)
+
+# 绘图笔记等整文件写入：每个文件一把锁、原子替换；窗口内的连续保存合并为一次写盘
+JSON_WRITE_BATCH_MS = float(os.environ.get("NBWEB_JSON_WRITE_BATCH_MS", "0"))
+json_writer = JsonFileWriter(batch_window=JSON_WRITE_BATCH_MS / 1000)
+
+# 文档 Markdown / HTML 的进程内缓存；超过 NBWEB_DOC_CACHE_MMAP_MB 的文件改用 mmap 按区间读取
+document_cache = DocumentCache(
+    max_bytes=int(float(os.environ.get("NBWEB_DOC_CACHE_MAX_MB", "256")) * 1024 * 1024),
+    max_entry_bytes=int(float(os.environ.get("NBWEB_DOC_CACHE_MMAP_MB", "32")) * 1024 * 1024),
+)
+
+# 首轮提问的"系统提示 + 文档内容"前缀缓存到上游（显式上下文缓存），之后只发送问题部分
+PROMPT_CACHE_ENABLED = os.environ.get("NBWEB_PROMPT_CACHE", "1") not in ("0", "false", "False")
+PROMPT_CACHE_TTL = float(os.environ.get("NBWEB_PROMPT_CACHE_TTL", "600"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get("NBWEB_PROMPT_CACHE_MAX_ENTRIES", "32"))
+PROMPT_CACHE_MIN_CHARS = int(os.environ.get("NBWEB_PROMPT_CACHE_MIN_CHARS", "8000"))
+
+# 服务端对话：后续提问只带 conversation_id 与新问题；发给模型的历史（首轮问答之外）
+# 超过 token 预算时截断，开启摘要时把更早的轮次交给模型压缩成摘要
+CHAT_HISTORY_TOKENS = int(os.environ.get("NBWEB_CHAT_HISTORY_TOKENS", "8000"))
+CHAT_SUMMARY_ENABLED = os.environ.get("NBWEB_CHAT_SUMMARY", "1") not in ("0", "false", "False")
+
+# 实时同步的发布 / 订阅层：memory（默认，单进程）、sqlite（同一台机器上的多个 worker）或 包.模块:工厂
+PUBSUB_BACKEND = os.environ.get("NBWEB_PUBSUB", "memory")
+SYNC_RETAIN_EVENTS = int(os.environ.get("NBWEB_SYNC_RETAIN_EVENTS", "500"))
+
+# 保留后台任务的引用，防止任务在完成前被回收
+_background_tasks = set()
+
 
 class Message(BaseModel):
     role: str
@@ -68,15 +127,140 @@ class KnowledgeNode(BaseModel):
     conversation_log: List[Message]
     user_annotations: Optional[str] = None
     source_element_html: Optional[str] = None
+    conversation_id: Optional[str] = None
+
+
+def _reject_null(value):
+    # 字段缺省表示"不修改"；显式的 null 会把已保存的位置写坏，直接拒绝（422）
+    if value is None:
+        raise ValueError("must not be null")
+    return value
+
+
+class CanvasPositionPatch(BaseModel):
+    x: Optional[float] = None
+    y: Optional[float] = None
+    zoom_level: Optional[float] = None
+
+    _not_null = field_validator('x', 'y', 'zoom_level')(_reject_null)
+
+    @model_validator(mode='after')
+    def _not_empty(self):
+        if not self.model_fields_set:
+            raise ValueError("canvas_position must contain at least one of x, y, zoom_level")
+        return self
+
+
+class KnowledgeNodePatch(BaseModel):
+    """节点的部分更新：只需提交发生变化的字段（如拖动后的位置）。"""
+    canvas_position: Optional[CanvasPositionPatch] = None
+    user_annotations: Optional[str] = None
+
+    _not_null = field_validator('canvas_position')(_reject_null)
+
+
+class KnowledgeNodeBatchPatch(KnowledgeNodePatch):
+    node_id: str
 
 
 class ChatSession(BaseModel):
     id: str
     name: str
     messages: List[Message]
+    conversation_id: Optional[str] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 整个进程共享一个上游模型后端（及其连接池），避免每次请求重新建连
+    app.state.llm = create_backend_from_env()
+    app.state.prompt_cache = PromptCache(
+        app.state.llm,
+        ttl=PROMPT_CACHE_TTL,
+        max_entries=PROMPT_CACHE_MAX_ENTRIES,
+        min_chars=PROMPT_CACHE_MIN_CHARS,
+    ) if PROMPT_CACHE_ENABLED else None
+    app.state.store = create_store(STORAGE_BACKEND, DB_PATH, {'nodes': NODES_DIR, 'chats': CHATS_DIR, 'drawings': DRAWINGS_DIR})
+    app.state.catalog = DocumentCatalog(DB_PATH)
+    app.state.conversations = ConversationStore(DB_PATH)
+    app.state.search = SearchIndex(DB_PATH)
+    app.state.sync = SyncHub(create_pubsub(PUBSUB_BACKEND, DB_PATH, SYNC_RETAIN_EVENTS))
+    await app.state.sync.start()
+    added, removed = await anyio.to_thread.run_sync(app.state.catalog.sync, DOCS_DIR)
+    if added or removed:
+        logger.info("文档目录已与磁盘对账", extra=fields(added=added, removed=removed))
+    # 全文索引的对账可能要重新索引很多文档，放到后台进行，不阻塞启动
+    search_backfill = asyncio.create_task(_backfill_search(app))
+    app.state.convert_pool = ProcessPoolExecutor(max_workers=CONVERT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        yield
+    finally:
+        app.state.search.stop()
+        await search_backfill
+        await app.state.sync.close()
+        app.state.convert_pool.shutdown(wait=False, cancel_futures=True)
+        await json_writer.flush()
+        if app.state.prompt_cache:
+            await app.state.prompt_cache.aclose()
+        await app.state.llm.aclose()
+        app.state.store.close()
+        app.state.catalog.close()
+        app.state.conversations.close()
+        app.state.search.close()
+
+
+async def _backfill_search(app: FastAPI):
+    try:
+        documents, _ = await anyio.to_thread.run_sync(app.state.catalog.list)
+        counts = await anyio.to_thread.run_sync(app.state.search.backfill, DOCS_DIR, documents, app.state.store)
+        if any(counts.values()):
+            logger.info("全文索引已与磁盘对账", extra=fields(**counts))
+    except Exception:
+        logger.exception("全文索引对账失败")
+
+
+def get_llm(request: Request) -> LLMBackend:
+    return request.app.state.llm
+
+
+def get_store(request: Request) -> Store:
+    return request.app.state.store
+
+
+def get_catalog(request: Request) -> DocumentCatalog:
+    return request.app.state.catalog
+
 
+def get_prompt_cache(request: Request) -> Optional[PromptCache]:
+    return request.app.state.prompt_cache
+
+
+def get_conversations(request: Request) -> ConversationStore:
+    return request.app.state.conversations
+
+
+def get_search(request: Request) -> SearchIndex:
+    return request.app.state.search
+
+
+def get_sync(request: Request) -> SyncHub:
+    return request.app.state.sync
+
+
+def get_client_id(request: Request) -> Optional[str]:
+    """发起改动的客户端（``X-Client-Id`` 请求头），随同步事件广播，客户端据此忽略自己的改动。"""
+    return request.headers.get('x-client-id')
+
+
+async def _update_search(fn, *args):
+    """更新全文索引；失败只记日志，不影响已经完成的保存。"""
+    try:
+        await anyio.to_thread.run_sync(fn, *args)
+    except Exception as e:
+        logger.warning("全文索引更新失败", extra=fields(operation=fn.__name__, error=str(e)))
 
-app = FastAPI(title="nbweb backend")
+
+app = FastAPI(title="nbweb backend", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -84,12 +268,36 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 动态 JSON / HTML 响应按需 gzip；已带 Content-Encoding 的预压缩文件和 SSE 流不会被重复压缩
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 
 @app.get("/health")
 def health():
     return JSONResponse({"status": "ok"})
 
+
+def _collect_cache_stats() -> Dict[tuple, float]:
+    values = {('document', k): v for k, v in document_cache.stats().items()}
+    if app.state.prompt_cache:
+        values.update({('prompt_prefix', k): v for k, v in app.state.prompt_cache.stats().items()})
+    if answer_cache is not None:
+        values.update({('answer', k): v for k, v in answer_cache.stats().items()})
+    return values
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'nbweb_cache_state', 'Entries, bytes, hits and misses of in-process caches.', ['cache', 'field'], _collect_cache_stats))
+metrics.REGISTRY.register(metrics.Gauge(
+    'nbweb_sync_connections', 'Open real-time sync WebSocket connections in this process.', [],
+    lambda: {(): app.state.sync.connection_count()}))
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus 文本格式的指标。"""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/", response_class=HTMLResponse)
 def index():
     index_path = os.path.join(WEB_DIR, 'index.html')
@@ -104,37 +312,73 @@ app.mount("/api/documents_assets", StaticFiles(directory=DOCS_DIR), name="docume
 
 
 @app.get("/api/documents")
-def list_documents() -> List[Dict[str, Any]]:
-    docs = []
-    for fname in os.listdir(DOCS_DIR):
-        path = os.path.join(DOCS_DIR, fname)
-        if os.path.isdir(path):
-            meta_path = os.path.join(path, 'meta.json')
-            total_chars = 0
-            if os.path.exists(meta_path):
-                try:
-                    with open(meta_path, 'r', encoding='utf-8') as f:
-                        meta_data = json.load(f)
-                        total_chars = meta_data.get('total_chars', 0)
-                except Exception:
-                    total_chars = 0
-            
-            docs.append({
-                'document_id': fname,
-                'title': fname,
-                'total_chars': total_chars,
-            })
-    return docs
+async def list_documents(q: str = "", offset: int = 0, limit: Optional[int] = None,
+                         catalog: DocumentCatalog = Depends(get_catalog)):
+    """文档列表；``q`` 为标题 / id 前缀，``offset`` / ``limit`` 分页，总数见 X-Total-Count 响应头。"""
+    docs, total = await anyio.to_thread.run_sync(catalog.list, q, max(offset, 0), limit)
+    return JSONResponse(docs, headers={"X-Total-Count": str(total)})
+
+
+@app.delete("/api/documents/{document_id}")
+async def delete_document(document_id: str, catalog: DocumentCatalog = Depends(get_catalog),
+                          store: Store = Depends(get_store),
+                          conversations: ConversationStore = Depends(get_conversations),
+                          search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                          client_id: Optional[str] = Depends(get_client_id)):
+    doc_dir = os.path.join(DOCS_DIR, document_id)
+    if os.path.dirname(os.path.normpath(doc_dir)) != os.path.normpath(DOCS_DIR) or not os.path.isdir(doc_dir):
+        raise HTTPException(404, detail="Document not found")
+    await anyio.to_thread.run_sync(shutil.rmtree, doc_dir)
+    await anyio.to_thread.run_sync(catalog.remove, document_id)
+    await anyio.to_thread.run_sync(store.delete_document, document_id)
+    await anyio.to_thread.run_sync(conversations.delete_document, document_id)
+    await _update_search(search.remove_document, document_id)
+    await sync.publish(document_id, 'document.deleted', client_id)
+    image_precompute_status.pop(document_id, None)
+    return {"status": "ok"}
 
 
 @app.get("/api/document/{document_id}", response_class=HTMLResponse)
-def get_document(document_id: str):
+def get_document(document_id: str, request: Request):
     html_filename = f"{document_id}.html"
     path = os.path.join(DOCS_DIR, document_id, html_filename)
     if not os.path.isfile(path):
         raise HTTPException(404, detail="Document not found")
-    with open(path, 'r', encoding='utf-8') as f:
-        return f.read()
+    st = os.stat(path)
+    media_type = "text/html; charset=utf-8"
+    response = httpcache.precompressed_response(request, path, st, media_type)
+    if response is not None:
+        return response
+    etag = httpcache.weak(httpcache.etag_for_stat(st))
+    if httpcache.is_not_modified(request, etag):
+        return httpcache.not_modified(etag)
+    return httpcache.conditional_response(request, document_cache.read_text(path).encode('utf-8'), media_type, etag)
+
+
+@app.get("/api/document/{document_id}/fragments")
+def get_document_fragments(document_id: str, request: Request):
+    """片段索引：每个片段的字符数、atom 编号范围和首个标题；旧文档在此时补切分。"""
+    doc_dir = os.path.join(DOCS_DIR, document_id)
+    html_path = os.path.join(doc_dir, f"{document_id}.html")
+    if not os.path.isfile(html_path):
+        raise HTTPException(404, detail="Document not found")
+    index = fragments.load_fragment_index(doc_dir, html_path)
+    return httpcache.conditional_response(request, json.dumps(index, ensure_ascii=False).encode('utf-8'), "application/json")
+
+
+@app.get("/api/document/{document_id}/fragments/{index}", response_class=HTMLResponse)
+def get_document_fragment(document_id: str, index: int, request: Request):
+    doc_dir = os.path.join(DOCS_DIR, document_id)
+    html_path = os.path.join(doc_dir, f"{document_id}.html")
+    if not os.path.isfile(html_path):
+        raise HTTPException(404, detail="Document not found")
+    if index < 0 or index >= len(fragments.load_fragment_index(doc_dir, html_path)['fragments']):
+        raise HTTPException(404, detail="Fragment not found")
+    path = fragments.fragment_path(doc_dir, index)
+    etag = httpcache.weak(httpcache.etag_for_stat(os.stat(path)))
+    if httpcache.is_not_modified(request, etag):
+        return httpcache.not_modified(etag)
+    return httpcache.conditional_response(request, document_cache.read_text(path).encode('utf-8'), "text/html; charset=utf-8", etag)
 
 
 @app.post("/api/upload")
@@ -147,232 +391,336 @@ def upload_document(file: UploadFile = File(...)):
     return {"status": "ok", "document_id": file.filename}
 
 
-@app.post("/api/upload-pdf")
-async def upload_pdf(file: UploadFile = File(...), max_pages: int = 200, backend: str = 'pipeline', language: str = 'ch'):
-    if not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(400, detail="Only PDF is supported")
+def _save_upload(file: UploadFile, dest_path: str) -> str:
+    """把上传内容写入 dest_path，同时计算 SHA-256。"""
+    h = hashlib.sha256()
+    with open(dest_path, 'wb') as f:
+        while True:
+            chunk = file.file.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
 
-    tmp_dir = os.path.join(DATA_DIR, 'tmp')
-    os.makedirs(tmp_dir, exist_ok=True)
-    tmp_pdf_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.pdf")
-    with open(tmp_pdf_path, 'wb') as f:
-        shutil.copyfileobj(file.file, f)
 
-    if to_markdown is None:
-        raise HTTPException(500, detail="MinerU not available in server environment")
+# 任务失败时按所处步骤给出错误前缀
+PDF_JOB_ERRORS = {
+    'convert': "MinerU conversion failed",
+    'write': "Writing the converted document failed",
+    'catalog': "Adding the document to the catalog failed",
+}
+
 
-    archive_zip_path = None
-    clean_md_content = ""
+async def _run_pdf_job(app: FastAPI, job_id: str, tmp_pdf_path: str, filename: str, options: Dict[str, Any],
+                       fingerprint: str, analyze_images: bool, llm: LLMBackend):
+    work_dir = os.path.join(DATA_DIR, 'tmp', job_id)
+    step = 'convert'
     try:
-        md_content_from_mineru, md_text, archive_zip_path, preview_pdf_path = await to_markdown(
-            tmp_pdf_path, end_pages=max_pages, is_ocr=False, formula_enable=True,
-            table_enable=True, language=language, backend=backend, url=None,
+        conversion_jobs.update(job_id, 'converting')
+        page_count = await anyio.to_thread.run_sync(ingest.pdf_page_count, tmp_pdf_path)
+        try:
+            result = await ingest.convert_pdf_chunked(
+                app.state.convert_pool, tmp_pdf_path, options, work_dir, options['chunk_pages'],
+                on_progress=lambda done, total: conversion_jobs.update(job_id, 'converting', percent=10 + 60 * done / total),
+            )
+        finally:
+            if os.path.exists(tmp_pdf_path):
+                os.remove(tmp_pdf_path)
+
+        step = 'write'
+        doc_foldername = f"{Path(filename).stem}_{int(time.time())}"
+        info = await anyio.to_thread.run_sync(
+            ingest.write_document, DOCS_DIR, doc_foldername, result['md_content'], result['archive_zip_path'],
+            lambda stage: conversion_jobs.update(job_id, stage), Path(filename).stem,
+            min(page_count, options['max_pages']) if page_count else None,
         )
+        step = 'catalog'
+        entry = await anyio.to_thread.run_sync(app.state.catalog.add_from_disk, DOCS_DIR, info['document_id'])
+        await _update_search(app.state.search.index_document, info['document_id'], entry['title'],
+                             os.path.join(DOCS_DIR, info['document_id'], f"{info['document_id']}.html"))
+        conversion_jobs.remember_result(fingerprint, info['document_id'])
+        conversion_jobs.update(job_id, 'done', document_id=info['document_id'])
+
+        if analyze_images and info['has_images']:
+            schedule_image_precompute(llm, info['document_id'])
     except Exception as e:
-        raise HTTPException(500, detail=f"MinerU conversion failed: {e}")
+        logger.exception("PDF 转换任务失败", extra=fields(job_id=job_id, step=step))
+        conversion_jobs.update(job_id, 'failed', error=f"{PDF_JOB_ERRORS[step]}: {e}")
     finally:
-        if os.path.exists(tmp_pdf_path):
-            os.remove(tmp_pdf_path)
+        # 分块的 PDF 与中间结果无论成功与否都要清理
+        await anyio.to_thread.run_sync(lambda: shutil.rmtree(work_dir, ignore_errors=True))
 
-    doc_foldername = f"{Path(file.filename).stem}_{int(time.time())}"
-    doc_dir = os.path.join(DOCS_DIR, doc_foldername)
-    os.makedirs(doc_dir)
 
-    html_filename = f"{doc_foldername}.html"
-    md_filename = f"{doc_foldername}.md"
-    
-    md_content_for_html = md_content_from_mineru
-    found_media_dir_name = None
-
-    if archive_zip_path and os.path.exists(archive_zip_path):
-        with tempfile.TemporaryDirectory() as temp_extract_dir:
-            with zipfile.ZipFile(archive_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_extract_dir)
-
-            source_md_path = None
-            for root, dirs, files in os.walk(temp_extract_dir):
-                for f in files:
-                    if f.endswith('.md'):
-                        source_md_path = os.path.join(root, f)
-                        break
-                if source_md_path:
-                    break
-            
-            if source_md_path:
-                md_dir = os.path.dirname(source_md_path)
-                source_media_path = None
-                
-                potential_images_path = os.path.join(md_dir, 'images')
-                potential_assets_path = os.path.join(md_dir, 'assets')
-
-                if os.path.isdir(potential_images_path):
-                    source_media_path = potential_images_path
-                    found_media_dir_name = 'images'
-                elif os.path.isdir(potential_assets_path):
-                    source_media_path = potential_assets_path
-                    found_media_dir_name = 'assets'
-                
-                if found_media_dir_name:
-                    with open(source_md_path, 'r', encoding='utf-8') as f:
-                        clean_md_content = f.read()
-                    
-                    md_content_for_html = clean_md_content
-                    md_for_ai_out_path = os.path.join(doc_dir, md_filename)
-                    with open(md_for_ai_out_path, 'w', encoding='utf-8') as f:
-                        f.write(clean_md_content)
-                    
-                    target_images_path = os.path.join(doc_dir, 'images')
-                    shutil.move(source_media_path, target_images_path)
-
-    if not clean_md_content:
-        clean_md_content = md_content_from_mineru
-        md_for_ai_out_path = os.path.join(doc_dir, md_filename)
-        with open(md_for_ai_out_path, 'w', encoding='utf-8') as f:
-            f.write(clean_md_content)
-
-    total_chars = len(clean_md_content)
-    meta_path = os.path.join(doc_dir, 'meta.json')
-    with open(meta_path, 'w', encoding='utf-8') as f:
-        json.dump({'total_chars': total_chars}, f)
-
-
-    if found_media_dir_name:
-        web_accessible_path = f"/api/documents_assets/{doc_foldername}/images/"
-        search_string = f'src="{found_media_dir_name}/'
-        replace_string = f'src="{web_accessible_path}'
-        md_content_for_html = md_content_for_html.replace(search_string, replace_string)
-
-    print("\n" + "="*20 + " [Markdown Conversion Log] " + "="*20)
-    print("--- Markdown content snippet BEFORE conversion ---")
-    print(md_content_for_html[:1000] + "...")
-    print("-" * 50)
-
-    html_for_frontend = markdown.markdown(
-        md_content_for_html,
-        extensions=[ 'tables', 'fenced_code', 'nl2br', 'pymdownx.arithmatex' ],
-        extension_configs={ 'pymdownx.arithmatex': { 'generic': True } }
-    )
-    print("--- HTML content snippet AFTER conversion by markdown2 ---")
-    print(html_for_frontend[:1000] + "...")
-    print("="*67 + "\n")
-    
-    html_out_path = os.path.join(doc_dir, html_filename)
-    with open(html_out_path, 'w', encoding='utf-8') as f:
-        f.write(html_for_frontend)
-    
-    if archive_zip_path and os.path.exists(archive_zip_path):
-        os.remove(archive_zip_path)
+@app.post("/api/upload-pdf")
+async def upload_pdf(request: Request, file: UploadFile = File(...), max_pages: int = 200, backend: str = 'pipeline', language: str = 'ch',
+                     chunk_pages: Optional[int] = None, analyze_images: Optional[bool] = None, llm: LLMBackend = Depends(get_llm)):
+    if not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(400, detail="Only PDF is supported")
 
-    return {"status": "ok", "document_id": doc_foldername}
+    if not ingest.mineru_available():
+        raise HTTPException(500, detail="MinerU not available in server environment")
+
+    tmp_dir = os.path.join(DATA_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_pdf_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.pdf")
+    pdf_sha256 = await anyio.to_thread.run_sync(_save_upload, file, tmp_pdf_path)
+
+    options = {'max_pages': max_pages, 'backend': backend, 'language': language,
+               'chunk_pages': CONVERT_CHUNK_PAGES if chunk_pages is None else max(chunk_pages, 0)}
+    fingerprint = content_key(pdf_sha256, json.dumps(options, sort_keys=True))
+    analyze = PRECOMPUTE_IMAGE_DESCRIPTIONS if analyze_images is None else analyze_images
+
+    # 相同内容、相同参数的 PDF：复用已完成的文档，或挂到正在进行的任务上
+    existing_doc = conversion_jobs.lookup_result(fingerprint)
+    existing_job = None if existing_doc else conversion_jobs.find_inflight(fingerprint)
+    if existing_doc or existing_job:
+        os.remove(tmp_pdf_path)
+        if existing_job:
+            return {"status": existing_job["status"], "job_id": existing_job["job_id"], "document_id": None}
+        job = conversion_jobs.create(file.filename, fingerprint, status='done', stage='done', percent=100,
+                                     document_id=existing_doc, reused=True)
+        logger.info("复用已转换的文档", extra=fields(document_id=existing_doc))
+        return {"status": "ok", "job_id": job["job_id"], "document_id": existing_doc, "reused": True}
+
+    job = conversion_jobs.create(file.filename, fingerprint)
+    task = asyncio.create_task(_run_pdf_job(request.app, job["job_id"], tmp_pdf_path, file.filename, options,
+                                            fingerprint, analyze, llm))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return {"status": "queued", "job_id": job["job_id"], "document_id": None}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = conversion_jobs.get(job_id)
+    if not job:
+        raise HTTPException(404, detail="Job not found")
+    return job
+
+
+async def _write_json(path: str, data: Any):
+    await json_writer.write(path, data)
+
+
+def _parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+    """``?bbox=min_x,min_y,max_x,max_y``（画布坐标）。"""
+    if bbox is None:
+        return None
+    try:
+        x0, y0, x1, y1 = (float(v) for v in bbox.split(','))
+    except ValueError:
+        raise HTTPException(400, detail="bbox must be min_x,min_y,max_x,max_y")
+    if x1 < x0 or y1 < y0:
+        raise HTTPException(400, detail="bbox must be min_x,min_y,max_x,max_y")
+    return x0, y0, x1, y1
 
 
-def _nodes_path(document_id: str) -> str:
-    return os.path.join(NODES_DIR, f"{document_id}.json")
+async def _reindex_nodes(store: Store, search: SearchIndex, document_id: str, node_ids: List[str]):
+    """批注改动后按存储中的完整节点重建索引。"""
+    for node_id in node_ids:
+        node = await anyio.to_thread.run_sync(store.get_item, 'nodes', document_id, node_id)
+        if node is not None:
+            await _update_search(search.index_node, document_id, node)
 
 
-def _read_nodes(document_id: str) -> List[Dict[str, Any]]:
-    path = _nodes_path(document_id)
-    if not os.path.exists(path): return []
-    with open(path, 'r', encoding='utf-8') as f:
-        try: return json.load(f)
-        except Exception: return []
+@app.get("/api/search")
+async def search_all(q: str, kind: Optional[Literal['document', 'node', 'chat']] = None, document_id: Optional[str] = None,
+                     limit: int = 20, search: SearchIndex = Depends(get_search),
+                     catalog: DocumentCatalog = Depends(get_catalog)):
+    """全文检索文档、节点与对话；命中按相关度排序，带摘要（HTML，命中处为 ``<mark>``）与跳转目标。"""
+    if not search.enabled:
+        raise HTTPException(503, detail="Full-text search is not available")
+    start = time.perf_counter()
+    hits = await anyio.to_thread.run_sync(search.search, q, min(max(limit, 1), 100), kind, document_id)
 
+    def document_titles() -> Dict[str, str]:
+        return {d: (catalog.get(d) or {}).get('title', d) for d in {hit['document_id'] for hit in hits}}
 
-def _write_nodes(document_id: str, nodes: List[Dict[str, Any]]):
-    path = _nodes_path(document_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(nodes, f, ensure_ascii=False, indent=2)
+    titles = await anyio.to_thread.run_sync(document_titles)
+    for hit in hits:
+        hit['document_title'] = titles[hit['document_id']]
+    return {"query": q, "hits": hits, "took_ms": round((time.perf_counter() - start) * 1000, 1)}
 
 
 @app.get("/api/nodes/{document_id}")
-def list_nodes(document_id: str) -> List[Dict[str, Any]]:
-    return _read_nodes(document_id)
+async def list_nodes(document_id: str, request: Request, bbox: Optional[str] = None, store: Store = Depends(get_store)):
+    """给出 ``bbox`` 时只返回 ``canvas_position`` 落在其中的节点。"""
+    view = _parse_bbox(bbox)
+    if view is None:
+        body = await anyio.to_thread.run_sync(store.list_json, 'nodes', document_id)
+    else:
+        body = await anyio.to_thread.run_sync(store.query_json, 'nodes', document_id, view)
+    return httpcache.conditional_response(request, body.encode('utf-8'), "application/json")
 
 
 @app.post("/api/nodes/{document_id}")
-def create_or_update_node(document_id: str, node: KnowledgeNode):
-    nodes = _read_nodes(document_id)
-    found = False
-    for i, n in enumerate(nodes):
-        if n.get('node_id') == node.node_id:
-            nodes[i] = node.model_dump(); found = True; break
-    if not found:
-        nodes.append(node.model_dump())
-    _write_nodes(document_id, nodes)
+async def create_or_update_node(document_id: str, node: KnowledgeNode, store: Store = Depends(get_store),
+                                search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                                client_id: Optional[str] = Depends(get_client_id)):
+    item = node.model_dump()
+    with metrics.PERSISTENCE_SECONDS.time(kind='nodes'):
+        await anyio.to_thread.run_sync(store.upsert, 'nodes', document_id, item)
+    await _update_search(search.index_node, document_id, item)
+    await sync.publish(document_id, 'node.upserted', client_id, node=item)
     return {"status": "ok", "node_id": node.node_id}
 
 
-@app.delete("/api/nodes/{document_id}/{node_id}")
-def delete_node(document_id: str, node_id: str):
-    nodes = _read_nodes(document_id)
-    nodes = [n for n in nodes if n.get('node_id') != node_id]
-    _write_nodes(document_id, nodes)
-    return {"status": "ok"}
-
-def _chats_path(document_id: str) -> str:
-    return os.path.join(CHATS_DIR, f"{document_id}.json")
+@app.patch("/api/nodes/{document_id}/{node_id}")
+async def patch_node(document_id: str, node_id: str, patch: KnowledgeNodePatch, store: Store = Depends(get_store),
+                     search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                     client_id: Optional[str] = Depends(get_client_id)):
+    changes = patch.model_dump(exclude_unset=True)
+    with metrics.PERSISTENCE_SECONDS.time(kind='nodes'):
+        updated = await anyio.to_thread.run_sync(store.patch, 'nodes', document_id, node_id, changes)
+    if not updated:
+        raise HTTPException(404, detail="Node not found")
+    if 'user_annotations' in changes:
+        await _reindex_nodes(store, search, document_id, [node_id])
+    await sync.publish(document_id, 'nodes.patched', client_id, patches={node_id: changes})
+    return {"status": "ok", "node_id": node_id}
+
+
+@app.patch("/api/nodes/{document_id}")
+async def patch_nodes(document_id: str, patches: List[KnowledgeNodeBatchPatch], store: Store = Depends(get_store),
+                      search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                      client_id: Optional[str] = Depends(get_client_id)):
+    changes = {p.node_id: p.model_dump(exclude_unset=True, exclude={'node_id'}) for p in patches}
+    with metrics.PERSISTENCE_SECONDS.time(kind='nodes'):
+        updated = await anyio.to_thread.run_sync(store.patch_many, 'nodes', document_id, changes)
+    await _reindex_nodes(store, search, document_id, [n for n in updated if 'user_annotations' in changes[n]])
+    if updated:
+        await sync.publish(document_id, 'nodes.patched', client_id, patches={n: changes[n] for n in updated})
+    return {"status": "ok", "updated": updated, "missing": [node_id for node_id in changes if node_id not in updated]}
 
-def _read_chats(document_id: str) -> List[Dict[str, Any]]:
-    path = _chats_path(document_id)
-    if not os.path.exists(path): return []
-    with open(path, 'r', encoding='utf-8') as f:
-        try: return json.load(f)
-        except Exception: return []
 
-def _write_chats(document_id: str, chats: List[Dict[str, Any]]):
-    path = _chats_path(document_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(chats, f, ensure_ascii=False, indent=2)
+@app.delete("/api/nodes/{document_id}/{node_id}")
+async def delete_node(document_id: str, node_id: str, store: Store = Depends(get_store),
+                      search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                      client_id: Optional[str] = Depends(get_client_id)):
+    with metrics.PERSISTENCE_SECONDS.time(kind='nodes'):
+        await anyio.to_thread.run_sync(store.delete, 'nodes', document_id, node_id)
+    await _update_search(search.remove, 'node', document_id, node_id)
+    await sync.publish(document_id, 'node.deleted', client_id, node_id=node_id)
+    return {"status": "ok"}
 
 @app.get("/api/chats/{document_id}", response_model=List[ChatSession])
-def list_chats(document_id: str):
-    return _read_chats(document_id)
+async def list_chats(document_id: str, request: Request, store: Store = Depends(get_store)):
+    body = (await anyio.to_thread.run_sync(store.list_json, 'chats', document_id)).encode('utf-8')
+    return httpcache.conditional_response(request, body, "application/json")
 
 @app.post("/api/chats/{document_id}")
-def save_chat(document_id: str, chat: ChatSession):
-    chats = _read_chats(document_id)
-    found = False
-    for i, c in enumerate(chats):
-        if c.get('id') == chat.id:
-            chats[i] = chat.model_dump(); found = True; break
-    if not found:
-        chats.append(chat.model_dump())
-    _write_chats(document_id, chats)
+async def save_chat(document_id: str, chat: ChatSession, store: Store = Depends(get_store),
+                    search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                    client_id: Optional[str] = Depends(get_client_id)):
+    item = chat.model_dump()
+    with metrics.PERSISTENCE_SECONDS.time(kind='chats'):
+        previous = await anyio.to_thread.run_sync(store.get_item, 'chats', document_id, chat.id)
+        await anyio.to_thread.run_sync(store.upsert, 'chats', document_id, item)
+    await _update_search(search.index_chat, document_id, item)
+    # 只是追加了消息时只广播新消息
+    old = (previous or {}).get('messages')
+    if old is not None and len(item['messages']) > len(old) and item['messages'][:len(old)] == old:
+        await sync.publish(document_id, 'chat.appended', client_id, chat_id=chat.id, name=chat.name,
+                           conversation_id=chat.conversation_id, start=len(old), messages=item['messages'][len(old):])
+    elif previous != item:
+        await sync.publish(document_id, 'chat.upserted', client_id, chat=item)
     return {"status": "ok", "id": chat.id}
 
 @app.delete("/api/chats/{document_id}/{chat_id}")
-def delete_chat(document_id: str, chat_id: str):
-    chats = _read_chats(document_id)
-    chats = [c for c in chats if c.get('id') != chat_id]
-    _write_chats(document_id, chats)
+async def delete_chat(document_id: str, chat_id: str, store: Store = Depends(get_store),
+                      search: SearchIndex = Depends(get_search), sync: SyncHub = Depends(get_sync),
+                      client_id: Optional[str] = Depends(get_client_id)):
+    with metrics.PERSISTENCE_SECONDS.time(kind='chats'):
+        await anyio.to_thread.run_sync(store.delete, 'chats', document_id, chat_id)
+    await _update_search(search.remove, 'chat', document_id, chat_id)
+    await sync.publish(document_id, 'chat.deleted', client_id, chat_id=chat_id)
+    return {"status": "ok"}
+
+@app.delete("/api/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str, conversations: ConversationStore = Depends(get_conversations)):
+    await anyio.to_thread.run_sync(conversations.delete, conversation_id)
     return {"status": "ok"}
 
 
-# 新增：绘图笔记的辅助函数
-def _drawings_path(document_id: str) -> str:
-    return os.path.join(DRAWINGS_DIR, f"{document_id}.json")
+@app.websocket("/ws/documents/{document_id}")
+async def document_sync(websocket: WebSocket, document_id: str, since: Optional[int] = None):
+    """文档的实时同步：服务端推送带序号的增量事件；重连时 ``since`` 为最后收到的序号，先补发错过的事件。"""
+    await websocket.accept()
+    await websocket.app.state.sync.serve(websocket, document_id, since)
 
-def _read_drawings(document_id: str) -> List[Dict[str, Any]]:
-    path = _drawings_path(document_id)
-    if not os.path.exists(path): return []
-    with open(path, 'r', encoding='utf-8') as f:
-        try: return json.load(f)
-        except Exception: return []
 
-def _write_drawings(document_id: str, drawings: List[Dict[str, Any]]):
-    path = _drawings_path(document_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(drawings, f, ensure_ascii=False, indent=2)
+# 绘图笔画按条存储（与节点共用存储引擎），点坐标为紧凑编码的字符串，见 server/strokes.py
+class DrawingOp(BaseModel):
+    op: Literal['add', 'delete']
+    stroke: Optional[Dict[str, Any]] = None  # add：完整笔画；重做时重新提交被撤销的笔画
+    id: Optional[str] = None  # delete：笔画 id；撤销即删除
+
+
+def _normalize_strokes(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    try:
+        return [strokes.normalize(item) for item in items]
+    except ValueError as e:
+        raise HTTPException(400, detail=f"Invalid stroke: {e}")
+
+
+def _simplify_strokes(body: str, tolerance: float) -> str:
+    items = json.loads(body)
+    for item in items:
+        item['points'] = strokes.encode_points(strokes.simplify(strokes.decode_points(item['points']), tolerance))
+    return json.dumps(items, ensure_ascii=False, separators=(',', ':'))
+
 
-# 新增：获取绘图笔记的API
 @app.get("/api/drawings/{document_id}")
-def get_drawings(document_id: str) -> List[Dict[str, Any]]:
-    return _read_drawings(document_id)
+async def get_drawings(document_id: str, request: Request, bbox: Optional[str] = None, min_size: float = 0,
+                       tolerance: float = 0, store: Store = Depends(get_store)):
+    """按视口取笔画：``bbox`` 只返回与之相交的笔画；细节层次由调用方按缩放比例给出——
+    ``min_size`` 略去长宽都小于它的笔画，``tolerance`` 按该误差简化点列（均为画布单位）。"""
+    view = _parse_bbox(bbox)
+    if view is None and min_size <= 0:
+        body = await anyio.to_thread.run_sync(store.list_json, 'drawings', document_id)
+    else:
+        view = view or (-math.inf, -math.inf, math.inf, math.inf)
+        body = await anyio.to_thread.run_sync(store.query_json, 'drawings', document_id, view, min_size)
+    if tolerance > 0:
+        body = await anyio.to_thread.run_sync(_simplify_strokes, body, tolerance)
+    return httpcache.conditional_response(request, body.encode('utf-8'), "application/json")
+
+
+@app.post("/api/drawings/{document_id}/ops")
+async def apply_drawing_ops(document_id: str, ops: List[DrawingOp], store: Store = Depends(get_store),
+                            sync: SyncHub = Depends(get_sync), client_id: Optional[str] = Depends(get_client_id)):
+    """按顺序执行追加 / 删除笔画的操作；请求体只含新笔画，与已有笔画的数量无关。"""
+    for op in ops:
+        if (op.op == 'add' and op.stroke is None) or (op.op == 'delete' and not op.id):
+            raise HTTPException(400, detail=f"Incomplete '{op.op}' operation")
+    added = _normalize_strokes([op.stroke for op in ops if op.op == 'add'])
+
+    def apply():
+        pending = iter(added)
+        for op in ops:
+            if op.op == 'add':
+                store.upsert('drawings', document_id, next(pending))
+            else:
+                store.delete('drawings', document_id, op.id)
+
+    with metrics.PERSISTENCE_SECONDS.time(kind='drawings'):
+        await anyio.to_thread.run_sync(apply)
+    pending = iter(added)
+    await sync.publish(document_id, 'strokes.changed', client_id,
+                       ops=[{'op': 'add', 'stroke': next(pending)} if op.op == 'add' else {'op': 'delete', 'id': op.id} for op in ops])
+    return {"status": "ok", "ids": [stroke['id'] for stroke in added]}
+
 
-# 新增：保存绘图笔记的API
 @app.post("/api/drawings/{document_id}")
-def save_drawings(document_id: str, drawings: List[Dict[str, Any]]):
-    _write_drawings(document_id, drawings)
+async def save_drawings(document_id: str, drawings: List[Dict[str, Any]], store: Store = Depends(get_store),
+                        sync: SyncHub = Depends(get_sync), client_id: Optional[str] = Depends(get_client_id)):
+    """整体替换文档的全部笔画（旧接口），接受旧格式的点列表。"""
+    items = _normalize_strokes(drawings)
+    with metrics.PERSISTENCE_SECONDS.time(kind='drawings'):
+        await anyio.to_thread.run_sync(store.replace_document, 'drawings', document_id, items)
+    # 整体替换可能很大，只通知客户端重新加载
+    await sync.publish(document_id, 'strokes.replaced', client_id)
     return {"status": "ok"}
 
 
@@ -382,15 +730,69 @@ class ChatRequest(BaseModel):
     source_element_id: Optional[str] = None
     source_element_html: Optional[str] = None
     selected_elements_html: Optional[List[str]] = None
+    # 服务端编号（atom-N）；给出时按文档的元素索引取 Markdown，不必再发送 HTML
+    selected_element_ids: Optional[List[str]] = None
     image_url: Optional[str] = None
     char_start: Optional[int] = None
     char_end: Optional[int] = None
+    context_mode: Optional[str] = None  # full / retrieval / auto，缺省取 NBWEB_CONTEXT_MODE
+    conversation_id: Optional[str] = None  # 服务端对话 id；给出时 messages 只需包含新问题
+    no_cache: bool = False  # 跳过答案缓存，重新调用模型（新的回答仍会写入缓存）
+
+
+# 首轮提问的文档上下文：full 发送全文；retrieval 只发送检索出的相关片段；
+# auto 在文档超过 CONTEXT_FULL_MAX_CHARS 时使用 retrieval
+CONTEXT_MODE = os.environ.get("NBWEB_CONTEXT_MODE", "auto")
+CONTEXT_FULL_MAX_CHARS = int(os.environ.get("NBWEB_CONTEXT_FULL_MAX_CHARS", "30000"))
+CONTEXT_TOP_K = int(os.environ.get("NBWEB_CONTEXT_TOP_K", "6"))
+
+
+LLM_MODEL = os.environ.get("NBWEB_LLM_MODEL", "gemini-2.5-flash")
+
+IMAGE_ANALYSIS_PROMPT = "Please carefully analyze this image and output a detailed, structured description of everything it contains. Do not summarize. Instead, list all visible elements and details. Your description should include: Objects and entities (what they are, where they are, their relationships), Text present in the image (transcribe exactly if possible), Numbers, symbols, equations, charts, or tables, Colors, shapes, sizes, positions, and layout, Any actions, interactions, or context clues, If the image includes diagrams, figures, or math/physics notations, describe them precisely. Output should be verbose and exhaustive, so that another model reading your output can fully reconstruct and understand the image without ever seeing it."
+# 修改图片分析的流程（而不只是提示词）时递增，使旧的缓存结果失效
+IMAGE_ANALYSIS_VERSION = "1"
 
+# 图片描述缓存：key = SHA-256(分析版本, 模型, 提示词, 图片字节)
+image_description_cache = DiskLRUCache(
+    os.path.join(CACHE_DIR, 'image_descriptions'),
+    max_bytes=int(float(os.environ.get("NBWEB_IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    max_entries=int(os.environ.get("NBWEB_IMAGE_CACHE_MAX_ENTRIES", "10000")),
+)
+
+
+# 答案缓存（默认关闭）：最终提示词、历史与模型完全相同的提问直接返回上次的回答。
+# key = SHA-256(版本, 模型, 规范化后的提示词与历史)；聚焦内容和图片描述都已在提示词里
+ANSWER_CACHE_ENABLED = os.environ.get("NBWEB_ANSWER_CACHE", "0") not in ("0", "false", "False")
+# 修改提示词的组织方式时递增，使旧的回答失效
+ANSWER_CACHE_VERSION = "1"
+answer_cache = DiskLRUCache(
+    os.path.join(CACHE_DIR, 'answers'),
+    max_bytes=int(float(os.environ.get("NBWEB_ANSWER_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    max_entries=int(os.environ.get("NBWEB_ANSWER_CACHE_MAX_ENTRIES", "10000")),
+    ttl=float(os.environ.get("NBWEB_ANSWER_CACHE_TTL", "86400")),
+) if ANSWER_CACHE_ENABLED else None
+
+
+async def describe_image_bytes(llm: LLMBackend, image_bytes: bytes, mime_type: str) -> str:
+    cache_key = content_key(IMAGE_ANALYSIS_VERSION, LLM_MODEL, IMAGE_ANALYSIS_PROMPT, image_bytes)
+
+    async def describe() -> str:
+        image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+
+        logger.info("请求图片分析", extra=fields(model=LLM_MODEL, mime_type=mime_type, bytes=len(image_bytes)))
+
+        async with llm_semaphore:
+            description = await llm.generate(LLM_MODEL, [image_part, IMAGE_ANALYSIS_PROMPT])
 
-GEMINI_API_KEY = os.environ.get("GOOGLE_API_KEY")
+        dump(logger, "图片分析结果", description)
+        return description
 
+    # 相同图片（无论来自哪个文档或会话）只分析一次；并发请求共享同一次上游调用
+    return await image_description_cache.get_or_create(cache_key, describe)
 
-def analyze_image_with_ai(client: genai.Client, image_url: str) -> Optional[str]:
+
+async def analyze_image_with_ai(llm: LLMBackend, image_url: str) -> Optional[str]:
     image_bytes = None
     mime_type = 'image/png'
     
@@ -399,118 +801,123 @@ def analyze_image_with_ai(client: genai.Client, image_url: str) -> Optional[str]
             local_path = image_url.replace('/api/documents_assets/', '', 1)
             full_path = os.path.join(DOCS_DIR, local_path)
             
-            print(f"--- [图片分析] 正在从本地路径读取图片: {full_path}")
-            if os.path.exists(full_path):
-                with open(full_path, 'rb') as f:
-                    image_bytes = f.read()
+            path_parts = local_path.split('/')
+            if len(path_parts) == 3 and path_parts[1] == 'images':
+                stored = (await _read_image_descriptions(path_parts[0])).get(path_parts[2])
+                if stored:
+                    logger.debug("使用入库时预先生成的图片描述", extra=fields(path=local_path))
+                    return stored
+
+            if await anyio.Path(full_path).exists():
+                image_bytes = await anyio.Path(full_path).read_bytes()
                 if full_path.lower().endswith(('.jpg', '.jpeg')):
                     mime_type = 'image/jpeg'
             else:
-                print(f"--- [图片分析] 警告: 本地文件未找到: {full_path}")
+                logger.warning("图片分析：本地文件未找到", extra=fields(path=full_path))
                 return "[图片分析失败：服务器未找到对应的图片文件]"
 
         elif image_url.startswith('http://') or image_url.startswith('https://'):
-            print(f"--- [图片分析] 正在从URL下载图片: {image_url}")
-            response = requests.get(image_url, stream=True)
+            logger.debug("图片分析：下载远程图片", extra=fields(url=image_url))
+            async with httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True) as http:
+                response = await http.get(image_url)
             response.raise_for_status()
             image_bytes = response.content
             content_type = response.headers.get('Content-Type')
             if content_type:
                 mime_type = content_type
         else:
-            print(f"--- [图片分析] 错误: 不支持的图片URL格式: {image_url}")
+            logger.warning("图片分析：不支持的图片URL格式", extra=fields(url=image_url))
             return "[图片分析失败：不支持的图片URL格式]"
 
         if not image_bytes:
             return "[图片分析失败：无法获取图片数据]"
 
-        image_analysis_prompt = "Please carefully analyze this image and output a detailed, structured description of everything it contains. Do not summarize. Instead, list all visible elements and details. Your description should include: Objects and entities (what they are, where they are, their relationships), Text present in the image (transcribe exactly if possible), Numbers, symbols, equations, charts, or tables, Colors, shapes, sizes, positions, and layout, Any actions, interactions, or context clues, If the image includes diagrams, figures, or math/physics notations, describe them precisely. Output should be verbose and exhaustive, so that another model reading your output can fully reconstruct and understand the image without ever seeing it."
+        return await describe_image_bytes(llm, image_bytes, mime_type)
 
-        image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
-        
-        print("\n" + "="*20 + " [AI Image Analysis Request] " + "="*20)
-        print(f"--- Model: gemini-2.5-flash")
-        print(f"--- Mime Type: {mime_type}")
-        print(f"--- Prompt: {image_analysis_prompt}")
-        print("="*65 + "\n")
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[image_part, image_analysis_prompt]
-        )
+    except Exception as e:
+        logger.exception("图片分析失败", extra=fields(url=image_url))
+        return f"[图片分析失败: {e}]"
 
-        print("\n" + "="*20 + " [AI Image Analysis Response] " + "="*20)
-        print("--- Raw Response Object ---")
-        print(response)
-        print("="*67 + "\n")
 
-        return response.text
+# --- 入库阶段的图片预分析 ---
+# 文档转换完成后在后台把 images/ 下的每张图片分析一遍，结果写入
+# data/documents/<doc>/image_descriptions.json，聊天时直接查表。
+PRECOMPUTE_IMAGE_DESCRIPTIONS = os.environ.get("NBWEB_PRECOMPUTE_IMAGES", "0") == "1"
+IMAGE_PRECOMPUTE_WORKERS = int(os.environ.get("NBWEB_IMAGE_PRECOMPUTE_WORKERS", "4"))
+IMAGE_DESCRIPTIONS_FILENAME = 'image_descriptions.json'
 
-    except Exception as e:
-        print(f"--- [图片分析] 调用Gemini进行图片分析时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"[图片分析失败: {e}]"
+image_precompute_semaphore = asyncio.Semaphore(IMAGE_PRECOMPUTE_WORKERS)
+image_precompute_status: Dict[str, Dict[str, Any]] = {}
 
 
-@app.post("/api/chat")
-def chat(req: ChatRequest):
-    last_user_message = next((m for m in reversed(req.messages) if m.role == 'user'), None)
-    if not last_user_message:
-        raise HTTPException(status_code=400, detail="No user message found")
-    
-    print("\n" + "#"*25 + " [New Chat API Request Received] " + "#"*25)
-    print(req.model_dump_json(indent=2))
-    print("#"*81 + "\n")
+def _image_descriptions_path(document_id: str) -> str:
+    return os.path.join(DOCS_DIR, document_id, IMAGE_DESCRIPTIONS_FILENAME)
 
-    if not GEMINI_API_KEY:
-        response_text = (f"[stub] 理解你的问题是: '{last_user_message.text}'。请设置 GOOGLE_API_KEY 环境变量以启用 Gemini AI。")
-        return {"role": "assistant", "text": response_text, "timestamp": time.time()}
 
-    try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        
-        image_description = None
-        if req.image_url:
-            print(f"--- [聊天请求] 检测到图片URL，开始分析: {req.image_url}")
-            image_description = analyze_image_with_ai(client, req.image_url)
-
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        
-        focused_content_md = ""
-        if req.selected_elements_html:
-            md_parts = [h.handle(html) for html in req.selected_elements_html]
-            focused_content_md = "\n".join(md_parts)
-        elif req.source_element_html:
-            focused_content_md = h.handle(req.source_element_html)
-
-        is_first_turn = len(req.messages) == 1
-        response_payload = {}
-        ai_response_text = ""
-
-        if is_first_turn:
-            print("--- [聊天逻辑] 检测到为首次提问，正在构建完整上下文。 ---")
-            
-            md_filename = f"{req.document_id}.md"
-            md_filepath = os.path.join(DOCS_DIR, req.document_id, md_filename)
-            
-            full_doc_md = ""
-            if os.path.exists(md_filepath):
-                with open(md_filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if req.char_start is not None and req.char_end is not None:
-                        print(f"--- [上下文控制] 提取文档内容范围: {req.char_start} -> {req.char_end} ---")
-                        sliced_content = content[req.char_start:req.char_end]
-                        full_doc_md = f"[注意：以下仅为文档的一部分内容，从第 {req.char_start} 字到第 {req.char_end} 字]\n\n{sliced_content}"
-                    else:
-                        print("--- [上下文控制] 使用完整文档内容 ---")
-                        full_doc_md = content
-            else:
-                full_doc_md = "[无法找到完整的Markdown文档上下文]"
-                print(f"警告: 在路径 {md_filepath} 未找到对应的Markdown文件")
+async def _read_image_descriptions(document_id: str) -> Dict[str, str]:
+    path = _image_descriptions_path(document_id)
+    if not await anyio.Path(path).exists(): return {}
+    try: return json.loads(await _read_text(path)).get('images', {})
+    except Exception: return {}
+
+
+async def precompute_image_descriptions(llm: LLMBackend, document_id: str):
+    images_dir = os.path.join(DOCS_DIR, document_id, 'images')
+    names = sorted(n for n in os.listdir(images_dir) if n.lower().endswith(IMAGE_EXTENSIONS)) if os.path.isdir(images_dir) else []
+    status = image_precompute_status[document_id] = {
+        "status": "running", "total": len(names), "done": 0, "failed": 0, "started_at": time.time(), "finished_at": None,
+    }
+    descriptions = await _read_image_descriptions(document_id)
+
+    async def analyze_one(name: str):
+        async with image_precompute_semaphore:
+            try:
+                if name not in descriptions:
+                    image_bytes = await anyio.Path(images_dir, name).read_bytes()
+                    mime_type = 'image/jpeg' if name.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
+                    descriptions[name] = await describe_image_bytes(llm, image_bytes, mime_type)
+                status["done"] += 1
+            except Exception as e:
+                logger.warning("图片预分析失败", extra=fields(document_id=document_id, image=name, error=str(e)))
+                status["failed"] += 1
+
+    logger.info("开始图片预分析", extra=fields(document_id=document_id, images=len(names)))
+    await asyncio.gather(*(analyze_one(n) for n in names))
+    await _write_json(_image_descriptions_path(document_id), {"version": IMAGE_ANALYSIS_VERSION, "model": LLM_MODEL, "images": descriptions})
+    status.update({"status": "done", "finished_at": time.time()})
+    logger.info("图片预分析完成", extra=fields(document_id=document_id, done=status['done'], failed=status['failed']))
+
+
+def schedule_image_precompute(llm: LLMBackend, document_id: str) -> Dict[str, Any]:
+    current = image_precompute_status.get(document_id)
+    if current and current["status"] in ("queued", "running"):
+        return current
+    image_precompute_status[document_id] = {"status": "queued", "total": None, "done": 0, "failed": 0}
+    task = asyncio.create_task(precompute_image_descriptions(llm, document_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return image_precompute_status[document_id]
+
+
+@app.post("/api/documents/{document_id}/image-descriptions")
+async def start_image_precompute(document_id: str, llm: LLMBackend = Depends(get_llm)):
+    if not os.path.isdir(os.path.join(DOCS_DIR, document_id)):
+        raise HTTPException(404, detail="Document not found")
+    return schedule_image_precompute(llm, document_id)
+
+
+@app.get("/api/documents/{document_id}/image-descriptions/status")
+async def image_precompute_progress(document_id: str):
+    status = image_precompute_status.get(document_id)
+    if status:
+        return status
+    stored = await _read_image_descriptions(document_id)
+    if stored:
+        return {"status": "done", "total": len(stored), "done": len(stored), "failed": 0}
+    return {"status": "not_started", "total": None, "done": 0, "failed": 0}
+
 
-            system_prompt = """你是一个教育与知识解释，答题与解答助手，擅长解析文档内容并结合上下文回答问题。
+CHAT_SYSTEM_PROMPT = """你是一个教育与知识解释，答题与解答助手，擅长解析文档内容并结合上下文回答问题。
 
             我会给你三部分信息：
             1. 文档全文或选定部分的 Markdown 内容（可能包含文字、公式、图片、表格）
@@ -525,136 +932,473 @@ def chat(req: ChatRequest):
             - 如果用户要求用特定风格（如幽默、鲁迅风格），请保持该风格
             """
 
-            context_parts = [system_prompt]
 
-            if image_description:
-                context_parts.extend(["\n---","[图片内容描述]","这是关于用户当前正在查看的图片的一份详细文字描述，结合它来回答问题。",image_description])
+def _last_user_message(req: ChatRequest) -> Message:
+    last_user_message = next((m for m in reversed(req.messages) if m.role == 'user'), None)
+    if not last_user_message:
+        raise HTTPException(status_code=400, detail="No user message found")
+    return last_user_message
+
+
+async def _read_text(path: str) -> str:
+    async with await anyio.open_file(path, 'r', encoding='utf-8') as f:
+        return await f.read()
+
+
+def _use_retrieval(mode: str, doc_chars: int) -> bool:
+    if mode == "retrieval":
+        return True
+    if mode == "auto":
+        return doc_chars > CONTEXT_FULL_MAX_CHARS
+    return False
+
+
+async def _load_conversation(conversations: ConversationStore, req: ChatRequest) -> Optional[Dict[str, Any]]:
+    """读取请求引用的服务端对话；找不到时返回 404，客户端应改为携带完整历史重发。"""
+    if not req.conversation_id:
+        return None
+    conversation = await anyio.to_thread.run_sync(conversations.get, req.conversation_id)
+    if conversation is None or conversation['document_id'] != req.document_id:
+        raise HTTPException(status_code=404, detail="conversation_not_found")
+    conversation['turns'] = await anyio.to_thread.run_sync(conversations.live_turns, conversation)
+    return conversation
+
+
+async def _focused_content(req: ChatRequest) -> str:
+    """选中元素（或单个来源元素）的 Markdown。
+
+    请求带有 HTML 时直接转换；只带服务端编号时从元素索引中查找，有编号找不到（如索引
+    与前端页面不一致）时返回 409 ``atoms_not_found``，客户端应改为携带 HTML 重发。
+    """
+    if req.selected_elements_html:
+        with metrics.stage('html2text'):
+            return "\n".join(atoms.html_to_markdown(html) for html in req.selected_elements_html)
+    atom_ids = req.selected_element_ids
+    if not atom_ids and req.source_element_id and not req.source_element_html and atoms.ATOM_ID_RE.match(req.source_element_id):
+        atom_ids = [req.source_element_id]
+    if atom_ids:
+        doc_dir = os.path.join(DOCS_DIR, req.document_id)
+        html_path = os.path.join(doc_dir, f"{req.document_id}.html")
+        with metrics.stage('atom_lookup'):
+            try:
+                index = await anyio.to_thread.run_sync(atoms.load_index, doc_dir, html_path)
+            except FileNotFoundError:
+                index = []
+            parts, missing = atoms.lookup(index, atom_ids)
+        if missing:
+            raise HTTPException(status_code=409, detail="atoms_not_found")
+        return "\n".join(parts)
+    if req.source_element_html:
+        with metrics.stage('html2text'):
+            return atoms.html_to_markdown(req.source_element_html)
+    return ""
+
+
+async def _build_chat_prompt(llm: LLMBackend, req: ChatRequest, conversation: Optional[Dict[str, Any]] = None,
+                             focused_content_md: str = "") -> Dict[str, Any]:
+    """根据请求构建发送给模型的内容。
+
+    返回 ``{"is_first_turn", "prompt", "history"}``；首轮提问 ``history`` 为 None。
+    ``conversation`` 为服务端对话时历史取自服务端，否则取自请求中的 ``messages``；
+    ``focused_content_md`` 来自 ``_focused_content``。
+    """
+    image_description = None
+    if req.image_url:
+        with metrics.stage('image_analysis'):
+            image_description = await analyze_image_with_ai(llm, req.image_url)
+
+    is_first_turn = not conversation['turns'] if conversation else len(req.messages) == 1
+
+    if is_first_turn:
+        md_filename = f"{req.document_id}.md"
+        md_filepath = os.path.join(DOCS_DIR, req.document_id, md_filename)
+
+        full_doc_md = ""
+        # 检索片段随问题变化，不做前缀缓存
+        cacheable = False
+        if await anyio.Path(md_filepath).exists():
+            with metrics.stage('md_load'):
+                content = await anyio.to_thread.run_sync(document_cache.get_text, md_filepath)
+            has_range = req.char_start is not None and req.char_end is not None
+            retrieval = not has_range and _use_retrieval(req.context_mode or CONTEXT_MODE, len(content))
+            if has_range:
+                context_mode = "range"
+                sliced_content = content[req.char_start:req.char_end]
+                full_doc_md = f"[注意：以下仅为文档的一部分内容，从第 {req.char_start} 字到第 {req.char_end} 字]\n\n{sliced_content}"
+            elif retrieval:
+                context_mode = "retrieval"
+                with metrics.stage('retrieval'):
+                    index = await anyio.to_thread.run_sync(textindex.load_index, md_filepath, content)
+                    excerpts = await anyio.to_thread.run_sync(
+                        textindex.select_context, content, index, req.messages[0].text, focused_content_md, CONTEXT_TOP_K)
+                full_doc_md = f"[注意：以下是根据问题从文档中检索出的相关片段，并非全文，全文共 {len(content)} 字]\n\n{excerpts}"
+            else:
+                context_mode = "full"
+                full_doc_md = str(content)
+            cacheable = not retrieval
+        else:
+            context_mode = "missing"
+            full_doc_md = "[无法找到完整的Markdown文档上下文]"
+            logger.warning("未找到文档对应的 Markdown 文件", extra=fields(path=md_filepath))
+
+        # 前缀（系统提示 + 文档内容）对同一文档、同一范围的提问保持不变，可以缓存到上游；
+        # 图片描述、聚焦内容和问题放在后缀里
+        prefix = "\n".join([CHAT_SYSTEM_PROMPT, "\n---", "[文档内容]", full_doc_md])
+
+        extra_parts = []
+        if image_description:
+            extra_parts.extend(["\n---","[图片内容描述]","这是关于用户当前正在查看的图片的一份详细文字描述，结合它来回答问题。",image_description])
+
+        if focused_content_md:
+            extra_parts.extend(["\n---","[聚焦内容]",focused_content_md])
+
+        user_question = req.messages[0].text
+        suffix = "".join("\n" + part for part in extra_parts) + f"\n\n---\n\n[用户问题]\n{user_question}\n\n请结合以上信息，给出清晰、准确且结构化的回答。"
+        prompt_for_model = prefix + suffix
+
+        logger.info("首轮提问", extra=fields(document_id=req.document_id, context=context_mode,
+                                             char_start=req.char_start, char_end=req.char_end,
+                                             prompt_chars=len(prompt_for_model), image=bool(image_description)))
+        dump(logger, "首轮提示词", prompt_for_model)
+        return {"is_first_turn": True, "prompt": prompt_for_model, "history": None,
+                "prefix": prefix if cacheable else None, "suffix": suffix}
+
+    if conversation:
+        history_for_model = conversation_history.build_history(conversation, conversation['turns'], CHAT_HISTORY_TOKENS)
+    else:
+        history_for_model = [{'role': 'model' if msg.role == 'assistant' else 'user', 'parts': [{'text': msg.text}]} for msg in req.messages[:-1]]
+
+    last_user_question = req.messages[-1].text
+
+    # 【关键修改】为后续提问注入新的文档或元素上下文
+    new_context_prompt_part = ""
+
+    if focused_content_md:
+        new_context_prompt_part = f"请参考我新选中的内容，并结合我们之前的完整对话来回答。\n\n[新聚焦内容]\n{focused_content_md}\n\n---"
+    else:
+        md_filename = f"{req.document_id}.md"
+        md_filepath = os.path.join(DOCS_DIR, req.document_id, md_filename)
+        if req.char_start is not None and req.char_end is not None and await anyio.Path(md_filepath).exists():
+            with metrics.stage('md_load'):
+                sliced_content = await anyio.to_thread.run_sync(document_cache.read_slice, md_filepath, req.char_start, req.char_end)
+            new_context_prompt_part = f"请参考我新选中的文档内容（字 {req.char_start} 至 {req.char_end}）并结合我们之前的对话来回答。\n\n[新文档上下文]\n{sliced_content}\n\n---"
+
+    prompt_for_model = f"{new_context_prompt_part}\n我的问题是：{last_user_question}" if new_context_prompt_part else last_user_question
+
+    logger.info("后续提问", extra=fields(document_id=req.document_id, conversation_id=req.conversation_id,
+                                         history_turns=len(history_for_model), prompt_chars=len(prompt_for_model),
+                                         new_context=bool(new_context_prompt_part)))
+    dump(logger, "对话历史", history_for_model)
+    dump(logger, "后续提示词", prompt_for_model)
+    return {"is_first_turn": False, "prompt": prompt_for_model, "history": history_for_model}
+
+
+async def _record_turn(llm: LLMBackend, conversations: ConversationStore, req: ChatRequest,
+                       conversation: Optional[Dict[str, Any]], prompt: Dict[str, Any], ai_response_text: str) -> str:
+    """把本轮问答追加到服务端对话，返回对话 id。
+
+    请求没有引用对话时新建一个；若是后续提问（旧客户端或服务端对话已丢失），先导入请求中的历史。
+    """
+    turns = []
+    if conversation:
+        conversation_id = conversation['conversation_id']
+    else:
+        conversation_id = await anyio.to_thread.run_sync(conversations.create, req.document_id)
+        if not prompt["is_first_turn"]:
+            turns = [('model' if m.role == 'assistant' else 'user', m.text) for m in req.messages[:-1]]
+    turns += [('user', prompt["prompt"]), ('model', ai_response_text)]
+    with metrics.PERSISTENCE_SECONDS.time(kind='conversations'):
+        await anyio.to_thread.run_sync(conversations.append, conversation_id, turns)
+    if CHAT_SUMMARY_ENABLED:
+        task = asyncio.create_task(_compact_conversation(llm, conversations, conversation_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return conversation_id
+
+
+_compacting_conversations = set()
+
+
+async def _compact_conversation(llm: LLMBackend, conversations: ConversationStore, conversation_id: str):
+    """未摘要的轮次超出预算时，让模型把较早的轮次压缩进摘要。失败时历史仍按预算截断。"""
+    if conversation_id in _compacting_conversations:
+        return
+    _compacting_conversations.add(conversation_id)
+    try:
+        conversation = await anyio.to_thread.run_sync(conversations.get, conversation_id)
+        if conversation is None:
+            return
+        turns = await anyio.to_thread.run_sync(conversations.live_turns, conversation)
+        plan = conversation_history.compaction_plan(turns, CHAT_HISTORY_TOKENS)
+        if not plan:
+            return
+        async with llm_semaphore:
+            summary = await llm.generate(LLM_MODEL, [conversation_history.summary_prompt(conversation['summary'], plan)])
+        await anyio.to_thread.run_sync(conversations.set_summary, conversation_id, summary.strip(), plan[-1]['seq'])
+        logger.info("已把较早的轮次压缩进摘要", extra=fields(conversation_id=conversation_id,
+                                                        first_seq=plan[0]['seq'], last_seq=plan[-1]['seq']))
+    except Exception as e:
+        logger.warning("对话摘要失败，暂时只保留预算内的最近轮次", extra=fields(conversation_id=conversation_id, error=str(e)))
+    finally:
+        _compacting_conversations.discard(conversation_id)
 
-            context_parts.extend(["\n---","[文档内容]",full_doc_md])
 
-            if focused_content_md:
-                context_parts.extend(["\n---","[聚焦内容]",focused_content_md])
+def _build_response_payload(document_id: str, ai_response_text: str, prompt: Dict[str, Any],
+                            conversation_id: Optional[str] = None) -> Dict[str, Any]:
+    ai_response_text = re.sub(r'```[a-zA-Z]*\s*(<img[^>]*>)\s*```', r'\1', ai_response_text, flags=re.DOTALL)
+    with metrics.stage('markdown_render'):
+        ai_response_html = markdown.markdown(
+            ai_response_text,
+            extensions=['tables', 'fenced_code', 'nl2br', 'pymdownx.arithmatex'],
+            extension_configs={'pymdownx.arithmatex': {'generic': True}}
+        )
+    correct_image_path_prefix = f'src="/api/documents_assets/{document_id}/images/'
+    ai_response_html = ai_response_html.replace('src="images/', correct_image_path_prefix)
+
+    response_payload = {
+        "role": "assistant",
+        "text": ai_response_text,
+        "htmlText": ai_response_html,
+        "timestamp": time.time(),
+    }
+    if prompt["is_first_turn"]:
+        response_payload["first_user_message_override"] = prompt["prompt"]
+    if conversation_id:
+        response_payload["conversation_id"] = conversation_id
+    return response_payload
+
+
+async def _prompt_cache_handle(prompt_cache: Optional[PromptCache], req: ChatRequest, prompt: Dict[str, Any]):
+    """返回 ``(缓存句柄, key)``；不适用缓存时句柄为 None。"""
+    prefix = prompt.get("prefix")
+    if prompt_cache is None or not prefix or not prompt_cache.enabled_for(prefix):
+        return None, None
+    key = PromptCache.key_for(LLM_MODEL, req.document_id, req.char_start, req.char_end, prefix)
+    return await prompt_cache.get_handle(key, LLM_MODEL, prefix), key
+
+
+async def _generate_first_turn(llm: LLMBackend, prompt_cache: Optional[PromptCache], req: ChatRequest,
+                               prompt: Dict[str, Any]) -> str:
+    handle, key = await _prompt_cache_handle(prompt_cache, req, prompt)
+    if handle:
+        try:
+            return await llm.generate(LLM_MODEL, [prompt["suffix"]], cached_content=handle)
+        except Exception as e:
+            # 句柄可能已在上游过期或被删除：丢弃并改为发送完整提示
+            logger.warning("前缀缓存不可用，改为发送完整提示", extra=fields(name=handle, error=str(e)))
+            prompt_cache.invalidate(key)
+    return await llm.generate(LLM_MODEL, [prompt["prompt"]])
+
+
+async def _stream_first_turn(llm: LLMBackend, prompt_cache: Optional[PromptCache], req: ChatRequest,
+                             prompt: Dict[str, Any]):
+    handle, key = await _prompt_cache_handle(prompt_cache, req, prompt)
+    if handle:
+        started = False
+        try:
+            async for piece in llm.generate_stream(LLM_MODEL, [prompt["suffix"]], cached_content=handle):
+                started = True
+                yield piece
+            return
+        except Exception as e:
+            if started:
+                raise
+            logger.warning("前缀缓存不可用，改为发送完整提示", extra=fields(name=handle, error=str(e)))
+            prompt_cache.invalidate(key)
+    async for piece in llm.generate_stream(LLM_MODEL, [prompt["prompt"]]):
+        yield piece
+
+
+def _normalize_prompt_text(text: str) -> str:
+    # 只合并空白，不改大小写（代码、公式里大小写有意义）
+    return " ".join(text.split())
+
+
+def _answer_key(prompt: Dict[str, Any]) -> str:
+    history = [[message['role'], [_normalize_prompt_text(part.get('text') or '') for part in message['parts']]]
+               for message in prompt["history"] or []]
+    return content_key(ANSWER_CACHE_VERSION, LLM_MODEL, _normalize_prompt_text(prompt["prompt"]),
+                       json.dumps(history, ensure_ascii=False))
+
+
+async def _lookup_answer(req: ChatRequest, prompt: Dict[str, Any]):
+    """返回 ``(key, 缓存的回答)``；未开启缓存时 key 为 None，未命中或 ``no_cache`` 时回答为 None。"""
+    if answer_cache is None:
+        return None, None
+    key = _answer_key(prompt)
+    if req.no_cache:
+        return key, None
+    with metrics.stage('answer_cache'):
+        cached = await anyio.to_thread.run_sync(answer_cache.get, key)
+    if cached is not None:
+        logger.info("答案缓存命中", extra=fields(document_id=req.document_id, key=key[:16]))
+    return key, cached
+
+
+async def _store_answer(key: Optional[str], ai_response_text: str):
+    if key is None or not ai_response_text.strip():
+        return
+    try:
+        await anyio.to_thread.run_sync(answer_cache.set, key, ai_response_text)
+    except OSError as e:
+        logger.warning("无法写入答案缓存", extra=fields(key=key[:16], error=str(e)))
 
-            initial_context_string = "\n".join(context_parts)
-            user_question = req.messages[0].text
-            prompt_for_model = f"{initial_context_string}\n\n---\n\n[用户问题]\n{user_question}\n\n请结合以上信息，给出清晰、准确且结构化的回答。"
 
-            print("\n" + "="*50 + "\n>>> CURRENT USER PROMPT (FIRST TURN - FULL CONTEXT):\n" + prompt_for_model + "\n" + "="*50 + "\n")
+def _log_chat_request(endpoint: str, req: ChatRequest):
+    logger.info("收到聊天请求", extra=fields(endpoint=endpoint, document_id=req.document_id,
+                                           conversation_id=req.conversation_id, messages=len(req.messages),
+                                           image=bool(req.image_url)))
+    dump(logger, "聊天请求", req.model_dump_json())
 
-            response = client.models.generate_content(model="gemini-2.5-flash", contents=[prompt_for_model])
-            
-            print("\n" + "="*20 + " [AI Chat Response (First Turn)] " + "="*20)
-            print("--- Raw Response Object ---")
-            print(response)
-            print("="*68 + "\n")
 
-            # --- [推荐的修改] ---
-            # 默认AI回复为空字符串，避免后续操作出错
-            # --- [推荐的修改] ---
-            ai_response_text = ""  # 默认值，确保是字符串
+def _turn_label(prompt: Dict[str, Any]) -> str:
+    return "first" if prompt["is_first_turn"] else "follow_up"
 
-            try:
-                # 采用您指出的、最稳健的方式来解析返回内容
-                if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-                    ai_response_text = response.candidates[0].content.parts[0].text
-                else:
-                    # 即使结构完整但内容为空，也记录一下，便于调试
-                    print("警告: Gemini API 返回了空的 candidates 或 parts。")
-            except Exception as e:
-                # 捕获所有可能的解析错误
-                print(f"解析 Gemini API 响应时出错: {e}")
-                ai_response_text = "[AI服务返回格式异常或无内容]"
-            # --- [修改结束] ---
-            # --- [修改结束] ---
-            ai_response_text = re.sub(r'```[a-zA-Z]*\s*(<img[^>]*>)\s*```', r'\1', ai_response_text, flags=re.DOTALL)
-            ai_response_html = markdown.markdown(
-                ai_response_text,
-                extensions=['tables', 'fenced_code', 'nl2br', 'pymdownx.arithmatex'],
-                extension_configs={'pymdownx.arithmatex': {'generic': True}}
-            )
-            correct_image_path_prefix = f'src="/api/documents_assets/{req.document_id}/images/'
-            ai_response_html = ai_response_html.replace('src="images/', correct_image_path_prefix)
-
-            response_payload = {
-                "role": "assistant", 
-                "text": ai_response_text, 
-                "htmlText": ai_response_html,
-                "timestamp": time.time(),
-                "first_user_message_override": prompt_for_model 
-            }
-        else:
-            print("--- [聊天逻辑] 检测到为后续提问，将使用历史记录。 ---")
-            history_for_model = [{'role': 'model' if msg.role == 'assistant' else 'user', 'parts': [{'text': msg.text}]} for msg in req.messages[:-1]]
-            
-            last_user_question = req.messages[-1].text
-            
-            # 【关键修改】为后续提问注入新的文档或元素上下文
-            new_context_prompt_part = ""
-            
-            if focused_content_md:
-                new_context_prompt_part = f"请参考我新选中的内容，并结合我们之前的完整对话来回答。\n\n[新聚焦内容]\n{focused_content_md}\n\n---"
-            else:
-                md_filename = f"{req.document_id}.md"
-                md_filepath = os.path.join(DOCS_DIR, req.document_id, md_filename)
-                if req.char_start is not None and req.char_end is not None and os.path.exists(md_filepath):
-                    print(f"--- [上下文控制] 后续提问检测到新范围: {req.char_start} -> {req.char_end} ---")
-                    with open(md_filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        sliced_content = content[req.char_start:req.char_end]
-                        new_context_prompt_part = f"请参考我新选中的文档内容（字 {req.char_start} 至 {req.char_end}）并结合我们之前的对话来回答。\n\n[新文档上下文]\n{sliced_content}\n\n---"
-
-            prompt_for_model = f"{new_context_prompt_part}\n我的问题是：{last_user_question}" if new_context_prompt_part else last_user_question
-            
-            print("\n" + "="*50)
-            print("====== V V V ====== SENDING TO GEMINI API ====== V V V ======")
-            print(">>> CONVERSATION HISTORY (for model context):")
-            print(json.dumps(history_for_model, ensure_ascii=False, indent=2))
-            print("\n>>> CURRENT USER PROMPT (with new context if any):")
-            print(prompt_for_model)
-            print("====== ^ ^ ^ ====== END OF GEMINI API INPUT ====== ^ ^ ^ ======")
-            print("="*50 + "\n")
-
-            chat_session = client.chats.create(model="gemini-2.5-flash", history=history_for_model)
-            response = chat_session.send_message(prompt_for_model)
-
-            print("\n" + "="*20 + " [AI Chat Response (Follow-up)] " + "="*20)
-            print("--- Raw Response Object ---")
-            print(response)
-            print("="*69 + "\n")
-
-            # --- [同样的修改逻辑] ---
-            ai_response_text = ""
 
+def _observe_tokens(prompt: Dict[str, Any], ai_response_text: str):
+    """按字数估算本次请求的输入（含历史）与输出 token 数。"""
+    prompt_tokens = conversation_history.estimate_tokens(prompt["prompt"])
+    for message in prompt["history"] or []:
+        prompt_tokens += sum(conversation_history.estimate_tokens(part.get('text') or '') for part in message['parts'])
+    metrics.CHAT_TOKENS.observe(prompt_tokens, direction="prompt")
+    metrics.CHAT_TOKENS.observe(conversation_history.estimate_tokens(ai_response_text), direction="response")
+
+
+@app.post("/api/chat")
+async def chat(req: ChatRequest, llm: LLMBackend = Depends(get_llm),
+               prompt_cache: Optional[PromptCache] = Depends(get_prompt_cache),
+               conversations: ConversationStore = Depends(get_conversations)):
+    _last_user_message(req)
+    conversation = await _load_conversation(conversations, req)
+    focused_content_md = await _focused_content(req)
+
+    _log_chat_request("chat", req)
+
+    turn = "unknown"
+    try:
+        prompt = await _build_chat_prompt(llm, req, conversation, focused_content_md)
+        turn = _turn_label(prompt)
+
+        answer_key, ai_response_text = await _lookup_answer(req, prompt)
+        cached = ai_response_text is not None
+        if not cached:
+            with metrics.stage('llm_queue'):
+                await llm_semaphore.acquire()
             try:
-                if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-                    ai_response_text = response.candidates[0].content.parts[0].text
-                else:
-                    print("警告: Gemini API 返回了空的 candidates 或 parts。")
-            except Exception as e:
-                print(f"解析 Gemini API 响应时出错: {e}")
-                ai_response_text = "[AI服务返回格式异常或无内容]"
-            # --- [修改结束] ---
-            ai_response_text = re.sub(r'```[a-zA-Z]*\s*(<img[^>]*>)\s*```', r'\1', ai_response_text, flags=re.DOTALL)
-            ai_response_html = markdown.markdown(
-                ai_response_text,
-                extensions=['tables', 'fenced_code', 'nl2br', 'pymdownx.arithmatex'],
-                extension_configs={'pymdownx.arithmatex': {'generic': True}}
-            )
-            correct_image_path_prefix = f'src="/api/documents_assets/{req.document_id}/images/'
-            ai_response_html = ai_response_html.replace('src="images/', correct_image_path_prefix)
+                with metrics.stage('llm'):
+                    if prompt["is_first_turn"]:
+                        ai_response_text = await _generate_first_turn(llm, prompt_cache, req, prompt)
+                    else:
+                        ai_response_text = await llm.chat(LLM_MODEL, prompt["history"], prompt["prompt"])
+            finally:
+                llm_semaphore.release()
 
-            response_payload = {
-                "role": "assistant", 
-                "text": ai_response_text, 
-                "htmlText": ai_response_html,
-                "timestamp": time.time()
-            }
+            dump(logger, "模型回复", ai_response_text)
+            _observe_tokens(prompt, ai_response_text)
+            await _store_answer(answer_key, ai_response_text)
 
-        return response_payload
+        conversation_id = await _record_turn(llm, conversations, req, conversation, prompt, ai_response_text)
+        payload = _build_response_payload(req.document_id, ai_response_text, prompt, conversation_id)
+        if cached:
+            payload["cached"] = True
+        metrics.CHAT_REQUESTS.inc(endpoint="chat", turn=turn, outcome="ok")
+        return payload
 
     except Exception as e:
-        print(f"调用 Gemini API 时出错: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("聊天请求失败", extra=fields(document_id=req.document_id))
+        metrics.CHAT_REQUESTS.inc(endpoint="chat", turn=turn, outcome="error")
         ai_response_text = f"调用AI服务时出错: {e}"
-        return {"role": "assistant", "text": ai_response_text, "timestamp": time.time()}
\ No newline at end of file
+        return {"role": "assistant", "text": ai_response_text, "timestamp": time.time()}
+
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _read_upstream(stream, queue: asyncio.Queue):
+    """在并发名额内读取模型的流式输出并放进 ``queue``。
+
+    名额只覆盖上游读取：推送给客户端在另一边进行，读得慢的客户端不会一直占着名额。
+    队列不设上限，积压的最多是一次回复的全部内容。
+    """
+    with metrics.stage('llm_queue'):
+        await llm_semaphore.acquire()
+    try:
+        start = time.perf_counter()
+        first = True
+        async for piece in stream:
+            if first:
+                metrics.CHAT_STAGE_SECONDS.observe(time.perf_counter() - start, stage='llm_first_token')
+                first = False
+            queue.put_nowait(piece)
+        metrics.CHAT_STAGE_SECONDS.observe(time.perf_counter() - start, stage='llm')
+    finally:
+        llm_semaphore.release()
+
+
+async def _chat_stream_events(req: ChatRequest, llm: LLMBackend, prompt_cache: Optional[PromptCache],
+                              conversations: ConversationStore, conversation: Optional[Dict[str, Any]],
+                              focused_content_md: str):
+    turn = "unknown"
+    try:
+        prompt = await _build_chat_prompt(llm, req, conversation, focused_content_md)
+        turn = _turn_label(prompt)
+
+        answer_key, ai_response_text = await _lookup_answer(req, prompt)
+        cached = ai_response_text is not None
+        if cached:
+            # 命中时整段回答作为一个 delta 推送
+            yield _sse_event("delta", {"text": ai_response_text})
+        else:
+            if prompt["is_first_turn"]:
+                stream = _stream_first_turn(llm, prompt_cache, req, prompt)
+            else:
+                stream = llm.chat_stream(LLM_MODEL, prompt["history"], prompt["prompt"])
+
+            pieces = []
+            queue: asyncio.Queue = asyncio.Queue()
+            upstream = asyncio.create_task(_read_upstream(stream, queue))
+            upstream.add_done_callback(lambda _: queue.put_nowait(None))
+            try:
+                while (piece := await queue.get()) is not None:
+                    pieces.append(piece)
+                    yield _sse_event("delta", {"text": piece})
+                await upstream  # 抛出上游的异常
+            finally:
+                # 客户端断开时停止读取上游（同时释放并发名额）
+                upstream.cancel()
+
+            ai_response_text = "".join(pieces)
+            dump(logger, "模型回复", ai_response_text)
+            _observe_tokens(prompt, ai_response_text)
+            await _store_answer(answer_key, ai_response_text)
+
+        conversation_id = await _record_turn(llm, conversations, req, conversation, prompt, ai_response_text)
+        payload = _build_response_payload(req.document_id, ai_response_text, prompt, conversation_id)
+        if cached:
+            payload["cached"] = True
+        yield _sse_event("done", payload)
+        metrics.CHAT_REQUESTS.inc(endpoint="chat_stream", turn=turn, outcome="ok")
+
+    except Exception as e:
+        logger.exception("流式聊天请求失败", extra=fields(document_id=req.document_id))
+        metrics.CHAT_REQUESTS.inc(endpoint="chat_stream", turn=turn, outcome="error")
+        yield _sse_event("error", {"role": "assistant", "text": f"调用AI服务时出错: {e}", "timestamp": time.time()})
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest, llm: LLMBackend = Depends(get_llm),
+                      prompt_cache: Optional[PromptCache] = Depends(get_prompt_cache),
+                      conversations: ConversationStore = Depends(get_conversations)):
+    # 先校验请求，避免在已开始推送后才报 400 / 404 / 409
+    _last_user_message(req)
+    conversation = await _load_conversation(conversations, req)
+    focused_content_md = await _focused_content(req)
+
+    _log_chat_request("chat_stream", req)
+
+    return StreamingResponse(
+        _chat_stream_events(req, llm, prompt_cache, conversations, conversation, focused_content_md),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,133 @@
+# server/promptcache.py
+"""首轮提问的提示词前缀缓存（上游模型的显式上下文缓存）。
+
+同一文档、同一段内容的首轮提问共用同一个前缀（系统提示 + 文档内容）。第一次
+提问时把前缀存到上游，得到一个缓存句柄；之后的提问只发送问题部分并引用该句柄。
+
+本地记录每个句柄的过期时间：剩余时间不足一半时顺带续期，条目数超过上限时删除
+最久未用的句柄；上游报告句柄不存在时调用 ``invalidate`` 丢弃本地记录。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from server.cache import content_key
+from server.llm import LLMBackend
+from server.log import fields, get_logger
+
+logger = get_logger('promptcache')
+
+
+class PromptCache:
+    def __init__(self, llm: LLMBackend, ttl: float = 600.0, max_entries: int = 32, min_chars: int = 8000,
+                 failure_backoff: float = 60.0):
+        self.llm = llm
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_chars = min_chars
+        self.failure_backoff = failure_backoff
+        self.hits = 0
+        self.misses = 0
+        # key -> {'name': 句柄或 None（创建失败）, 'expires_at': 过期时间}
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks = set()
+
+    @staticmethod
+    def key_for(model: str, document_id: str, char_start: Optional[int], char_end: Optional[int], prefix: str) -> str:
+        """前缀本身包含文档内容，文档改写后 key 自然随之变化。"""
+        return content_key(model, document_id, char_start, char_end, prefix)
+
+    def enabled_for(self, prefix: str) -> bool:
+        return self.llm.supports_caching and len(prefix) >= self.min_chars
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _safe_delete(self, name: str):
+        try:
+            await self.llm.delete_cache(name)
+        except Exception as e:
+            logger.warning("删除前缀缓存失败", extra=fields(name=name, error=str(e)))
+
+    async def _safe_refresh(self, key: str, name: str):
+        try:
+            await self.llm.update_cache_ttl(name, self.ttl)
+        except Exception as e:
+            logger.warning("前缀缓存续期失败", extra=fields(name=name, error=str(e)))
+            self.invalidate(key)
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e['expires_at'] <= now]:
+            self._entries.pop(key)
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            if entry['name']:
+                self._background(self._safe_delete(entry['name']))
+
+    def invalidate(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry and entry['name']:
+            self._background(self._safe_delete(entry['name']))
+
+    async def get_handle(self, key: str, model: str, prefix: str) -> Optional[str]:
+        """返回可用的缓存句柄；无法缓存时返回 None（调用方改为发送完整提示）。"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry and entry['expires_at'] > now:
+            self._entries.move_to_end(key)
+            if entry['name'] is None:
+                return None
+            self.hits += 1
+            if entry['expires_at'] - now < self.ttl / 2:
+                entry['expires_at'] = now + self.ttl * 0.9
+                self._background(self._safe_refresh(key, entry['name']))
+            return entry['name']
+
+        if key in self._inflight:
+            inflight = self._inflight[key]
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                return None
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            try:
+                name = await self.llm.create_cache(model, [prefix], self.ttl)
+                # 留出余量，避免引用一个即将在上游过期的句柄
+                self._entries[key] = {'name': name, 'expires_at': time.time() + self.ttl * 0.9}
+                logger.info("已创建前缀缓存", extra=fields(name=name, chars=len(prefix)))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("创建前缀缓存失败，暂时改为发送完整提示",
+                               extra=fields(backoff_seconds=self.failure_backoff, error=str(e)))
+                name = None
+                self._entries[key] = {'name': None, 'expires_at': time.time() + self.failure_backoff}
+            self._evict()
+            future.set_result(name)
+            return name
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': sum(1 for e in self._entries.values() if e['name']), 'hits': self.hits, 'misses': self.misses}
+
+    async def aclose(self):
+        """删除本进程创建的所有上游缓存。"""
+        names: List[str] = [e['name'] for e in self._entries.values() if e['name']]
+        self._entries.clear()
+        for name in names:
+            await self._safe_delete(name)
@@ -0,0 +1,310 @@
+# server/realtime.py
+"""文档级的实时同步：节点、笔画与对话的改动以增量事件广播给打开同一文档的所有客户端。
+
+每个文档一个频道，事件带有频道内连续递增的序号 ``seq``。客户端连接
+``/ws/documents/{doc}?since=<seq>``，断线重连时带上最后收到的序号，服务端先补发
+错过的事件；错过的事件已不在保留范围内时发送 ``reset``，客户端整体重新加载。
+
+发布 / 订阅是可替换的一层（``PubSub``）：
+
+- ``MemoryPubSub``（默认）：进程内直接分发，每个频道在内存中保留最近的事件；
+- ``SqlitePubSub``：事件写入共享的 SQLite 数据库，各进程轮询新事件，
+  用于同一台机器上的多个 uvicorn worker；
+- 其他实现（如 Redis）通过 ``NBWEB_PUBSUB=包.模块:工厂`` 接入，工厂不带参数调用。
+"""
+import asyncio
+import importlib
+import json
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import anyio
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from server.log import fields, get_logger
+from server.storage import SqliteDatabase
+
+logger = get_logger('realtime')
+
+Deliver = Callable[[str, Dict[str, Any]], None]
+
+
+class PubSub:
+    """发布 / 订阅接口。事件的序号由这一层分配，多个进程共用同一套序号。"""
+
+    async def start(self, deliver: Deliver):
+        """开始把所有频道的新事件交给 ``deliver(channel, event)``（在事件循环中调用）。"""
+        raise NotImplementedError
+
+    async def publish(self, channel: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        """分配序号并发布，返回带 ``seq`` 的事件。"""
+        raise NotImplementedError
+
+    async def since(self, channel: str, seq: Optional[int]) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+        """返回 ``(当前序号, seq 之后的事件)``；``seq`` 为 None 时不取事件，无法补齐时事件为 None。"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryPubSub(PubSub):
+    def __init__(self, retain: int = 500):
+        self.retain = retain
+        self._deliver: Optional[Deliver] = None
+        self._events: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._seq: Dict[str, int] = {}
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def publish(self, channel: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        seq = self._seq[channel] = self._seq.get(channel, 0) + 1
+        event = {**event, 'seq': seq}
+        self._events.setdefault(channel, deque(maxlen=self.retain)).append(event)
+        if self._deliver:
+            self._deliver(channel, event)
+        return event
+
+    async def since(self, channel: str, seq: Optional[int]) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+        last = self._seq.get(channel, 0)
+        if seq is None or seq == last:
+            return last, []
+        events = self._events.get(channel) or ()
+        # 客户端的序号比服务端还新（服务重启后序号从头开始）也只能整体重新加载
+        if seq > last or not events or events[0]['seq'] > seq + 1:
+            return last, None
+        return last, [e for e in events if e['seq'] > seq]
+
+
+class SqlitePubSub(SqliteDatabase, PubSub):
+    """事件表兼作各进程之间的消息通道：发布即插入一行，每个进程轮询比上次看到的更新的行。"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sync_channels (
+            channel TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sync_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sync_events_by_channel ON sync_events (channel, seq);
+    """
+
+    def __init__(self, path: str, retain: int = 500, poll_interval: float = 0.1):
+        super().__init__(path)
+        self.retain = retain
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def _append(self, channel: str, event: Dict[str, Any]) -> int:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute(
+                """INSERT INTO sync_channels (channel, last_seq) VALUES (?, 1)
+                   ON CONFLICT (channel) DO UPDATE SET last_seq = last_seq + 1 RETURNING last_seq""",
+                (channel,),
+            ).fetchone()[0]
+            conn.execute("INSERT INTO sync_events (channel, seq, data, created_at) VALUES (?, ?, ?, ?)",
+                         (channel, seq, json.dumps(event, ensure_ascii=False, separators=(',', ':')), time.time()))
+            conn.execute("DELETE FROM sync_events WHERE channel = ? AND seq <= ?", (channel, seq - self.retain))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    async def publish(self, channel: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        seq = await anyio.to_thread.run_sync(self._append, channel, event)
+        if self._wake:
+            self._wake.set()
+        return {**event, 'seq': seq}
+
+    def _read_since(self, channel: str, seq: Optional[int]) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+        conn = self._conn()
+        row = conn.execute("SELECT last_seq FROM sync_channels WHERE channel = ?", (channel,)).fetchone()
+        last = row[0] if row else 0
+        if seq is None or seq == last:
+            return last, []
+        if seq > last:
+            return last, None
+        rows = conn.execute("SELECT seq, data FROM sync_events WHERE channel = ? AND seq > ? AND seq <= ? ORDER BY seq",
+                            (channel, seq, last)).fetchall()
+        if not rows or rows[0][0] != seq + 1:
+            return last, None
+        return last, [{**json.loads(data), 'seq': s} for s, data in rows]
+
+    async def since(self, channel: str, seq: Optional[int]) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+        return await anyio.to_thread.run_sync(self._read_since, channel, seq)
+
+    def _read_new(self, after_id: int) -> List[Tuple[int, str, int, str]]:
+        return self._conn().execute(
+            "SELECT id, channel, seq, data FROM sync_events WHERE id > ? ORDER BY id LIMIT 1000", (after_id,)).fetchall()
+
+    async def start(self, deliver: Deliver):
+        self._wake = asyncio.Event()
+        last_id = await anyio.to_thread.run_sync(
+            lambda: self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM sync_events").fetchone()[0])
+        self._task = asyncio.create_task(self._poll(deliver, last_id))
+
+    async def _poll(self, deliver: Deliver, last_id: int):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                rows = await anyio.to_thread.run_sync(self._read_new, last_id)
+            except Exception as e:
+                logger.warning("读取同步事件失败", extra=fields(error=str(e)))
+                continue
+            for row_id, channel, seq, data in rows:
+                last_id = row_id
+                deliver(channel, {**json.loads(data), 'seq': seq})
+            if len(rows) == 1000:
+                self._wake.set()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        super().close()
+
+
+def create_pubsub(backend: str, db_path: str, retain: int = 500) -> PubSub:
+    if backend == 'memory':
+        return MemoryPubSub(retain)
+    if backend == 'sqlite':
+        return SqlitePubSub(db_path, retain)
+    if ':' in backend:
+        module, _, attr = backend.partition(':')
+        return getattr(importlib.import_module(module), attr)()
+    raise RuntimeError(f"Unknown NBWEB_PUBSUB: {backend}")
+
+
+class _Client:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def offer(self, event: Optional[Dict[str, Any]]):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 客户端跟不上：丢弃排队的事件，之后从发布层按序号补发
+            self.overflowed = True
+
+    def stop(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class SyncHub:
+    """本进程的 WebSocket 连接，按文档分组；从发布层收到的事件分发给订阅了该文档的连接。"""
+
+    def __init__(self, pubsub: PubSub, queue_size: int = 256, heartbeat: float = 30.0):
+        self.pubsub = pubsub
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self._clients: Dict[str, Set[_Client]] = {}
+
+    async def start(self):
+        await self.pubsub.start(self._deliver)
+
+    def _deliver(self, channel: str, event: Dict[str, Any]):
+        for client in self._clients.get(channel, ()):
+            client.offer(event)
+
+    def connection_count(self) -> int:
+        return sum(len(clients) for clients in self._clients.values())
+
+    async def publish(self, document_id: str, event_type: str, origin: Optional[str] = None, **data):
+        """广播一条改动；失败只记日志，改动本身已经保存。``origin`` 为发起改动的客户端 id。"""
+        try:
+            await self.pubsub.publish(document_id, {'type': event_type, 'origin': origin, **data})
+        except Exception as e:
+            logger.warning("广播同步事件失败", extra=fields(document_id=document_id, type=event_type, error=str(e)))
+
+    async def _catch_up(self, client: _Client, document_id: str, sent: Optional[int]) -> int:
+        last, events = await self.pubsub.since(document_id, sent)
+        if sent is None:
+            await client.websocket.send_json({'type': 'hello', 'seq': last})
+        elif events is None:
+            await client.websocket.send_json({'type': 'reset', 'seq': last})
+        else:
+            for event in events:
+                await client.websocket.send_json(event)
+        return last
+
+    async def _send_loop(self, client: _Client, document_id: str, since: Optional[int]):
+        sent = await self._catch_up(client, document_id, since)
+        while True:
+            try:
+                event = await asyncio.wait_for(client.queue.get(), self.heartbeat)
+            except asyncio.TimeoutError:
+                await client.websocket.send_json({'type': 'ping', 'seq': sent})
+                continue
+            if event is None:
+                return
+            if client.overflowed:
+                client.overflowed = False
+                while not client.queue.empty():
+                    client.queue.get_nowait()
+                sent = await self._catch_up(client, document_id, sent)
+                continue
+            # 补发与实时分发可能有重叠
+            if event['seq'] > sent:
+                await client.websocket.send_json(event)
+                sent = event['seq']
+
+    @staticmethod
+    async def _receive_loop(websocket: WebSocket):
+        # 客户端不需要发消息；这里只为及时发现断线
+        while True:
+            await websocket.receive_text()
+
+    async def serve(self, websocket: WebSocket, document_id: str, since: Optional[int] = None):
+        client = _Client(websocket, self.queue_size)
+        # 先登记再补发，补发期间到达的事件留在队列里，不会漏掉
+        self._clients.setdefault(document_id, set()).add(client)
+        tasks = [asyncio.create_task(self._send_loop(client, document_id, since)),
+                 asyncio.create_task(self._receive_loop(websocket))]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error and not isinstance(error, (WebSocketDisconnect, RuntimeError)):
+                    logger.warning("同步连接异常结束", extra=fields(document_id=document_id, error=str(error)))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            clients = self._clients.get(document_id)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del self._clients[document_id]
+            try:
+                await websocket.close()
+            except RuntimeError:
+                pass
+
+    async def close(self):
+        """结束所有连接（关闭服务时）。"""
+        for clients in list(self._clients.values()):
+            for client in clients:
+                client.stop()
+        await self.pubsub.close()
@@ -0,0 +1,300 @@
+# server/search.py
+"""跨文档的全文检索：文档正文、知识节点（对话记录与批注）和对话记录。
+
+倒排索引用 SQLite FTS5，与其他表放在同一个数据库里。FTS5 自带的分词器不切中文，
+这里先用 ``textindex.token_runs`` 切好词（英文按单词、中文按相邻两字）再以空格
+分隔写入；查询时中文串写成相邻两字的短语，等价于子串匹配，末尾的英文词按前缀匹配。
+
+文档按顶层元素切成约 ``CHUNK_CHARS`` 字的块，每块记下各元素的起点，命中后可以
+跳到具体元素（atom id）；节点与对话各占一行。保存节点、对话或导入文档时由调用方
+增量更新，服务启动时在后台与磁盘、存储对账一次（``backfill``）。
+"""
+import html
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from server import atoms, textindex
+from server.log import fields, get_logger
+from server.storage import SqliteDatabase, Store
+
+CHUNK_CHARS = 800
+SNIPPET_CHARS = 160
+# 查询词过于常见时（命中条数超过该值）只在最新的这些条目中按相关度排序，BM25 的耗时与命中条数成正比
+RANK_CANDIDATES = 10000
+KINDS = ('document', 'node', 'chat')
+
+logger = get_logger('search')
+
+
+def _node_text(node: Dict[str, Any]) -> Tuple[str, str]:
+    messages = [m.get('displayText') or m.get('text') or '' for m in node.get('conversation_log') or []]
+    title = next((t for t in messages if t), '')
+    return ' '.join(title.split())[:80], '\n\n'.join(filter(None, [node.get('user_annotations') or ''] + messages))
+
+
+def _chat_text(chat: Dict[str, Any]) -> Tuple[str, str]:
+    messages = [m.get('displayText') or m.get('text') or '' for m in chat.get('messages') or []]
+    return chat.get('name') or '', '\n\n'.join(filter(None, messages))
+
+
+def chunk_atoms(parts: List[Tuple[str, str]], chunk_chars: int = CHUNK_CHARS) -> List[Tuple[str, List[Tuple[int, str]]]]:
+    """把 ``[(编号, 文字)]`` 合并成块，返回 ``[(块文字, [(元素在块内的起点, 编号)])]``。"""
+    chunks = []
+    text, offsets = '', []
+    for atom_id, part in parts:
+        if text and len(text) + len(part) > chunk_chars:
+            chunks.append((text, offsets))
+            text, offsets = '', []
+        if text:
+            text += '\n\n'
+        offsets.append((len(text), atom_id))
+        text += part
+    if text:
+        chunks.append((text, offsets))
+    return chunks
+
+
+def parse_query(query: str) -> Tuple[str, Optional[re.Pattern]]:
+    """返回 ``(FTS5 查询表达式, 用于标出命中位置的正则)``；没有可检索的词时表达式为空串。"""
+    runs = textindex.token_runs(query)
+    terms, literals = [], []
+    for i, run in enumerate(runs):
+        if run[0][0] < '\u3400':
+            # 只有最后一个还没输完的英文词按前缀匹配
+            prefix = i == len(runs) - 1 and not query[-1:].isspace()
+            terms.append(f'"{run[0]}"' + ('*' if prefix else ''))
+            literals.append(run[0])
+        elif len(run[0]) == 1:
+            terms.append(f'"{run[0]}"*')
+            literals.append(run[0])
+        else:
+            terms.append('"' + ' '.join(run) + '"')
+            literals.append(run[0] + ''.join(t[1] for t in run[1:]))
+    if not terms:
+        return '', None
+    pattern = re.compile('|'.join(re.escape(s) for s in sorted(set(literals), key=len, reverse=True)), re.IGNORECASE)
+    return ' '.join(terms), pattern
+
+
+def make_snippet(body: str, pattern: Optional[re.Pattern], chars: int = SNIPPET_CHARS) -> Tuple[str, int]:
+    """截取第一个命中位置附近的一段（已做 HTML 转义，命中处包在 ``<mark>`` 中），同时返回命中位置。"""
+    m = pattern.search(body) if pattern else None
+    hit = m.start() if m else 0
+    start = max(0, hit - chars // 4)
+    end = min(len(body), start + chars)
+    window = ' '.join(body[start:end].split('\n'))
+    out, pos = [], 0
+    for w in (pattern.finditer(window) if pattern else ()):
+        out += [html.escape(window[pos:w.start()]), '<mark>', html.escape(w.group()), '</mark>']
+        pos = w.end()
+    out.append(html.escape(window[pos:]))
+    return ('…' if start else '') + ''.join(out) + ('…' if end < len(body) else ''), hit
+
+
+class SearchIndex(SqliteDatabase):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS search_entries (
+            entry_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            document_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            atom_id TEXT,
+            title TEXT NOT NULL DEFAULT '',
+            body TEXT NOT NULL,
+            atoms TEXT
+        );
+        CREATE INDEX IF NOT EXISTS search_entries_by_item ON search_entries (kind, document_id, item_id);
+        CREATE INDEX IF NOT EXISTS search_entries_by_document ON search_entries (document_id);
+        CREATE TABLE IF NOT EXISTS search_sources (
+            document_id TEXT PRIMARY KEY,
+            source_mtime INTEGER NOT NULL
+        );
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(tokens, tokenize = 'unicode61');
+        CREATE TRIGGER IF NOT EXISTS search_entries_delete AFTER DELETE ON search_entries BEGIN
+            DELETE FROM search_fts WHERE rowid = old.entry_id;
+        END;
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        try:
+            self._conn().executescript(self.FTS_SCHEMA)
+            self.enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite 不支持 FTS5，全文检索不可用", extra=fields(error=str(e)))
+            self.enabled = False
+        self._stop = threading.Event()
+
+    def _write(self, fn):
+        if not self.enabled:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            fn(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, kind: str, document_id: str, item_id: str, atom_id: Optional[str],
+                title: str, body: str, atom_offsets: Optional[List[Tuple[int, str]]] = None, index_title: bool = True):
+        entry_id = conn.execute(
+            "INSERT INTO search_entries (kind, document_id, item_id, atom_id, title, body, atoms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, document_id, item_id, atom_id, title, body, json.dumps(atom_offsets) if atom_offsets else None),
+        ).lastrowid
+        conn.execute("INSERT INTO search_fts (rowid, tokens) VALUES (?, ?)",
+                     (entry_id, ' '.join(textindex.tokenize(title + '\n' + body if index_title else body))))
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, kind: str, document_id: str, item_id: Optional[str] = None):
+        if item_id is None:
+            conn.execute("DELETE FROM search_entries WHERE kind = ? AND document_id = ?", (kind, document_id))
+        else:
+            conn.execute("DELETE FROM search_entries WHERE kind = ? AND document_id = ? AND item_id = ?",
+                         (kind, document_id, item_id))
+
+    def index_document(self, document_id: str, title: str, html_path: str):
+        """（重新）索引文档正文；记下 HTML 的修改时间，启动对账时据此判断是否过期。"""
+        mtime = os.stat(html_path).st_mtime_ns
+        with open(html_path, 'r', encoding='utf-8') as f:
+            chunks = chunk_atoms(atoms.outer_markdown(f.read()))
+
+        def write(conn):
+            self._delete(conn, 'document', document_id)
+            for i, (body, offsets) in enumerate(chunks):
+                # 标题只计入第一块，避免每一块都因标题命中
+                self._insert(conn, 'document', document_id, str(i), offsets[0][1], title, body, offsets, i == 0)
+            conn.execute("INSERT OR REPLACE INTO search_sources (document_id, source_mtime) VALUES (?, ?)", (document_id, mtime))
+
+        self._write(write)
+
+    def index_node(self, document_id: str, node: Dict[str, Any]):
+        title, body = _node_text(node)
+
+        def write(conn):
+            self._delete(conn, 'node', document_id, node['node_id'])
+            if title or body:
+                self._insert(conn, 'node', document_id, node['node_id'], node.get('source_element_id'), title, body)
+
+        self._write(write)
+
+    def index_chat(self, document_id: str, chat: Dict[str, Any]):
+        title, body = _chat_text(chat)
+
+        def write(conn):
+            self._delete(conn, 'chat', document_id, chat['id'])
+            if body:
+                self._insert(conn, 'chat', document_id, chat['id'], None, title, body)
+
+        self._write(write)
+
+    def remove(self, kind: str, document_id: str, item_id: str):
+        self._write(lambda conn: self._delete(conn, kind, document_id, item_id))
+
+    def remove_document(self, document_id: str):
+        """删除文档本身以及它的节点、对话的索引。"""
+        def write(conn):
+            conn.execute("DELETE FROM search_entries WHERE document_id = ?", (document_id,))
+            conn.execute("DELETE FROM search_sources WHERE document_id = ?", (document_id,))
+
+        self._write(write)
+
+    def search(self, query: str, limit: int = 20, kind: Optional[str] = None,
+               document_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按 BM25 排序返回命中，每条带摘要与跳转目标（文档、元素、节点或对话）。"""
+        expr, pattern = parse_query(query)
+        if not expr or not self.enabled:
+            return []
+        conn = self._conn()
+        where, args = ["search_fts MATCH ?"], [expr]
+        if not kind and not document_id:
+            cutoff = conn.execute(
+                "SELECT rowid FROM search_fts WHERE search_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                (expr, RANK_CANDIDATES - 1),
+            ).fetchone()
+            if cutoff:
+                where.append("search_fts.rowid >= ?")
+                args.append(cutoff[0])
+        if kind:
+            where.append("e.kind = ?")
+            args.append(kind)
+        if document_id:
+            where.append("e.document_id = ?")
+            args.append(document_id)
+        rows = conn.execute(
+            f"""SELECT e.kind, e.document_id, e.item_id, e.atom_id, e.title, e.body, e.atoms, bm25(search_fts) AS rank
+                FROM search_fts JOIN search_entries e ON e.entry_id = search_fts.rowid
+                WHERE {' AND '.join(where)} ORDER BY rank LIMIT ?""",
+            (*args, limit),
+        ).fetchall()
+        hits = []
+        for entry_kind, doc_id, item_id, atom_id, title, body, offsets, rank in rows:
+            snippet, pos = make_snippet(body, pattern)
+            if offsets:
+                atom_id = next((a for start, a in reversed(json.loads(offsets)) if start <= pos), atom_id)
+            hits.append({
+                'kind': entry_kind,
+                'document_id': doc_id,
+                'atom_id': atom_id,
+                'node_id': item_id if entry_kind == 'node' else None,
+                'chat_id': item_id if entry_kind == 'chat' else None,
+                'title': title,
+                'snippet': snippet,
+                'score': round(-rank, 4),
+            })
+        return hits
+
+    def stop(self):
+        """让正在进行的 ``backfill`` 尽快返回（关闭服务时）。"""
+        self._stop.set()
+
+    def backfill(self, docs_dir: str, documents: Iterable[Dict[str, Any]], store: Store) -> Dict[str, int]:
+        """与磁盘和存储对账：索引新的或改过的文档、缺失的节点与对话，删掉已不存在的条目。"""
+        counts = {'documents': 0, 'nodes': 0, 'chats': 0, 'removed': 0}
+        if not self.enabled:
+            return counts
+        conn = self._conn()
+        known = dict(conn.execute("SELECT document_id, source_mtime FROM search_sources"))
+        seen_docs = set()
+        for doc in documents:
+            if self._stop.is_set():
+                return counts
+            document_id = doc['document_id']
+            seen_docs.add(document_id)
+            html_path = os.path.join(docs_dir, document_id, f"{document_id}.html")
+            try:
+                if known.get(document_id) != os.stat(html_path).st_mtime_ns:
+                    self.index_document(document_id, doc.get('title') or document_id, html_path)
+                    counts['documents'] += 1
+            except Exception as e:
+                logger.warning("全文检索：无法索引文档", extra=fields(document_id=document_id, error=str(e)))
+        for document_id in set(known) - seen_docs:
+            self.remove_document(document_id)
+            counts['removed'] += 1
+
+        for store_kind, kind, index in (('nodes', 'node', self.index_node), ('chats', 'chat', self.index_chat)):
+            indexed = set(conn.execute("SELECT document_id, item_id FROM search_entries WHERE kind = ?", (kind,)))
+            present = set()
+            for document_id, item in store.iter_items(store_kind):
+                if self._stop.is_set():
+                    return counts
+                key = (document_id, item.get('node_id' if kind == 'node' else 'id'))
+                present.add(key)
+                if key not in indexed:
+                    try:
+                        index(document_id, item)
+                        counts[store_kind] += 1
+                    except Exception as e:
+                        logger.warning("全文检索：无法索引记录", extra=fields(kind=kind, document_id=document_id, error=str(e)))
+            for document_id, item_id in indexed - present:
+                self.remove(kind, document_id, item_id)
+                counts['removed'] += 1
+        return counts
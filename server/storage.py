@@ -0,0 +1,603 @@
+# server/storage.py
+"""知识节点、对话记录与绘图笔画的存储引擎。
+
+``SqliteStore``（默认）把每条记录存为一行，按 ``(kind, document_id, item_id)``
+建主键，单条写入 / 删除与文档里已有的数据量无关；数据库运行在 WAL 模式下，
+读写互不阻塞。``JsonStore`` 保留原先每个文档一个 JSON 文件的格式。
+
+JSON 文件一律先写临时文件再 ``os.replace``，读者永远看不到写了一半的文件；
+同一个文件的写入互相串行，不同文件之间互不影响（见 ``JsonStore`` 与
+``JsonFileWriter``）。
+
+旧的 data/nodes/*.json、data/chats/*.json、data/drawings/*.json 可以通过 ``migrate_json_files`` 导入
+SQLite（服务启动时会自动执行），也可以手动运行::
+
+    python -m server.storage migrate
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import anyio
+
+from server import strokes
+from server.log import fields, get_logger, setup_logging
+
+logger = get_logger('storage')
+
+# 记录类型 -> 记录中作为主键的字段
+KINDS = {'nodes': 'node_id', 'chats': 'id', 'drawings': 'id'}
+# 读取旧文件时的格式转换（旧的绘图文件没有笔画 id 与 bbox，点是 {x, y} 列表）
+UPGRADES: Dict[str, Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]] = {'drawings': strokes.normalize_all}
+# SQLite 中仍需转换的旧记录
+UPGRADE_WHERE = {'drawings': "json_type(data, '$.bbox') IS NULL OR json_type(data, '$.points') != 'text'"}
+
+
+def item_bounds(item: Dict[str, Any]) -> Optional[Tuple[float, float, float, float]]:
+    """记录在画布上的范围 ``(min_x, min_y, max_x, max_y)``：笔画取 ``bbox``，节点取 ``canvas_position`` 这一点。"""
+    try:
+        if 'bbox' in item:
+            x0, y0, x1, y1 = (float(v) for v in item['bbox'])
+            return x0, y0, x1, y1
+        pos = item['canvas_position']
+        x, y = float(pos['x']), float(pos['y'])
+        return x, y, x, y
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _in_view(bounds: Optional[Tuple[float, float, float, float]], bbox: Tuple[float, float, float, float], min_size: float) -> bool:
+    if bounds is None:
+        return False
+    x0, y0, x1, y1 = bounds
+    if x1 < bbox[0] or x0 > bbox[2] or y1 < bbox[1] or y0 > bbox[3]:
+        return False
+    return not min_size or max(x1 - x0, y1 - y0) >= min_size
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def _leaf_fields(fields: Dict[str, Any], prefix: Tuple[str, ...] = ()) -> List[Tuple[Tuple[str, ...], Any]]:
+    """把嵌套的部分字段展开为 ``(路径, 值)``，例如 ``{'a': {'x': 1}}`` -> ``[(('a', 'x'), 1)]``。
+
+    空的嵌套对象没有要修改的字段，直接跳过（不会把原有对象覆盖为 ``{}``）。
+    """
+    leaves = []
+    for key, value in fields.items():
+        if isinstance(value, dict):
+            leaves.extend(_leaf_fields(value, prefix + (key,)))
+        else:
+            leaves.append((prefix + (key,), value))
+    return leaves
+
+
+def apply_patch(item: Dict[str, Any], fields: Dict[str, Any]) -> Dict[str, Any]:
+    """只覆盖 ``fields`` 中给出的（嵌套）字段，其余字段保持不变。"""
+    for path, value in _leaf_fields(fields):
+        target = item
+        for key in path[:-1]:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        target[path[-1]] = value
+    return item
+
+
+def atomic_write_json(path: str, data: Any):
+    """以紧凑格式写入同目录下的临时文件并 fsync，再原子地替换 ``path``。"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonFileWriter:
+    """整文件覆盖写入的 JSON 文件（如绘图笔记），每个路径一把锁。
+
+    ``batch_window`` 大于 0 时，同一路径在窗口内到达的多次写入合并为一次，
+    只落盘最后一份数据；所有调用方都会等到包含自己数据的那次写入完成才返回。
+    """
+
+    def __init__(self, batch_window: float = 0.0):
+        self.batch_window = batch_window
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._tasks = set()
+
+    def _lock(self, path: str) -> asyncio.Lock:
+        lock = self._locks.get(path)
+        if lock is None:
+            lock = self._locks[path] = asyncio.Lock()
+        return lock
+
+    async def write(self, path: str, data: Any):
+        if self.batch_window <= 0:
+            async with self._lock(path):
+                await anyio.to_thread.run_sync(atomic_write_json, path, data)
+            return
+        pending = self._pending.get(path)
+        if pending is None:
+            pending = self._pending[path] = {'data': data, 'future': asyncio.get_running_loop().create_future()}
+            task = asyncio.create_task(self._flush_later(path))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            pending['data'] = data
+        await asyncio.shield(pending['future'])
+
+    async def _flush_later(self, path: str):
+        await asyncio.sleep(self.batch_window)
+        await self._flush(path)
+
+    async def _flush(self, path: str):
+        async with self._lock(path):
+            # 先摘下本批数据，写入期间到达的新数据进入下一批
+            pending = self._pending.pop(path, None)
+            if pending is None:
+                return
+            try:
+                await anyio.to_thread.run_sync(atomic_write_json, path, pending['data'])
+            except Exception as e:
+                pending['future'].set_exception(e)
+                pending['future'].exception()
+            else:
+                pending['future'].set_result(None)
+
+    async def flush(self):
+        """立即写出所有尚在等待窗口中的数据（用于关闭服务前）。"""
+        for path in list(self._pending):
+            await self._flush(path)
+
+
+class Store:
+    """存储接口；``list_json`` 直接返回 JSON 数组文本，避免多余的解析与序列化。"""
+
+    def list_json(self, kind: str, document_id: str) -> str:
+        raise NotImplementedError
+
+    def list_items(self, kind: str, document_id: str) -> List[Dict[str, Any]]:
+        return json.loads(self.list_json(kind, document_id))
+
+    def query_json(self, kind: str, document_id: str, bbox: Tuple[float, float, float, float], min_size: float = 0) -> str:
+        """与 ``bbox = (min_x, min_y, max_x, max_y)`` 相交的记录（JSON 数组文本，保持原有顺序）；
+        ``min_size`` 大于 0 时略去长宽都小于它的记录。默认实现逐条过滤。"""
+        return _dumps([it for it in self.list_items(kind, document_id) if _in_view(item_bounds(it), bbox, min_size)])
+
+    def get_item(self, kind: str, document_id: str, item_id: str) -> Optional[Dict[str, Any]]:
+        key = KINDS[kind]
+        return next((it for it in self.list_items(kind, document_id) if it.get(key) == item_id), None)
+
+    def iter_items(self, kind: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """遍历所有文档中某类记录，产生 ``(document_id, 记录)``。"""
+        raise NotImplementedError
+
+    def upsert(self, kind: str, document_id: str, item: Dict[str, Any]):
+        raise NotImplementedError
+
+    def delete(self, kind: str, document_id: str, item_id: str):
+        raise NotImplementedError
+
+    def patch_many(self, kind: str, document_id: str, patches: Dict[str, Dict[str, Any]]) -> List[str]:
+        """对多条记录做部分字段更新，``patches`` 为 ``{item_id: fields}``；返回实际更新到的 id。"""
+        raise NotImplementedError
+
+    def patch(self, kind: str, document_id: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        return bool(self.patch_many(kind, document_id, {item_id: fields}))
+
+    def delete_document(self, document_id: str):
+        """删除某个文档的全部节点、对话与绘图。"""
+        raise NotImplementedError
+
+    def replace_document(self, kind: str, document_id: str, items: List[Dict[str, Any]]):
+        """用 ``items`` 整体替换某个文档的记录。"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteDatabase:
+    """按线程复用连接的 SQLite 数据库（WAL 模式）。子类在 ``SCHEMA`` 中建表。"""
+
+    SCHEMA = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._all_conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # 每个线程一个连接；WAL 模式下多个读连接与一个写连接可以并发
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._all_conns.append(conn)
+        return conn
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._all_conns:
+                conn.close()
+            self._all_conns.clear()
+        self._local = threading.local()
+
+
+class SqliteStore(SqliteDatabase, Store):
+    SCHEMA = """
+            CREATE TABLE IF NOT EXISTS records (
+                kind TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (kind, document_id, item_id)
+            );
+            CREATE INDEX IF NOT EXISTS records_by_seq ON records (kind, document_id, seq);
+    """
+    # 空间索引：R*Tree 的第三维是 (kind, document_id) 对应的整数 space_id，查询只落在一个文档内。
+    # 范围取自记录 JSON（笔画的 bbox、节点的 canvas_position），由触发器随增删改同步。
+    SPATIAL_SCHEMA = """
+            CREATE TABLE IF NOT EXISTS record_spaces (
+                space_id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                UNIQUE (kind, document_id)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS record_bounds USING rtree(id, min_x, max_x, min_y, max_y, min_space, max_space);
+            CREATE VIEW IF NOT EXISTS record_extent AS
+                SELECT r.rowid AS id,
+                       COALESCE(json_extract(r.data, '$.bbox[0]'), json_extract(r.data, '$.canvas_position.x')) AS min_x,
+                       COALESCE(json_extract(r.data, '$.bbox[2]'), json_extract(r.data, '$.canvas_position.x')) AS max_x,
+                       COALESCE(json_extract(r.data, '$.bbox[1]'), json_extract(r.data, '$.canvas_position.y')) AS min_y,
+                       COALESCE(json_extract(r.data, '$.bbox[3]'), json_extract(r.data, '$.canvas_position.y')) AS max_y,
+                       s.space_id
+                FROM records r JOIN record_spaces s ON s.kind = r.kind AND s.document_id = r.document_id;
+            CREATE TRIGGER IF NOT EXISTS records_bounds_insert AFTER INSERT ON records BEGIN
+                INSERT OR IGNORE INTO record_spaces (kind, document_id) VALUES (new.kind, new.document_id);
+                INSERT INTO record_bounds
+                    SELECT id, min_x, max_x, min_y, max_y, space_id, space_id FROM record_extent
+                    WHERE id = new.rowid AND min_x IS NOT NULL AND min_y IS NOT NULL;
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_bounds_update AFTER UPDATE OF data ON records BEGIN
+                DELETE FROM record_bounds WHERE id = old.rowid;
+                INSERT INTO record_bounds
+                    SELECT id, min_x, max_x, min_y, max_y, space_id, space_id FROM record_extent
+                    WHERE id = new.rowid AND min_x IS NOT NULL AND min_y IS NOT NULL;
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_bounds_delete AFTER DELETE ON records BEGIN
+                DELETE FROM record_bounds WHERE id = old.rowid;
+            END;
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        conn = self._conn()
+        try:
+            conn.executescript(self.SPATIAL_SCHEMA)
+            self.spatial = True
+        except sqlite3.OperationalError as e:
+            # SQLite 未编译 R*Tree 时按视口查询退回到逐条过滤
+            logger.warning("SQLite 不支持 R*Tree，按视口查询将逐条过滤", extra=fields(error=str(e)))
+            self.spatial = False
+            return
+        if conn.execute("SELECT 1 FROM record_bounds LIMIT 1").fetchone() is None:
+            # 建索引之前已有的记录
+            conn.executescript("""
+                BEGIN;
+                INSERT OR IGNORE INTO record_spaces (kind, document_id) SELECT DISTINCT kind, document_id FROM records;
+                INSERT INTO record_bounds
+                    SELECT id, min_x, max_x, min_y, max_y, space_id, space_id FROM record_extent
+                    WHERE min_x IS NOT NULL AND min_y IS NOT NULL;
+                COMMIT;
+            """)
+
+    def upgrade_records(self) -> int:
+        """按 ``UPGRADES`` 转换库中的旧格式记录，返回转换的条数。"""
+        conn = self._conn()
+        upgraded = 0
+        for kind, where in UPGRADE_WHERE.items():
+            rows = conn.execute(f"SELECT document_id, item_id, data FROM records WHERE kind = ? AND ({where})", (kind,)).fetchall()
+            for document_id, item_id, data in rows:
+                items = UPGRADES[kind]([json.loads(data)])
+                if items:
+                    conn.execute("UPDATE records SET data = ? WHERE kind = ? AND document_id = ? AND item_id = ?",
+                                 (_dumps(items[0]), kind, document_id, item_id))
+                else:
+                    conn.execute("DELETE FROM records WHERE kind = ? AND document_id = ? AND item_id = ?",
+                                 (kind, document_id, item_id))
+                upgraded += 1
+        if upgraded:
+            logger.info("已转换旧格式记录", extra=fields(records=upgraded))
+        return upgraded
+
+    def query_json(self, kind: str, document_id: str, bbox: Tuple[float, float, float, float], min_size: float = 0) -> str:
+        if not self.spatial:
+            return super().query_json(kind, document_id, bbox, min_size)
+        conn = self._conn()
+        space = conn.execute("SELECT space_id FROM record_spaces WHERE kind = ? AND document_id = ?", (kind, document_id)).fetchone()
+        if space is None:
+            return '[]'
+        rows = conn.execute(
+            """SELECT r.data FROM record_bounds b JOIN records r ON r.rowid = b.id
+               WHERE b.min_space = ? AND b.max_space = ? AND b.max_x >= ? AND b.min_x <= ? AND b.max_y >= ? AND b.min_y <= ?
+                 AND (? <= 0 OR b.max_x - b.min_x >= ? OR b.max_y - b.min_y >= ?)
+               ORDER BY r.seq""",
+            (space[0], space[0], bbox[0], bbox[2], bbox[1], bbox[3], min_size, min_size, min_size),
+        ).fetchall()
+        return '[' + ','.join(r[0] for r in rows) + ']'
+
+    def list_json(self, kind: str, document_id: str) -> str:
+        rows = self._conn().execute(
+            "SELECT data FROM records WHERE kind = ? AND document_id = ? ORDER BY seq",
+            (kind, document_id),
+        ).fetchall()
+        return '[' + ','.join(r[0] for r in rows) + ']'
+
+    def get_item(self, kind: str, document_id: str, item_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT data FROM records WHERE kind = ? AND document_id = ? AND item_id = ?",
+            (kind, document_id, item_id),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_items(self, kind: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for document_id, data in self._conn().execute(
+                "SELECT document_id, data FROM records WHERE kind = ? ORDER BY document_id, seq", (kind,)):
+            yield document_id, json.loads(data)
+
+    def upsert(self, kind: str, document_id: str, item: Dict[str, Any]):
+        item_id = item[KINDS[kind]]
+        self._conn().execute(
+            """INSERT INTO records (kind, document_id, item_id, seq, data, updated_at)
+               VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM records WHERE kind = ? AND document_id = ?), ?, ?)
+               ON CONFLICT (kind, document_id, item_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+            (kind, document_id, item_id, kind, document_id, _dumps(item), time.time()),
+        )
+
+    def delete(self, kind: str, document_id: str, item_id: str):
+        self._conn().execute(
+            "DELETE FROM records WHERE kind = ? AND document_id = ? AND item_id = ?",
+            (kind, document_id, item_id),
+        )
+
+    def patch_many(self, kind: str, document_id: str, patches: Dict[str, Dict[str, Any]]) -> List[str]:
+        # json_set 只改动给出的字段，不需要把整条记录读回 Python 再序列化
+        conn = self._conn()
+        now = time.time()
+        updated = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for item_id, fields in patches.items():
+                leaves = _leaf_fields(fields)
+                if not leaves:
+                    continue
+                args: List[Any] = []
+                for path, value in leaves:
+                    args += ['$.' + '.'.join(path), _dumps(value)]
+                setters = ', '.join(['?, json(?)'] * len(leaves))
+                cur = conn.execute(
+                    f"UPDATE records SET data = json_set(data, {setters}), updated_at = ? "
+                    "WHERE kind = ? AND document_id = ? AND item_id = ?",
+                    (*args, now, kind, document_id, item_id),
+                )
+                if cur.rowcount:
+                    updated.append(item_id)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return updated
+
+    def delete_document(self, document_id: str):
+        self._conn().execute("DELETE FROM records WHERE document_id = ?", (document_id,))
+
+    def replace_document(self, kind: str, document_id: str, items: List[Dict[str, Any]]):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM records WHERE kind = ? AND document_id = ?", (kind, document_id))
+            seen = set()
+            for seq, item in enumerate(items, start=1):
+                item_id = item.get(KINDS[kind])
+                if item_id is None or item_id in seen:
+                    continue
+                seen.add(item_id)
+                conn.execute(
+                    "INSERT INTO records (kind, document_id, item_id, seq, data, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, document_id, item_id, seq, _dumps(item), now),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class JsonStore(Store):
+    """每个文档一个 JSON 文件：data/<kind>/<document_id>.json。
+
+    同一文档的修改在线程锁下串行执行（组提交）：等锁期间排队的修改由拿到锁的
+    线程一次读入、依次应用、原子写出，高并发时写盘次数远少于请求数。
+    """
+
+    def __init__(self, dirs: Dict[str, str]):
+        self.dirs = dirs
+        self._meta_lock = threading.Lock()
+        self._doc_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._queues: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+
+    def _path(self, kind: str, document_id: str) -> str:
+        return os.path.join(self.dirs[kind], f"{document_id}.json")
+
+    def _read(self, kind: str, document_id: str) -> List[Dict[str, Any]]:
+        path = self._path(kind, document_id)
+        if not os.path.exists(path): return []
+        with open(path, 'r', encoding='utf-8') as f:
+            try: items = json.load(f)
+            except Exception: return []
+        upgrade = UPGRADES.get(kind)
+        return upgrade(items) if upgrade else items
+
+    def list_json(self, kind: str, document_id: str) -> str:
+        return _dumps(self._read(kind, document_id))
+
+    def iter_items(self, kind: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        directory = self.dirs[kind]
+        if not os.path.isdir(directory):
+            return
+        for fname in sorted(os.listdir(directory)):
+            if fname.endswith('.json'):
+                document_id = fname[:-len('.json')]
+                for item in self._read(kind, document_id):
+                    yield document_id, item
+
+    def _modify(self, kind: str, document_id: str, op: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]):
+        key = (kind, document_id)
+        entry = {'op': op, 'done': threading.Event(), 'error': None}
+        with self._meta_lock:
+            self._queues.setdefault(key, []).append(entry)
+            lock = self._doc_locks.setdefault(key, threading.Lock())
+        with lock:
+            if not entry['done'].is_set():
+                with self._meta_lock:
+                    batch = self._queues.pop(key, [])
+                try:
+                    items = self._read(kind, document_id)
+                    for queued in batch:
+                        items = queued['op'](items)
+                    atomic_write_json(self._path(kind, document_id), items)
+                except Exception as e:
+                    for queued in batch:
+                        queued['error'] = e
+                for queued in batch:
+                    queued['done'].set()
+        if entry['error'] is not None:
+            raise entry['error']
+
+    def upsert(self, kind: str, document_id: str, item: Dict[str, Any]):
+        key = KINDS[kind]
+
+        def op(items):
+            for i, existing in enumerate(items):
+                if existing.get(key) == item[key]:
+                    items[i] = item
+                    break
+            else:
+                items.append(item)
+            return items
+
+        self._modify(kind, document_id, op)
+
+    def delete(self, kind: str, document_id: str, item_id: str):
+        key = KINDS[kind]
+        self._modify(kind, document_id, lambda items: [it for it in items if it.get(key) != item_id])
+
+    def patch_many(self, kind: str, document_id: str, patches: Dict[str, Dict[str, Any]]) -> List[str]:
+        key = KINDS[kind]
+        updated: List[str] = []
+
+        def op(items):
+            for item in items:
+                fields = patches.get(item.get(key))
+                if fields is not None:
+                    apply_patch(item, fields)
+                    updated.append(item[key])
+            return items
+
+        self._modify(kind, document_id, op)
+        return updated
+
+    def replace_document(self, kind: str, document_id: str, items: List[Dict[str, Any]]):
+        self._modify(kind, document_id, lambda _: list(items))
+
+    def delete_document(self, document_id: str):
+        for kind in self.dirs:
+            with self._meta_lock:
+                lock = self._doc_locks.setdefault((kind, document_id), threading.Lock())
+            with lock:
+                try:
+                    os.remove(self._path(kind, document_id))
+                except FileNotFoundError:
+                    pass
+
+
+def migrate_json_files(store: SqliteStore, dirs: Dict[str, str]) -> int:
+    """把 ``dirs`` 中尚未导入的 ``<document_id>.json`` 导入 SQLite。
+
+    导入成功的文件重命名为 ``<document_id>.json.migrated`` 作为备份，
+    因此重复执行是安全的。返回导入的文件数。
+    """
+    migrated = 0
+    for kind, directory in dirs.items():
+        if not os.path.isdir(directory):
+            continue
+        for fname in sorted(os.listdir(directory)):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(directory, fname)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    items = json.load(f)
+            except Exception as e:
+                logger.warning("存储迁移：跳过无法解析的文件", extra=fields(path=path, error=str(e)))
+                continue
+            if not isinstance(items, list):
+                logger.warning("存储迁移：跳过格式不符的文件", extra=fields(path=path))
+                continue
+            if kind in UPGRADES:
+                items = UPGRADES[kind](items)
+            store.replace_document(kind, fname[:-len('.json')], items)
+            os.replace(path, path + '.migrated')
+            migrated += 1
+            logger.info("存储迁移：已导入", extra=fields(path=path, items=len(items)))
+    return migrated
+
+
+def create_store(backend: str, db_path: str, dirs: Dict[str, str]) -> Store:
+    if backend == 'sqlite':
+        store = SqliteStore(db_path)
+        migrate_json_files(store, dirs)
+        store.upgrade_records()
+        return store
+    if backend == 'json':
+        return JsonStore(dirs)
+    raise RuntimeError(f"Unknown NBWEB_STORAGE: {backend}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print("usage: python -m server.storage migrate")
+        sys.exit(2)
+    setup_logging()
+    root = os.environ.get("NBWEB_DATA_DIR") or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+    os.makedirs(root, exist_ok=True)
+    count = migrate_json_files(
+        SqliteStore(os.path.join(root, 'nbweb.sqlite3')),
+        {'nodes': os.path.join(root, 'nodes'), 'chats': os.path.join(root, 'chats'), 'drawings': os.path.join(root, 'drawings')},
+    )
+    print(f"migrated {count} file(s)")
@@ -0,0 +1,139 @@
+# server/strokes.py
+"""绘图笔画的紧凑编码。
+
+每条笔画是 ``{"id", "tool", "color", "width", "points"}``，其中 ``points`` 是字符串：
+坐标按 ``1 / SCALE`` 像素取整，第一个点存绝对值、之后存与前一点的差值，x、y 交替，
+每个整数做 zigzag 后按 LEB128 变长编码，最后整体 base64。相邻点的差值通常只占
+1～2 字节，比 ``{"x": 123.456, "y": 78.9}`` 形式的 JSON 小一个数量级。
+
+服务端为每条笔画算出 ``bbox = [min_x, min_y, max_x, max_y]``（已计入线宽），
+用于按视口查询（见 ``storage.SqliteStore`` 的空间索引）。
+
+前端 ``web/main.js`` 中的 ``encodePoints`` / ``decodePoints`` 与这里的实现一致。
+旧格式（``points`` 为 ``{x, y}`` 或 ``[x, y]`` 列表、没有 ``id``）由 ``normalize`` 转换。
+"""
+import base64
+import math
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+SCALE = 10
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def encode_points(points: Iterable[Tuple[float, float]]) -> str:
+    out = bytearray()
+    px = py = 0
+    for x, y in points:
+        qx, qy = round(x * SCALE), round(y * SCALE)
+        for value in (_zigzag(qx - px), _zigzag(qy - py)):
+            while value >= 0x80:
+                out.append((value & 0x7f) | 0x80)
+                value >>= 7
+            out.append(value)
+        px, py = qx, qy
+    return base64.b64encode(bytes(out)).decode('ascii')
+
+
+def decode_points(encoded: str) -> List[Tuple[float, float]]:
+    data = base64.b64decode(encoded, validate=True)
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(_unzigzag(value))
+        value, shift = 0, 0
+    if shift or len(values) % 2:
+        raise ValueError("truncated point data")
+    points, x, y = [], 0, 0
+    for i in range(0, len(values), 2):
+        x += values[i]
+        y += values[i + 1]
+        points.append((x / SCALE, y / SCALE))
+    return points
+
+
+def simplify(points: List[Tuple[float, float]], tolerance: float) -> List[Tuple[float, float]]:
+    """Ramer–Douglas–Peucker：去掉与相邻保留点连线的距离不超过 ``tolerance`` 的点。"""
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        a, b = stack.pop()
+        (ax, ay), (bx, by) = points[a], points[b]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        best, index = 0.0, -1
+        for i in range(a + 1, b):
+            px, py = points[i]
+            dist = math.hypot(px - ax, py - ay) if length == 0 else abs(dy * (px - ax) - dx * (py - ay)) / length
+            if dist > best:
+                best, index = dist, i
+        if best > tolerance:
+            keep[index] = True
+            stack += [(a, index), (index, b)]
+    return [p for p, k in zip(points, keep) if k]
+
+
+def bounds(points: List[Tuple[float, float]], width: float = 0) -> List[float]:
+    pad = max(float(width or 0), 0.0) / 2
+    xs, ys = [p[0] for p in points], [p[1] for p in points]
+    return [round(min(xs) - pad, 1), round(min(ys) - pad, 1), round(max(xs) + pad, 1), round(max(ys) + pad, 1)]
+
+
+def _legacy_point(p: Any) -> Tuple[float, float]:
+    if isinstance(p, dict):
+        return float(p['x']), float(p['y'])
+    return float(p[0]), float(p[1])
+
+
+def normalize(stroke: Dict[str, Any], default_id: Optional[str] = None) -> Dict[str, Any]:
+    """补上缺失的 ``id``，把旧格式的点列表编码为紧凑字符串并重新计算 ``bbox``；点数据无效时抛出 ValueError。"""
+    points = stroke.get('points')
+    if isinstance(points, str):
+        decoded = decode_points(points)
+    elif isinstance(points, Sequence):
+        try:
+            decoded = [_legacy_point(p) for p in points]
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"invalid point: {e}") from None
+        stroke = {**stroke, 'points': encode_points(decoded)}
+    else:
+        raise ValueError("stroke has no points")
+    if not decoded:
+        raise ValueError("stroke has no points")
+    try:
+        stroke = {**stroke, 'bbox': bounds(decoded, stroke.get('width') or 0)}
+    except (TypeError, ValueError):
+        raise ValueError("invalid stroke width") from None
+    if not stroke.get('id'):
+        stroke = {**stroke, 'id': default_id or uuid.uuid4().hex}
+    return stroke
+
+
+def normalize_all(strokes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """用于读取与迁移旧文件：跳过无法转换的笔画；已是新格式的笔画原样保留（不逐条校验）。
+
+    旧笔画的 id 取它在文件中的位置，文件改写之前每次读取得到的 id 都相同。
+    """
+    out = []
+    for i, stroke in enumerate(strokes):
+        if isinstance(stroke, dict) and stroke.get('id') and isinstance(stroke.get('points'), str) and 'bbox' in stroke:
+            out.append(stroke)
+            continue
+        try:
+            out.append(normalize(stroke, f"legacy-{i}"))
+        except (ValueError, AttributeError):
+            continue
+    return out
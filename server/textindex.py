@@ -0,0 +1,202 @@
+# server/textindex.py
+"""文档分块与 BM25 检索，用于只把与问题相关的片段发给模型。
+
+Markdown 按空行切成约 ``CHUNK_CHARS`` 字的块；英文按单词、中文按相邻两字
+（bigram）切词，不依赖分词库。索引在导入文档时写入
+``data/documents/<doc>/chunks.json``，旧文档在第一次检索时补建。
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from server.log import fields, get_logger
+
+INDEX_VERSION = 1
+INDEX_FILENAME = 'chunks.json'
+CHUNK_CHARS = 1200
+
+_TOKEN_RE = re.compile('[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_PARAGRAPH_BREAK_RE = re.compile(r'\n[ \t]*\n')
+
+logger = get_logger('textindex')
+
+
+def token_runs(text: str) -> List[List[str]]:
+    """按连续的单词 / 汉字串分组切词：英文单词自成一组，汉字串切成相邻两字的序列。"""
+    runs = []
+    for m in _TOKEN_RE.finditer(text.lower()):
+        run = m.group()
+        if run[0] < '\u3400' or len(run) == 1:
+            runs.append([run])
+        else:
+            runs.append([run[i:i + 2] for i in range(len(run) - 1)])
+    return runs
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for run in token_runs(text) for token in run]
+
+
+def chunk_markdown(md: str, chunk_chars: int = CHUNK_CHARS) -> List[Tuple[int, int]]:
+    """按段落边界切块，返回每块在原文中的 ``(start, end)``；超长段落按长度硬切。"""
+    paragraphs = []
+    pos = 0
+    for m in _PARAGRAPH_BREAK_RE.finditer(md):
+        paragraphs.append((pos, m.end()))
+        pos = m.end()
+    if pos < len(md):
+        paragraphs.append((pos, len(md)))
+
+    chunks: List[Tuple[int, int]] = []
+    start = end = None
+    for p_start, p_end in paragraphs:
+        while p_end - p_start > chunk_chars:
+            if start is not None:
+                chunks.append((start, end))
+                start = None
+            chunks.append((p_start, p_start + chunk_chars))
+            p_start += chunk_chars
+        if start is None:
+            start, end = p_start, p_end
+        elif p_end - start > chunk_chars:
+            chunks.append((start, end))
+            start, end = p_start, p_end
+        else:
+            end = p_end
+    if start is not None and end > start:
+        chunks.append((start, end))
+    return chunks
+
+
+class ChunkIndex:
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, chunks: List[Tuple[int, int]], lengths: List[int], postings: Dict[str, List[List[int]]],
+                 md_length: int):
+        self.chunks = chunks
+        self.lengths = lengths
+        self.postings = postings
+        self.md_length = md_length
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, md: str, chunk_chars: int = CHUNK_CHARS) -> "ChunkIndex":
+        chunks = chunk_markdown(md, chunk_chars)
+        lengths = []
+        postings: Dict[str, List[List[int]]] = {}
+        for i, (start, end) in enumerate(chunks):
+            counts = Counter(tokenize(md[start:end]))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append([i, tf])
+        return cls(chunks, lengths, postings, len(md))
+
+    def to_dict(self) -> Dict:
+        return {'version': INDEX_VERSION, 'md_length': self.md_length, 'chunks': self.chunks,
+                'lengths': self.lengths, 'postings': self.postings}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ChunkIndex":
+        return cls([tuple(c) for c in data['chunks']], data['lengths'], data['postings'], data['md_length'])
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """返回得分最高的 ``k`` 个块 ``(块序号, 得分)``。"""
+        n = len(self.chunks)
+        if not n or k <= 0:
+            return []
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for i, tf in posting:
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[i] / (self.avg_length or 1))
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:k]
+
+
+def index_path(md_path: str) -> str:
+    return os.path.join(os.path.dirname(md_path), INDEX_FILENAME)
+
+
+def build_and_save(md_path: str, md: Optional[str] = None) -> ChunkIndex:
+    if md is None:
+        with open(md_path, 'r', encoding='utf-8') as f:
+            md = f.read()
+    index = ChunkIndex.build(md)
+    tmp_path = index_path(md_path) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, index_path(md_path))
+    return index
+
+
+_loaded: "OrderedDict[str, Tuple[float, ChunkIndex]]" = OrderedDict()
+_loaded_lock = threading.Lock()
+_LOADED_MAX = 16
+
+
+def load_index(md_path: str, md: str) -> ChunkIndex:
+    """读取（必要时重建）``md_path`` 对应的索引；最近用过的索引保留在内存中。
+
+    ``md`` 也可以是 ``doccache.MappedText``，只要支持 ``len()`` 和切片。
+    """
+    path = index_path(md_path)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    with _loaded_lock:
+        cached = _loaded.get(md_path)
+        if cached and cached[0] == mtime and cached[1].md_length == len(md):
+            _loaded.move_to_end(md_path)
+            return cached[1]
+
+    index = None
+    if mtime is not None:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION and data.get('md_length') == len(md):
+                index = ChunkIndex.from_dict(data)
+        except Exception as e:
+            logger.warning("无法读取检索索引，将重建", extra=fields(path=path, error=str(e)))
+    if index is None:
+        index = build_and_save(md_path, md if isinstance(md, str) else None)
+        mtime = os.stat(path).st_mtime
+
+    with _loaded_lock:
+        _loaded[md_path] = (mtime, index)
+        _loaded.move_to_end(md_path)
+        while len(_loaded) > _LOADED_MAX:
+            _loaded.popitem(last=False)
+    return index
+
+
+def select_context(md: str, index: ChunkIndex, question: str, focused: str = "", top_k: int = 6) -> str:
+    """挑出与问题最相关的 ``top_k`` 块，外加聚焦内容所在的块及其前后相邻块，按原文顺序拼接。"""
+    selected = set()
+    if focused.strip():
+        anchor = index.search(focused, 1)
+        if anchor:
+            i = anchor[0][0]
+            selected.update(j for j in (i - 1, i, i + 1) if 0 <= j < len(index.chunks))
+    selected.update(i for i, _ in index.search(f"{question}\n{focused}", top_k))
+    if not selected:
+        # 没有任何词命中时退回到文档开头
+        selected.update(range(min(top_k, len(index.chunks))))
+
+    ranges: List[List[int]] = []
+    for i in sorted(selected):
+        start, end = index.chunks[i]
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return "\n\n……\n\n".join(f"[文档片段：第 {start} 字至第 {end} 字]\n{md[start:end].strip()}" for start, end in ranges)
@@ -0,0 +1,7 @@
+# tests/conftest.py
+"""测试使用临时数据目录与本地假模型；须在导入 ``server.main`` 之前设置。"""
+import os
+import tempfile
+
+os.environ.setdefault("NBWEB_DATA_DIR", tempfile.mkdtemp(prefix="nbweb-test-"))
+os.environ.setdefault("NBWEB_LLM_BACKEND", "stub")
@@ -0,0 +1,91 @@
+# tests/test_chat_stream.py
+"""``/api/chat/stream`` 在本地假模型上的 SSE 格式与错误响应。"""
+import asyncio
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from server import main
+from server.llm import StubBackend
+
+DOC = "stream-doc"
+
+
+@pytest.fixture
+def client():
+    doc_dir = os.path.join(main.DOCS_DIR, DOC)
+    os.makedirs(doc_dir, exist_ok=True)
+    with open(os.path.join(doc_dir, f"{DOC}.md"), "w", encoding="utf-8") as f:
+        f.write("# 标题\n\n第一段内容。")
+    with open(os.path.join(doc_dir, f"{DOC}.html"), "w", encoding="utf-8") as f:
+        f.write("<h1>标题</h1><p>第一段内容。</p>")
+    main.app.dependency_overrides[main.get_llm] = lambda: StubBackend(latency=0, token_rate=0)
+    try:
+        with TestClient(main.app) as c:
+            yield c
+    finally:
+        main.app.dependency_overrides.pop(main.get_llm, None)
+
+
+def _request(**extra):
+    return {"document_id": DOC, "messages": [{"role": "user", "text": "这一段讲了什么？", "timestamp": 1}], **extra}
+
+
+def _events(body: str):
+    events = []
+    for block in body.split("\n\n"):
+        if not block.strip():
+            continue
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_stream_sends_deltas_then_done(client):
+    res = client.post("/api/chat/stream", json=_request(), headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/event-stream")
+    # GZipMiddleware 不能缓冲 SSE
+    assert "content-encoding" not in res.headers
+
+    events = _events(res.text)
+    kinds = [kind for kind, _ in events]
+    assert kinds[-1] == "done" and len(kinds) > 2
+    assert set(kinds[:-1]) == {"delta"}
+
+    done = events[-1][1]
+    assert "".join(data["text"] for _, data in events[:-1]) == done["text"]
+    assert done["role"] == "assistant" and done["htmlText"] and done["conversation_id"]
+
+
+@pytest.mark.parametrize("extra, status, detail", [
+    ({"conversation_id": "no-such-conversation"}, 404, "conversation_not_found"),
+    ({"selected_element_ids": ["atom-999"]}, 409, "atoms_not_found"),
+])
+def test_stream_errors_are_json(client, extra, status, detail):
+    res = client.post("/api/chat/stream", json=_request(**extra))
+    assert res.status_code == status
+    assert res.headers["content-type"].startswith("application/json")
+    assert res.json() == {"detail": detail}
+
+
+def test_slot_is_released_before_client_reads():
+    async def run():
+        conversations = main.ConversationStore(os.path.join(main.DATA_DIR, "stream-test.sqlite3"))
+        req = main.ChatRequest(**_request())
+        events = main._chat_stream_events(req, StubBackend(latency=0, token_rate=0), None, conversations, None, "")
+        first = await events.__anext__()
+        assert first.startswith("event: delta")
+        # 客户端暂停读取时，上游读完即归还并发名额
+        for _ in range(100):
+            if main.llm_semaphore._value == main.LLM_CONCURRENCY:
+                break
+            await asyncio.sleep(0.01)
+        assert main.llm_semaphore._value == main.LLM_CONCURRENCY
+        await events.aclose()
+        conversations.close()
+
+    os.makedirs(os.path.join(main.DOCS_DIR, DOC), exist_ok=True)
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+# tests/test_node_patch.py
+"""节点部分更新：显式的 null / 空位置返回 422，已保存的节点保持不变。"""
+import pytest
+from fastapi.testclient import TestClient
+
+from server import main
+
+NODE = {
+    "node_id": "n1",
+    "document_id": "doc",
+    "source_element_id": "atom-1",
+    "canvas_position": {"x": 10.0, "y": 20.0, "zoom_level": 1.0},
+    "conversation_log": [],
+}
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as c:
+        assert c.post("/api/nodes/doc", json=NODE).status_code == 200
+        yield c
+
+
+def _stored(client):
+    nodes = client.get("/api/nodes/doc").json()
+    return next(n for n in nodes if n["node_id"] == "n1")
+
+
+@pytest.mark.parametrize("body", [
+    {"canvas_position": None},
+    {"canvas_position": {}},
+    {"canvas_position": {"x": None}},
+    {"canvas_position": {"x": 5, "zoom_level": None}},
+])
+def test_patch_rejects_null_or_empty_position(client, body):
+    before = _stored(client)
+    assert client.patch("/api/nodes/doc/n1", json=body).status_code == 422
+    assert client.patch("/api/nodes/doc", json=[{"node_id": "n1", **body}]).status_code == 422
+    assert _stored(client) == before
+
+
+def test_patch_updates_only_given_fields(client):
+    assert client.patch("/api/nodes/doc/n1", json={"canvas_position": {"x": 5}}).status_code == 200
+    assert _stored(client)["canvas_position"] == {"x": 5.0, "y": 20.0, "zoom_level": 1.0}
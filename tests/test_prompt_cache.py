@@ -0,0 +1,94 @@
+# tests/test_prompt_cache.py
+"""前缀缓存：通过假模型的显式缓存检查命中、续期与失效。"""
+import asyncio
+import time
+
+from server import main
+from server.llm import StubBackend
+from server.promptcache import PromptCache
+
+PREFIX = "系统提示\n---\n[文档内容]\n" + "文档正文。" * 100
+
+
+def _methods(llm: StubBackend):
+    return [call["method"] for call in llm.calls]
+
+
+async def _drain(cache: PromptCache):
+    while cache._tasks:
+        await asyncio.gather(*list(cache._tasks))
+
+
+def test_second_request_hits_the_cached_handle():
+    async def run():
+        llm = StubBackend(latency=0, token_rate=0)
+        cache = PromptCache(llm, ttl=60, min_chars=100)
+        key = PromptCache.key_for("m", "doc", None, None, PREFIX)
+        first = await cache.get_handle(key, "m", PREFIX)
+        second = await cache.get_handle(key, "m", PREFIX)
+        assert first and first == second
+        assert _methods(llm) == ["create_cache"]
+        assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+        # 引用句柄时只需发送问题部分，模型看到的仍是前缀加问题
+        reply = await llm.generate("m", ["问题"], cached_content=first)
+        assert f"收到 {len(PREFIX) + len('问题')} 字" in reply
+
+    asyncio.run(run())
+
+
+def test_handle_is_refreshed_when_half_expired():
+    async def run():
+        llm = StubBackend(latency=0, token_rate=0)
+        cache = PromptCache(llm, ttl=60, min_chars=100)
+        key = PromptCache.key_for("m", "doc", None, None, PREFIX)
+        name = await cache.get_handle(key, "m", PREFIX)
+        cache._entries[key]["expires_at"] = time.time() + 10
+        assert await cache.get_handle(key, "m", PREFIX) == name
+        await _drain(cache)
+        assert _methods(llm) == ["create_cache", "update_cache_ttl"]
+        assert cache._entries[key]["expires_at"] > time.time() + 30
+        assert llm.caches[name]["expires_at"] > time.time() + 50
+
+    asyncio.run(run())
+
+
+def test_invalidate_deletes_upstream_and_recreates():
+    async def run():
+        llm = StubBackend(latency=0, token_rate=0)
+        cache = PromptCache(llm, ttl=60, min_chars=100)
+        key = PromptCache.key_for("m", "doc", None, None, PREFIX)
+        name = await cache.get_handle(key, "m", PREFIX)
+        cache.invalidate(key)
+        await _drain(cache)
+        assert name not in llm.caches
+        assert await cache.get_handle(key, "m", PREFIX) != name
+        assert _methods(llm) == ["create_cache", "delete_cache", "create_cache"]
+
+    asyncio.run(run())
+
+
+def test_expired_upstream_handle_falls_back_to_full_prompt():
+    async def run():
+        llm = StubBackend(latency=0, token_rate=0)
+        cache = PromptCache(llm, ttl=60, min_chars=100)
+        req = main.ChatRequest(document_id="doc", messages=[main.Message(role="user", text="问题", timestamp=1)])
+        suffix = "\n\n[用户问题]\n问题"
+        prompt = {"is_first_turn": True, "prompt": PREFIX + suffix, "history": None, "prefix": PREFIX, "suffix": suffix}
+
+        def generated():
+            return [(call["contents"], call["cached_content"]) for call in llm.calls if call["method"] == "generate"]
+
+        await main._generate_first_turn(llm, cache, req, prompt)
+        name = llm.calls[0]["name"]
+        assert generated() == [([suffix], name)]
+
+        # 上游句柄已过期：改为发送完整提示，并丢弃本地记录
+        llm.caches[name]["expires_at"] = 0
+        reply = await main._generate_first_turn(llm, cache, req, prompt)
+        assert f"收到 {len(prompt['prompt'])} 字" in reply
+        assert generated()[1:] == [([suffix], name), ([prompt["prompt"]], None)]
+        assert cache.stats()["entries"] == 0
+        await _drain(cache)
+        assert "delete_cache" in _methods(llm)
+
+    asyncio.run(run())
@@ -1,8 +1,29 @@
 // web/main.js
 
+// 本页的客户端 id：写请求带在 X-Client-Id 中，实时同步推送回来的自己的改动据此忽略
+// crypto.randomUUID 只在安全上下文（https / localhost）可用，经局域网 IP 以 http 打开时退回到随机串
+function newId() {
+  return crypto.randomUUID ? crypto.randomUUID() : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+const CLIENT_ID = newId();
+const JSON_HEADERS = { 'Content-Type': 'application/json', 'X-Client-Id': CLIENT_ID };
+
 const API = {
   listDocs: async () => fetch('/api/documents').then(r => r.json()),
+  search: async (q) => fetch(`/api/search?q=${encodeURIComponent(q)}`).then(r => {
+    if (!r.ok) throw new Error(`Search failed: ${r.status}`);
+    return r.json();
+  }),
   getDocHtml: async (id) => fetch(`/api/document/${encodeURIComponent(id)}`).then(r => r.text()),
+  getDocFragments: async (id) => fetch(`/api/document/${encodeURIComponent(id)}/fragments`).then(r => {
+    if (!r.ok) throw new Error('Fragment index unavailable');
+    return r.json();
+  }),
+  getDocFragment: async (id, index) => fetch(`/api/document/${encodeURIComponent(id)}/fragments/${index}`).then(r => {
+    if (!r.ok) throw new Error(`Fragment ${index} unavailable`);
+    return r.text();
+  }),
   upload: async (file) => {
     const form = new FormData();
     form.append('file', file);
@@ -23,19 +44,81 @@ const API = {
     }
     return res.json();
   },
-  listNodes: async (docId) => fetch(`/api/nodes/${encodeURIComponent(docId)}`).then(r => r.json()),
+  getJob: async (jobId) => {
+    const res = await fetch(`/api/jobs/${encodeURIComponent(jobId)}`);
+    if (!res.ok) throw new Error('Job not found');
+    return res.json();
+  },
+  // bbox = [min_x, min_y, max_x, max_y]（画布坐标）时只返回位置落在其中的节点
+  listNodes: async (docId, bbox) => fetch(`/api/nodes/${encodeURIComponent(docId)}${bbox ? `?bbox=${bbox.map(Math.round).join(',')}` : ''}`).then(r => {
+    if (!r.ok) throw new Error(`List nodes failed: ${r.status}`);
+    return r.json();
+  }),
   saveNode: async (docId, node) => fetch(`/api/nodes/${encodeURIComponent(docId)}`, {
-    method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(node)
+    method: 'POST', headers: JSON_HEADERS, body: JSON.stringify(node)
+  }).then(r => r.json()),
+  // 部分更新：只提交变化的字段，如 { canvas_position: { x, y } }
+  patchNode: async (docId, nodeId, fields) => fetch(`/api/nodes/${encodeURIComponent(docId)}/${encodeURIComponent(nodeId)}`, {
+    method: 'PATCH', headers: JSON_HEADERS, body: JSON.stringify(fields)
+  }).then(r => r.json()),
+  // 批量部分更新：[{ node_id, canvas_position: { x, y } }, ...]
+  patchNodes: async (docId, patches) => fetch(`/api/nodes/${encodeURIComponent(docId)}`, {
+    method: 'PATCH', headers: JSON_HEADERS, body: JSON.stringify(patches)
+  }).then(r => r.json()),
+  deleteNode: async (docId, nodeId) => fetch(`/api/nodes/${encodeURIComponent(docId)}/${encodeURIComponent(nodeId)}`, {
+    method: 'DELETE', headers: { 'X-Client-Id': CLIENT_ID }
   }).then(r => r.json()),
-  deleteNode: async (docId, nodeId) => fetch(`/api/nodes/${encodeURIComponent(docId)}/${encodeURIComponent(nodeId)}`, { method: 'DELETE' }).then(r => r.json()),
   chat: async (payload) => fetch('/api/chat', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) }).then(r => r.json()),
+  // 流式聊天：逐段回调 onDelta(text)，最终返回与 /api/chat 相同结构的结果。
+  // HTTP 错误（如 404 conversation_not_found、409 atoms_not_found）与 /api/chat 一样返回 JSON 错误体
+  chatStream: async (payload, onDelta) => {
+    const res = await fetch('/api/chat/stream', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+    if (!res.ok) {
+      const error = await res.json().catch(() => null);
+      if (error && typeof error === 'object') return error;
+      throw new Error(`Chat stream failed: ${res.status}`);
+    }
+    if (!res.body) throw new Error('Chat stream has no body');
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = null;
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const raw = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = 'message';
+        let data = '';
+        raw.split('\n').forEach(line => {
+          if (line.startsWith('event:')) event = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        });
+        if (!data) continue;
+        const parsed = JSON.parse(data);
+        if (event === 'delta') onDelta(parsed.text);
+        else if (event === 'done' || event === 'error') final = parsed;
+      }
+    }
+    if (!final) throw new Error('Chat stream ended without a result');
+    return final;
+  },
+  deleteConversation: async (conversationId) => fetch(`/api/conversations/${encodeURIComponent(conversationId)}`, { method: 'DELETE' }).then(r => r.json()),
   listChats: async (docId) => fetch(`/api/chats/${encodeURIComponent(docId)}`).then(r => r.json()),
   saveChat: async (docId, chat) => fetch(`/api/chats/${encodeURIComponent(docId)}`, {
-    method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(chat)
+    method: 'POST', headers: JSON_HEADERS, body: JSON.stringify(chat)
   }).then(r => r.json()),
   getDrawings: async (docId) => fetch(`/api/drawings/${encodeURIComponent(docId)}`).then(r => r.json()),
   saveDrawings: async (docId, drawings) => fetch(`/api/drawings/${encodeURIComponent(docId)}`, {
-    method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(drawings)
+    method: 'POST', headers: JSON_HEADERS, body: JSON.stringify(drawings)
+  }).then(r => r.json()),
+  // 笔画操作：[{ op: 'add', stroke }, { op: 'delete', id }]。keepalive 只用于关闭页面时的提交：
+  // 浏览器会直接拒绝超过 64 KB 的 keepalive 请求体
+  drawingOps: async (docId, ops, { keepalive = false } = {}) => fetch(`/api/drawings/${encodeURIComponent(docId)}/ops`, {
+    method: 'POST', headers: JSON_HEADERS, body: JSON.stringify(ops), keepalive
   }).then(r => r.json()),
 };
 
@@ -46,16 +129,23 @@ const state = {
   documentId: null,
   documents: [], 
   nodes: [],
+  // 已按视口加载过的范围：{ documentId, boxes: [[x0, y0, x1, y1]], offline }
+  nodeView: null,
   elementIdCounter: 0,
+  // 长文档按片段加载：index 为服务端的片段索引，loading 记录每个片段的加载 Promise
+  fragments: { index: null, loading: new Map(), observer: null, pxPerChar: 0.12 },
   selectedElements: [],
   sidebarContext: {
     mode: 'document',
     conversation: [],
+    conversationId: null,
     sourceElement: null,
     sourceNodeId: null,
   },
   chats: [],
   activeChatId: null,
+  // 实时同步：seq 为最后收到的事件序号；文档加载完之前收到的事件先放进 pending
+  sync: { socket: null, documentId: null, seq: null, retry: 0, timer: null, ready: false, pending: [] },
   drawing: {
     activeTool: null, 
     color: '#FF0000',
@@ -71,6 +161,9 @@ const els = {
   select: document.getElementById('documentSelect'),
   upload: document.getElementById('uploadInput'),
   uploadPdf: document.getElementById('uploadPdfInput'),
+  searchBox: document.getElementById('searchBox'),
+  searchInput: document.getElementById('searchInput'),
+  searchResults: document.getElementById('searchResults'),
   toggleSidebar: document.getElementById('toggleSidebar'),
   sidebar: document.getElementById('sidebar'),
   sidebarResizer: document.getElementById('sidebarResizer'),
@@ -125,6 +218,26 @@ function hideProcessingOverlay() {
   els.processingOverlay.classList.add('hidden');
 }
 
+const JOB_STAGE_LABELS = {
+  queued: '排队中',
+  converting: '正在解析 PDF',
+  extracting: '正在解压转换结果',
+  rendering: '正在生成网页',
+  writing: '正在保存文档',
+};
+
+// 轮询 PDF 转换任务直到完成，期间在遮罩层上显示阶段和进度
+async function waitForConversionJob(jobId, intervalMs = 1000) {
+  while (true) {
+    const job = await API.getJob(jobId);
+    if (job.status === 'done') return job;
+    if (job.status === 'failed') throw new Error(job.error || 'PDF processing failed');
+    const label = JOB_STAGE_LABELS[job.stage] || job.stage;
+    showProcessingOverlay(`${label}... ${Math.round(job.percent)}%`);
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+}
+
 function showThinkingIndicator(messagesContainer) {
   const thinkingEl = document.createElement('div');
   thinkingEl.className = 'm assistant thinking';
@@ -140,6 +253,75 @@ function hideThinkingIndicator(thinkingEl) {
   }
 }
 
+// 以流式方式请求回复：首个片段到达后用实时文本替换“思考中”指示器
+async function streamChatReply(messagesContainer, payload, thinkingEl) {
+  let liveEl = null;
+  let text = '';
+  try {
+    return await API.chatStream(payload, (delta) => {
+      if (!liveEl) {
+        hideThinkingIndicator(thinkingEl);
+        liveEl = document.createElement('div');
+        liveEl.className = 'm assistant streaming';
+        messagesContainer.appendChild(liveEl);
+      }
+      text += delta;
+      liveEl.textContent = text;
+      messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    });
+  } catch (err) {
+    // 网络或流传输失败（且尚未收到内容）时退回到普通接口；HTTP 错误已由 chatStream 作为结果返回
+    if (liveEl) throw err;
+    return API.chat(payload);
+  }
+}
+
+// 已有服务端对话时只发送新问题；服务端找不到该对话时改为携带完整历史重发（服务端会建立新对话）
+async function requestChatReply(messagesContainer, payload, thinkingEl, conversationId) {
+  if (conversationId) {
+    const res = await sendWithAtomRefs(messagesContainer, { ...payload, conversation_id: conversationId, messages: payload.messages.slice(-1) }, thinkingEl);
+    if (res.detail !== 'conversation_not_found') return res;
+  }
+  return sendWithAtomRefs(messagesContainer, payload, thinkingEl);
+}
+
+// 服务端编号（atom-N）的元素只发送编号，由服务端从元素索引取内容；前端补的编号仍发送 HTML
+const SERVER_ATOM_ID = /^atom-\d+$/;
+
+function withAtomRefs(payload) {
+  const compact = { ...payload };
+  const ids = payload.selected_element_ids;
+  if (ids && ids.length && ids.every(id => SERVER_ATOM_ID.test(id))) delete compact.selected_elements_html;
+  else delete compact.selected_element_ids;
+  if (payload.source_element_id && SERVER_ATOM_ID.test(payload.source_element_id)) delete compact.source_element_html;
+  return compact;
+}
+
+// 服务端按编号查不到元素时改为携带 HTML 重发
+async function sendWithAtomRefs(messagesContainer, payload, thinkingEl) {
+  const res = await streamChatReply(messagesContainer, withAtomRefs(payload), thinkingEl);
+  if (res.detail !== 'atoms_not_found') return res;
+  const { selected_element_ids, source_element_id, ...withHtml } = payload;
+  return streamChatReply(messagesContainer, withHtml, thinkingEl);
+}
+
+// 小于这个屏幕尺寸的笔画在缩小时不再绘制
+const STROKE_MIN_SCREEN_PX = 1;
+
+// 笔画在画布坐标中的范围 [min_x, min_y, max_x, max_y]（计入线宽），与 server/strokes.py 的 bounds 一致
+function strokeBounds(path) {
+  let x0 = Infinity, y0 = Infinity, x1 = -Infinity, y1 = -Infinity;
+  for (const p of path.points) {
+    if (p.x < x0) x0 = p.x;
+    if (p.x > x1) x1 = p.x;
+    if (p.y < y0) y0 = p.y;
+    if (p.y > y1) y1 = p.y;
+  }
+  const pad = (path.width || 0) / 2;
+  return [x0 - pad, y0 - pad, x1 + pad, y1 + pad];
+}
+
+// 只重放与视口相交、且在当前缩放下不小于 STROKE_MIN_SCREEN_PX 的笔画，平移缩放的开销取决于可见部分
 function redrawDrawingCanvas() {
     if (!drawingCtx) return;
     const dpr = window.devicePixelRatio || 1;
@@ -154,7 +336,14 @@ function redrawDrawingCanvas() {
     drawingCtx.translate(state.panX, state.panY);
     drawingCtx.scale(state.zoom, state.zoom);
 
-    const pathsToDraw = [...state.drawing.paths];
+    const view = [-state.panX / state.zoom, -state.panY / state.zoom,
+                  (rect.width - state.panX) / state.zoom, (rect.height - state.panY) / state.zoom];
+    const minSize = STROKE_MIN_SCREEN_PX / state.zoom;
+    const pathsToDraw = state.drawing.paths.filter(path => {
+        const box = path.bbox || (path.bbox = strokeBounds(path));
+        return box[2] >= view[0] && box[0] <= view[2] && box[3] >= view[1] && box[1] <= view[3]
+            && Math.max(box[2] - box[0], box[3] - box[1]) >= minSize;
+    });
     if (state.drawing.isDrawing && state.drawing.currentPath) {
         pathsToDraw.push(state.drawing.currentPath);
     }
@@ -191,8 +380,9 @@ function redrawDrawingCanvas() {
 function setTransform() {
   els.canvas.style.transform = `translate(${state.panX}px, ${state.panY}px) scale(${state.zoom})`;
   els.zoomValue.textContent = `${Math.round(state.zoom * 100)}%`;
-  redrawWires();
+  // 连线在 #canvas 内随画布一起变换，平移缩放时无需重画；只有进出视口的节点变化时才重画
   redrawDrawingCanvas();
+  scheduleVisibleNodes();
 }
 
 function initPanZoom() {
@@ -394,11 +584,27 @@ function clearTouchHovers() {
     });
 }
 
-function annotateAtoms() {
-  state.elementIdCounter = 0;
-  clearElementSelection();
+// 片段模式下编号由服务端写在 data-atom-id 上；MathJax 生成的 mjx-container 及其 svg
+// 取公式元素上预留的 data-math-atom-id（N 与 N+1）
+function fragmentAtomId(n, fragmentIndex, fallback) {
+  const math = n.closest('[data-math-atom-id]');
+  if (math) {
+    const base = parseInt(math.dataset.mathAtomId.slice('atom-'.length), 10);
+    if (n.tagName.toLowerCase() === 'mjx-container') return `atom-${base}`;
+    if (n.tagName.toLowerCase() === 'svg' && n.parentElement && n.parentElement.tagName.toLowerCase() === 'mjx-container') return `atom-${base + 1}`;
+  }
+  return `atom-f${fragmentIndex}-${fallback}`;
+}
+
+function annotateAtoms(root = els.docHtml) {
+  const fragmentIndex = root.dataset.fragmentIndex;
+  let fallbackCounter = 0;
+  if (fragmentIndex === undefined) {
+    state.elementIdCounter = 0;
+    clearElementSelection();
+  }
   const selector = 'p, img, table, thead, tbody, tr, pre, h1, h2, h3, h4, h5, h6, li, blockquote, code, figure, figcaption, math, svg, mjx-container';
-  const nodes = els.docHtml.querySelectorAll(selector);
+  const nodes = root.querySelectorAll(selector);
 
   let touchstartX = 0;
   let touchstartY = 0;
@@ -406,8 +612,12 @@ function annotateAtoms() {
 
   nodes.forEach((n) => {
     n.classList.add('atom');
-    const id = `atom-${++state.elementIdCounter}`;
-    n.dataset.atomId = id;
+    if (fragmentIndex === undefined) {
+      // 仅在拿不到片段（服务端编号的 HTML）时整份加载：本地编号不能当作服务端编号引用，提问时会携带 HTML
+      if (!n.dataset.atomId) n.dataset.atomId = `atom-local-${++state.elementIdCounter}`;
+    } else if (!n.dataset.atomId) {
+      n.dataset.atomId = fragmentAtomId(n, fragmentIndex, ++fallbackCounter);
+    }
     n.dataset.originalHtml = n.outerHTML;
     n.setAttribute('draggable', 'true');
 
@@ -558,6 +768,7 @@ function openMicroChat(atomEl) {
   const expandBtn = box.querySelector('.expand');
   const discardBtn = box.querySelector('.discard');
   let conversation = [];
+  let conversationId = null;
 
   async function send() {
     const text = input.value.trim(); if (!text) return;
@@ -572,6 +783,7 @@ function openMicroChat(atomEl) {
     const payload = {
       document_id: state.documentId,
       messages: conversation,
+      source_element_id: atomEl.dataset.atomId,
       source_element_html: atomEl.dataset.originalHtml,
     };
     
@@ -581,7 +793,8 @@ function openMicroChat(atomEl) {
     }
 
     try {
-      const res = await API.chat(payload);
+      const res = await requestChatReply(messagesEl, payload, thinkingIndicator, conversationId);
+      if (res.conversation_id) conversationId = res.conversation_id;
       
       if (res.first_user_message_override && currentConversationLength > 0) {
         const userMessageIndex = currentConversationLength - 1;
@@ -602,15 +815,18 @@ function openMicroChat(atomEl) {
   sendBtn.addEventListener('click', send);
   input.addEventListener('keydown', (e) => { if (e.key === 'Enter') send(); });
   saveBtn.addEventListener('click', async () => {
-    const node = await saveConversationAsNode(atomEl, conversation);
+    const node = await saveConversationAsNode(atomEl, conversation, conversationId);
     box.remove();
     addNodeToCanvas(node);
   });
   expandBtn.addEventListener('click', () => {
-    appendChatToSidebar(atomEl, conversation);
+    appendChatToSidebar(atomEl, conversation, null, conversationId);
+    box.remove();
+  });
+  discardBtn.addEventListener('click', () => {
+    if (conversationId) API.deleteConversation(conversationId).catch(() => {});
     box.remove();
   });
-  discardBtn.addEventListener('click', () => { box.remove(); });
 }
 
 function closeAllMicroChats() {
@@ -644,11 +860,11 @@ async function renderMessages(container, messages) {
 }
 
 
-async function saveConversationAsNode(atomEl, conversation) {
+async function saveConversationAsNode(atomEl, conversation, conversationId = null) {
   const nodeWidth = 28;
   const nodeHeight = 28;
   const node = {
-    node_id: crypto.randomUUID(),
+    node_id: newId(),
     document_id: state.documentId,
     source_element_id: atomEl.dataset.atomId,
     canvas_position: {
@@ -659,6 +875,7 @@ async function saveConversationAsNode(atomEl, conversation) {
     conversation_log: conversation,
     user_annotations: null,
     source_element_html: atomEl.dataset.originalHtml,
+    conversation_id: conversationId,
   };
   try {
     await API.saveNode(state.documentId, node);
@@ -672,18 +889,99 @@ async function saveConversationAsNode(atomEl, conversation) {
   return node;
 }
 
-function addNodeToCanvas(node) {
-  const tpl = els.nodeTemplate.content.cloneNode(true);
-  const el = tpl.querySelector('.node');
+// node_id -> 节点元素。移出视口的节点只从 DOM 中摘下、元素保留，再次进入视口时不必重新绑定拖动事件
+const nodeElements = new Map();
+
+function addNodeToCanvas(node, redraw = true) {
+  let el = nodeElements.get(node.node_id);
+  if (!el) {
+    const tpl = els.nodeTemplate.content.cloneNode(true);
+    el = tpl.querySelector('.node');
+    el.dataset.nodeId = node.node_id;
+    el.dataset.sourceId = node.source_element_id;
+    el.title = '点击展开/收缩对话';
+    // el.addEventListener('click', () => toggleNodeConversation(node));
+    enableNodeDrag(el, node);
+    nodeElements.set(node.node_id, el);
+  }
   el.style.left = `${node.canvas_position.x}px`;
   el.style.top = `${node.canvas_position.y}px`;
-  el.dataset.nodeId = node.node_id;
-  el.dataset.sourceId = node.source_element_id;
-  el.title = '点击展开/收缩对话';
-  // el.addEventListener('click', () => toggleNodeConversation(node));
-  enableNodeDrag(el, node);
-  els.canvas.appendChild(el);
-  redrawWires();
+  if (!el.isConnected) els.canvas.appendChild(el);
+  if (redraw) redrawWires();
+}
+
+function removeNodeElement(nodeId) {
+  const el = nodeElements.get(nodeId);
+  if (el) el.remove();
+  nodeElements.delete(nodeId);
+}
+
+// 节点按视口加载：平移缩放停下后请求视口外扩 NODE_FETCH_MARGIN 屏范围内的节点（已加载过的范围不再请求），
+// 只把视口外扩 NODE_RENDER_MARGIN 屏范围内的节点放进 DOM，连线也只画这些节点
+const NODE_FETCH_MARGIN = 1;
+const NODE_RENDER_MARGIN = 0.5;
+const NODE_VIEW_DEBOUNCE_MS = 120;
+const NODE_VIEW_MAX_BOXES = 32;
+let nodeViewTimer = null;
+
+// 视口在画布坐标中的范围，四周各外扩 margin 屏
+function canvasView(margin = 0) {
+  const rect = els.canvasWrapper.getBoundingClientRect();
+  const w = rect.width / state.zoom, h = rect.height / state.zoom;
+  const x0 = -state.panX / state.zoom, y0 = -state.panY / state.zoom;
+  return [x0 - w * margin, y0 - h * margin, x0 + w * (1 + margin), y0 + h * (1 + margin)];
+}
+
+function nodeInView(node, view) {
+  const { x, y } = node.canvas_position;
+  return x + NODE_SIZE >= view[0] && x <= view[2] && y + NODE_SIZE >= view[1] && y <= view[3];
+}
+
+// 让 DOM 中恰好是视口附近的节点；有节点进出时返回 true（调用方需要重画连线）
+function renderVisibleNodes() {
+  const view = canvasView(NODE_RENDER_MARGIN);
+  let changed = false;
+  state.nodes.forEach(node => {
+    const el = nodeElements.get(node.node_id);
+    const attached = !!(el && el.isConnected);
+    if (nodeInView(node, view) === attached) return;
+    if (attached) el.remove();
+    else addNodeToCanvas(node, false);
+    changed = true;
+  });
+  return changed;
+}
+
+function scheduleVisibleNodes() {
+  clearTimeout(nodeViewTimer);
+  nodeViewTimer = setTimeout(() => {
+    if (state.documentId) loadVisibleNodes(state.documentId);
+  }, NODE_VIEW_DEBOUNCE_MS);
+}
+
+async function loadVisibleNodes(docId) {
+  const nodeView = state.nodeView;
+  if (!nodeView || nodeView.documentId !== docId) return;
+  const view = canvasView();
+  const covered = nodeView.offline || nodeView.boxes.some(b => b[0] <= view[0] && b[1] <= view[1] && b[2] >= view[2] && b[3] >= view[3]);
+  if (!covered) {
+    const box = canvasView(NODE_FETCH_MARGIN);
+    let nodes;
+    try { nodes = await API.listNodes(docId, box); }
+    catch {
+      // 离线时退回本地保存的全部节点
+      nodes = JSON.parse(localStorage.getItem(`nbweb:${docId}:nodes`) || '[]');
+      nodeView.offline = true;
+    }
+    // 请求期间切换了文档或重新加载了节点
+    if (state.nodeView !== nodeView) return;
+    nodeView.boxes.push(box);
+    if (nodeView.boxes.length > NODE_VIEW_MAX_BOXES) nodeView.boxes.shift();
+    // 已知的节点由实时同步保持最新，这里只补上新出现的
+    const known = new Set(state.nodes.map(n => n.node_id));
+    nodes.forEach(node => { if (!known.has(node.node_id)) state.nodes.push(node); });
+  }
+  if (renderVisibleNodes()) redrawWires();
 }
 
 function enableNodeDrag(el, node) {
@@ -740,9 +1038,11 @@ function enableNodeDrag(el, node) {
       }
       toggleNodeConversation(node);
     } else {
-      // 如果是“拖动”，则保存位置
+      // 如果是“拖动”，则只保存位置
       try {
-        await API.saveNode(state.documentId, node);
+        await API.patchNode(state.documentId, node.node_id, {
+          canvas_position: { x: node.canvas_position.x, y: node.canvas_position.y },
+        });
       } catch {}
     }
 
@@ -772,32 +1072,37 @@ function enableNodeDrag(el, node) {
   window.addEventListener('touchcancel', (e) => onEnd(e)); // 传递事件对象
 }
 
+// 节点端点直接取 canvas_position（节点为 NODE_SIZE 见方），只需读取来源元素的布局；
+// 先读完全部布局再一次性写入 DOM，避免读写交替引起的重复排版
+const NODE_SIZE = 28;
+
 function redrawWires() {
-  els.wires.innerHTML = '';
-  els.wires.setAttribute('width', els.canvas.scrollWidth);
-  els.wires.setAttribute('height', els.canvas.scrollHeight);
-  
+  const canvasRect = els.canvas.getBoundingClientRect();
+  const segments = [];
   state.nodes.forEach(node => {
-    const nodeEl = document.querySelector(`.node[data-node-id="${node.node_id}"]`);
+    const nodeEl = nodeElements.get(node.node_id);
+    if (!nodeEl || !nodeEl.isConnected) return;
     const srcEl = els.docHtml.querySelector(`[data-atom-id="${node.source_element_id}"]`);
-    
-    if (!nodeEl || !srcEl) return;
-    
-    const nodeRect = nodeEl.getBoundingClientRect();
+    if (!srcEl) return;
     const srcRect = srcEl.getBoundingClientRect();
-    const canvasRect = els.canvas.getBoundingClientRect();
-    
-    const x1 = (nodeRect.left + nodeRect.width / 2 - canvasRect.left) / state.zoom;
-    const y1 = (nodeRect.top + nodeRect.height / 2 - canvasRect.top) / state.zoom;
-    const x2 = (srcRect.left - canvasRect.left) / state.zoom;
-    const y2 = (srcRect.top + srcRect.height / 2 - canvasRect.top) / state.zoom;
+    segments.push([
+      node.canvas_position.x + NODE_SIZE / 2,
+      node.canvas_position.y + NODE_SIZE / 2,
+      (srcRect.left - canvasRect.left) / state.zoom,
+      (srcRect.top + srcRect.height / 2 - canvasRect.top) / state.zoom,
+    ]);
+  });
 
+  const fragment = document.createDocumentFragment();
+  segments.forEach(([x1, y1, x2, y2]) => {
     const path = document.createElementNS('http://www.w3.org/2000/svg', 'path');
-    const d = `M ${x1},${y1} C ${x1 + 50},${y1} ${x2 - 150},${y2} ${x2},${y2}`;
-    path.setAttribute('d', d);
+    path.setAttribute('d', `M ${x1},${y1} C ${x1 + 50},${y1} ${x2 - 150},${y2} ${x2},${y2}`);
     path.setAttribute('class', 'wire');
-    els.wires.appendChild(path);
+    fragment.appendChild(path);
   });
+  els.wires.setAttribute('width', els.canvas.scrollWidth);
+  els.wires.setAttribute('height', els.canvas.scrollHeight);
+  els.wires.replaceChildren(fragment);
 }
 
 async function openNodeConversation(node) {
@@ -834,9 +1139,11 @@ async function openNodeConversation(node) {
       const payload = {
           document_id: state.documentId,
           messages: node.conversation_log,
+          source_element_id: node.source_element_id,
           source_element_html: node.source_element_html || '',
       };
 
+      await ensureAtomLoaded(node.source_element_id);
       const sourceElement = document.querySelector(`[data-atom-id="${node.source_element_id}"]`);
       if (sourceElement){
           const imageElement = sourceElement.querySelector('img');
@@ -846,7 +1153,8 @@ async function openNodeConversation(node) {
       }
       
       try {
-          const res = await API.chat(payload);
+          const res = await requestChatReply(messagesEl, payload, thinkingIndicator, node.conversation_id);
+          if (res.conversation_id) node.conversation_id = res.conversation_id;
 
           if (res.first_user_message_override && currentConversationLength > 0) {
             const userMessageIndex = currentConversationLength - 1;
@@ -872,8 +1180,10 @@ async function openNodeConversation(node) {
   saveBtn.textContent = '收起';
   saveBtn.addEventListener('click', () => box.remove());
   
-  box.querySelector('.expand').addEventListener('click', () => {
+  box.querySelector('.expand').addEventListener('click', async () => {
+    await ensureAtomLoaded(node.source_element_id);
     const sourceEl = els.docHtml.querySelector(`[data-atom-id="${node.source_element_id}"]`);
+    // 侧栏里的是副本，继续提问时另建服务端对话，保存回节点时再替换
     appendChatToSidebar(sourceEl, node.conversation_log || [], node.node_id);
     box.remove();
   });
@@ -882,8 +1192,9 @@ async function openNodeConversation(node) {
     if (confirm('确定要删除这个知识节点吗？')) {
       try {
         await API.deleteNode(state.documentId, node.node_id);
+        if (node.conversation_id) API.deleteConversation(node.conversation_id).catch(() => {});
         state.nodes = state.nodes.filter(n => n.node_id !== node.node_id);
-        nodeEl.remove();
+        removeNodeElement(node.node_id);
         box.remove();
         redrawWires();
       } catch {}
@@ -891,11 +1202,12 @@ async function openNodeConversation(node) {
   });
 }
 
-async function appendChatToSidebar(atomEl, conversation, nodeId = null) {
+async function appendChatToSidebar(atomEl, conversation, nodeId = null, conversationId = null) {
   clearElementSelection();
   state.sidebarContext = {
     mode: 'element',
     conversation: [...conversation],
+    conversationId,
     sourceElement: atomEl,
     sourceNodeId: nodeId
   };
@@ -945,6 +1257,7 @@ function setupContextSelector(totalChars) {
 
 async function loadDocument(id) {
   state.documentId = id;
+  connectSync(id);
   closeAllMicroChats();
   clearTouchHovers();
   
@@ -956,13 +1269,194 @@ async function loadDocument(id) {
   }
   els.customRangeInputs.classList.add('hidden');
 
-  const html = await API.getDocHtml(id).catch(() => '<p style="color:#a00">无法加载文档</p>');
-  els.docHtml.innerHTML = html;
-  
+  resetFragments();
+  const fragmentIndex = await API.getDocFragments(id).catch(() => null);
+  // 编号只由服务端写入（片段 HTML 上的 data-atom-id）；只有一个片段的短文档也走片段接口，并立即加载
+  if (fragmentIndex && fragmentIndex.fragments.length) {
+    showFragmentPlaceholders(id, fragmentIndex);
+    if (fragmentIndex.fragments.length === 1) await loadFragment(id, 0);
+  } else {
+    const html = await API.getDocHtml(id).catch(() => '<p style="color:#a00">无法加载文档</p>');
+    els.docHtml.innerHTML = html;
+    await typesetMath(els.docHtml);
+    annotateAtoms();
+  }
+  await loadNodes(id);
+  await loadChats(id);
+  await loadDrawings(id);
+  if (state.documentId === id) await finishSyncLoad();
+}
+
+// ---- 实时同步 ----
+// 每个打开的文档一条 WebSocket；服务端推送其他客户端的增量改动，断线后带上最后的序号重连补齐。
+// 事件处理都是幂等的：加载期间收到、随后又包含在加载结果里的改动重复应用也无妨。
+const SYNC_RETRY_MAX_MS = 30000;
+
+function connectSync(docId) {
+  const sync = state.sync;
+  clearTimeout(sync.timer);
+  if (sync.socket) { const old = sync.socket; sync.socket = null; old.close(); }
+  Object.assign(sync, { documentId: docId, seq: null, retry: 0, ready: false, pending: [] });
+  openSyncSocket();
+}
+
+function openSyncSocket() {
+  const sync = state.sync;
+  const docId = sync.documentId;
+  const query = sync.seq === null ? '' : `?since=${sync.seq}`;
+  const ws = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws/documents/${encodeURIComponent(docId)}${query}`);
+  sync.socket = ws;
+  ws.onopen = () => { sync.retry = 0; };
+  ws.onmessage = (e) => {
+    if (sync.socket !== ws) return;
+    handleSyncEvent(JSON.parse(e.data)).catch(err => console.error('同步事件处理失败', err));
+  };
+  ws.onclose = () => {
+    if (sync.socket !== ws) return;
+    sync.socket = null;
+    sync.timer = setTimeout(openSyncSocket, Math.min(SYNC_RETRY_MAX_MS, 1000 * 2 ** sync.retry++));
+  };
+}
+
+async function finishSyncLoad() {
+  const sync = state.sync;
+  sync.ready = true;
+  const pending = sync.pending;
+  sync.pending = [];
+  for (const event of pending) await applySyncEvent(event);
+}
+
+async function handleSyncEvent(event) {
+  const sync = state.sync;
+  if (event.type === 'ping') return;
+  sync.seq = event.seq;
+  if (event.type === 'hello') return;
+  if (event.type === 'reset') {
+    // 错过的改动已无法补发：整体重新加载
+    sync.pending = [];
+    if (sync.ready) await reloadSyncedState(sync.documentId);
+    return;
+  }
+  if (event.origin === CLIENT_ID) return;
+  if (!sync.ready) { sync.pending.push(event); return; }
+  await applySyncEvent(event);
+}
+
+async function reloadSyncedState(docId) {
+  await loadNodes(docId);
+  await loadDrawings(docId);
+  state.chats = await API.listChats(docId).catch(() => state.chats);
+  renderChatHistoryDropdown();
+  if (state.chats.find(c => c.id === state.activeChatId)) await setActiveChat(state.activeChatId);
+}
+
+function moveNodeElement(node) {
+  const el = nodeElements.get(node.node_id);
+  if (!el) return;
+  el.style.left = `${node.canvas_position.x}px`;
+  el.style.top = `${node.canvas_position.y}px`;
+}
+
+async function rerenderChatIfActive(chat) {
+  if (chat.id === state.activeChatId && state.sidebarContext.mode === 'document') {
+    state.sidebarContext.conversation = chat.messages;
+    state.sidebarContext.conversationId = chat.conversation_id;
+    await renderMessages(els.sidebarMessages, chat.messages);
+  }
+}
+
+async function applySyncEvent(event) {
+  switch (event.type) {
+    case 'node.upserted': {
+      const node = state.nodes.find(n => n.node_id === event.node.node_id);
+      if (!node) {
+        state.nodes.push(event.node);
+        if (renderVisibleNodes()) redrawWires();
+        return;
+      }
+      // 原地更新：拖动等处理函数持有的是这个对象
+      const { canvas_position, ...rest } = event.node;
+      Object.assign(node.canvas_position, canvas_position);
+      Object.assign(node, rest);
+      moveNodeElement(node);
+      renderVisibleNodes();
+      redrawWires();
+      const box = document.querySelector(`.micro-chat[data-node-id-ref='${node.node_id}']`);
+      if (box) await renderMessages(box.querySelector('.messages'), node.conversation_log);
+      return;
+    }
+    case 'nodes.patched': {
+      Object.entries(event.patches).forEach(([nodeId, fields]) => {
+        const node = state.nodes.find(n => n.node_id === nodeId);
+        if (!node) return;
+        if (fields.canvas_position) Object.assign(node.canvas_position, fields.canvas_position);
+        if ('user_annotations' in fields) node.user_annotations = fields.user_annotations;
+        moveNodeElement(node);
+      });
+      renderVisibleNodes();
+      redrawWires();
+      return;
+    }
+    case 'node.deleted': {
+      state.nodes = state.nodes.filter(n => n.node_id !== event.node_id);
+      removeNodeElement(event.node_id);
+      document.querySelectorAll(`.micro-chat[data-node-id-ref='${event.node_id}']`).forEach(el => el.remove());
+      redrawWires();
+      return;
+    }
+    case 'strokes.changed': {
+      event.ops.forEach(op => {
+        if (op.op === 'add') {
+          if (!state.drawing.paths.some(p => p.id === op.stroke.id)) {
+            state.drawing.paths.push({ ...op.stroke, points: decodePoints(op.stroke.points), remote: true });
+          }
+        } else {
+          state.drawing.paths = state.drawing.paths.filter(p => p.id !== op.id);
+        }
+      });
+      redrawDrawingCanvas();
+      return;
+    }
+    case 'strokes.replaced':
+      await loadDrawings(state.documentId);
+      return;
+    case 'chat.appended': {
+      const chat = state.chats.find(c => c.id === event.chat_id);
+      if (!chat || chat.messages.length < event.start) {
+        await reloadSyncedState(state.documentId);
+        return;
+      }
+      chat.messages.splice(event.start, chat.messages.length - event.start, ...event.messages);
+      Object.assign(chat, { name: event.name, conversation_id: event.conversation_id });
+      renderChatHistoryDropdown();
+      await rerenderChatIfActive(chat);
+      return;
+    }
+    case 'chat.upserted': {
+      const i = state.chats.findIndex(c => c.id === event.chat.id);
+      if (i === -1) state.chats.push(event.chat);
+      else state.chats[i] = event.chat;
+      renderChatHistoryDropdown();
+      await rerenderChatIfActive(event.chat);
+      return;
+    }
+    case 'chat.deleted': {
+      state.chats = state.chats.filter(c => c.id !== event.chat_id);
+      renderChatHistoryDropdown();
+      if (state.activeChatId === event.chat_id && state.chats.length) await setActiveChat(state.chats[0].id);
+      return;
+    }
+    case 'document.deleted':
+      await refreshDocs();
+      return;
+  }
+}
+
+async function typesetMath(el) {
   if (window.MathJax && window.MathJax.typesetPromise) {
     console.log('[MathJax Log] Attempting to typeset formulas in the main document content.');
     try {
-      await window.MathJax.typesetPromise([els.docHtml]);
+      await window.MathJax.typesetPromise([el]);
       console.log('[MathJax Log] Typesetting completed successfully for the main document.');
     } catch (err) {
       console.error('[MathJax Error] An error occurred during main document typesetting:', err);
@@ -970,28 +1464,166 @@ async function loadDocument(id) {
   } else {
     console.warn('[MathJax Log] MathJax library is not available.');
   }
-  annotateAtoms();
-  await loadNodes(id);
-  await loadChats(id);
-  await loadDrawings(id);
 }
 
-async function loadNodes(id) {
-  let nodes = [];
-  try { nodes = await API.listNodes(id); }
-  catch {
-    const key = `nbweb:${id}:nodes`; nodes = JSON.parse(localStorage.getItem(key) || '[]');
+function resetFragments() {
+  if (state.fragments.observer) state.fragments.observer.disconnect();
+  state.fragments.index = null;
+  state.fragments.loading = new Map();
+  state.fragments.observer = null;
+  clearElementSelection();
+}
+
+// 为每个片段放一个按字符数估算高度的占位块，接近视口时再加载
+function showFragmentPlaceholders(docId, index) {
+  state.fragments.index = index;
+  els.docHtml.innerHTML = '';
+  index.fragments.forEach(f => {
+    const section = document.createElement('section');
+    section.className = 'doc-fragment';
+    section.dataset.fragmentIndex = f.index;
+    section.style.minHeight = `${Math.round(f.chars * state.fragments.pxPerChar)}px`;
+    els.docHtml.appendChild(section);
+  });
+  state.fragments.observer = new IntersectionObserver((entries) => {
+    entries.forEach(entry => {
+      if (entry.isIntersecting) loadFragment(docId, parseInt(entry.target.dataset.fragmentIndex, 10));
+    });
+  }, { root: els.canvasWrapper, rootMargin: '1500px 0px' });
+  els.docHtml.querySelectorAll('.doc-fragment').forEach(section => state.fragments.observer.observe(section));
+}
+
+function loadFragment(docId, fragmentIndex) {
+  if (state.fragments.loading.has(fragmentIndex)) return state.fragments.loading.get(fragmentIndex);
+  const promise = (async () => {
+    const section = els.docHtml.querySelector(`.doc-fragment[data-fragment-index="${fragmentIndex}"]`);
+    const html = await API.getDocFragment(docId, fragmentIndex).catch(() => '<p style="color:#a00">无法加载该部分内容</p>');
+    if (state.documentId !== docId || !section) return;
+    if (state.fragments.observer) state.fragments.observer.unobserve(section);
+    section.innerHTML = html;
+    section.style.minHeight = '';
+    await typesetMath(section);
+    annotateAtoms(section);
+    updateFragmentEstimates(section, fragmentIndex);
+    redrawWires();
+  })();
+  state.fragments.loading.set(fragmentIndex, promise);
+  return promise;
+}
+
+// 用已加载片段的实际高度校正其余占位块的估算高度
+function updateFragmentEstimates(section, fragmentIndex) {
+  const info = state.fragments.index && state.fragments.index.fragments[fragmentIndex];
+  if (!info || !info.chars || !section.offsetHeight) return;
+  state.fragments.pxPerChar = (state.fragments.pxPerChar + section.offsetHeight / info.chars) / 2;
+  els.docHtml.querySelectorAll('.doc-fragment').forEach(el => {
+    const i = parseInt(el.dataset.fragmentIndex, 10);
+    if (!state.fragments.loading.has(i)) {
+      el.style.minHeight = `${Math.round(state.fragments.index.fragments[i].chars * state.fragments.pxPerChar)}px`;
+    }
+  });
+}
+
+// 确保某个元素所在的片段已加载（退回整份加载的文档直接返回）
+async function ensureAtomLoaded(atomId) {
+  const index = state.fragments.index;
+  if (!index || !atomId) return;
+  let fragment;
+  const mixed = /^atom-f(\d+)-/.exec(atomId);
+  if (mixed) {
+    fragment = index.fragments[parseInt(mixed[1], 10)];
+  } else {
+    const n = parseInt(String(atomId).replace('atom-', ''), 10);
+    fragment = index.fragments.find(f => n > f.atom_start && n <= f.atom_start + f.atom_count);
   }
-  state.nodes = nodes;
-  document.querySelectorAll('.node').forEach(e => e.remove());
-  nodes.forEach(addNodeToCanvas);
+  if (fragment) await loadFragment(state.documentId, fragment.index);
+}
+
+async function loadNodes(id) {
+  state.nodes = [];
+  state.nodeView = { documentId: id, boxes: [], offline: false };
+  nodeElements.forEach(el => el.remove());
+  nodeElements.clear();
+  await loadVisibleNodes(id);
   redrawWires();
 }
 
+// 与 server/strokes.py 相同的紧凑编码：坐标取 1/STROKE_SCALE 像素，首点为绝对值、之后为差值，
+// zigzag 后按变长整数写入，再整体 base64
+const STROKE_SCALE = 10;
+// 落笔结束时按屏幕像素简化笔画（Ramer–Douglas–Peucker）
+const STROKE_SIMPLIFY_PX = 0.5;
+
+function encodePoints(points) {
+  let binary = '';
+  let px = 0, py = 0;
+  for (const p of points) {
+    const qx = Math.round(p.x * STROKE_SCALE), qy = Math.round(p.y * STROKE_SCALE);
+    for (const d of [qx - px, qy - py]) {
+      let v = d >= 0 ? d * 2 : -d * 2 - 1;
+      while (v >= 0x80) {
+        binary += String.fromCharCode((v % 0x80) | 0x80);
+        v = Math.floor(v / 0x80);
+      }
+      binary += String.fromCharCode(v);
+    }
+    px = qx; py = qy;
+  }
+  return btoa(binary);
+}
+
+function decodePoints(encoded) {
+  const binary = atob(encoded);
+  const values = [];
+  let value = 0, mult = 1;
+  for (let i = 0; i < binary.length; i++) {
+    const b = binary.charCodeAt(i);
+    value += (b & 0x7f) * mult;
+    if (b & 0x80) { mult *= 0x80; continue; }
+    values.push(value % 2 === 0 ? value / 2 : -(value + 1) / 2);
+    value = 0; mult = 1;
+  }
+  const points = [];
+  let x = 0, y = 0;
+  for (let i = 0; i + 1 < values.length; i += 2) {
+    x += values[i]; y += values[i + 1];
+    points.push({ x: x / STROKE_SCALE, y: y / STROKE_SCALE });
+  }
+  return points;
+}
+
+function simplifyPoints(points, tolerance) {
+  if (points.length < 3) return points;
+  const keep = new Uint8Array(points.length);
+  keep[0] = keep[points.length - 1] = 1;
+  const stack = [[0, points.length - 1]];
+  while (stack.length) {
+    const [a, b] = stack.pop();
+    const pa = points[a], pb = points[b];
+    const dx = pb.x - pa.x, dy = pb.y - pa.y;
+    const len = Math.hypot(dx, dy);
+    let maxDist = 0, index = -1;
+    for (let i = a + 1; i < b; i++) {
+      const p = points[i];
+      const dist = len === 0 ? Math.hypot(p.x - pa.x, p.y - pa.y) : Math.abs(dy * (p.x - pa.x) - dx * (p.y - pa.y)) / len;
+      if (dist > maxDist) { maxDist = dist; index = i; }
+    }
+    if (maxDist > tolerance) {
+      keep[index] = 1;
+      stack.push([a, index], [index, b]);
+    }
+  }
+  return points.filter((_, i) => keep[i]);
+}
+
+function encodeStroke(path) {
+  return { id: path.id, tool: path.tool, color: path.color, width: path.width, points: encodePoints(path.points) };
+}
+
 async function loadDrawings(id) {
   try {
       const drawings = await API.getDrawings(id);
-      state.drawing.paths = drawings || [];
+      state.drawing.paths = (drawings || []).map(stroke => ({ ...stroke, points: decodePoints(stroke.points) }));
   } catch (e) {
       console.error("无法加载绘图数据:", e);
       state.drawing.paths = [];
@@ -1046,6 +1678,9 @@ function initUI() {
     let res;
     try {
       res = await API.uploadPdf(f);
+      if (!res.document_id && res.job_id) {
+        res = await waitForConversionJob(res.job_id);
+      }
       await refreshDocs();
       if (res && res.document_id) {
         els.select.value = res.document_id; 
@@ -1069,11 +1704,98 @@ function initUI() {
   });
 }
 
+// 全文检索：输入停顿后查询，点击结果跳到对应的文档元素、节点或对话
+const SEARCH_DEBOUNCE_MS = 250;
+const SEARCH_KIND_LABELS = { document: '文档', node: '节点', chat: '对话' };
+
+function initSearch() {
+  let timer = null;
+  let seq = 0;
+  const hide = () => els.searchResults.classList.add('hidden');
+  els.searchInput.addEventListener('input', () => {
+    clearTimeout(timer);
+    const mySeq = ++seq;
+    const q = els.searchInput.value;
+    if (!q.trim()) { hide(); return; }
+    timer = setTimeout(async () => {
+      const res = await API.search(q).catch(() => null);
+      if (mySeq === seq) renderSearchResults(res ? res.hits : null); // 只显示最后一次输入的结果
+    }, SEARCH_DEBOUNCE_MS);
+  });
+  els.searchInput.addEventListener('focus', () => {
+    if (els.searchInput.value.trim() && els.searchResults.childElementCount) els.searchResults.classList.remove('hidden');
+  });
+  els.searchInput.addEventListener('keydown', (e) => { if (e.key === 'Escape') hide(); });
+  document.addEventListener('click', (e) => { if (!els.searchBox.contains(e.target)) hide(); });
+}
+
+function renderSearchResults(hits) {
+  els.searchResults.innerHTML = '';
+  if (!hits || !hits.length) {
+    const empty = document.createElement('div');
+    empty.className = 'search-empty';
+    empty.textContent = hits ? '没有找到结果' : '搜索失败';
+    els.searchResults.appendChild(empty);
+  }
+  (hits || []).forEach(hit => {
+    const item = document.createElement('div');
+    item.className = 'search-hit';
+    const meta = document.createElement('div');
+    meta.className = 'meta';
+    meta.textContent = [SEARCH_KIND_LABELS[hit.kind], hit.document_title, hit.kind !== 'document' ? hit.title : '']
+      .filter(Boolean).join(' · ');
+    const snippet = document.createElement('div');
+    snippet.className = 'snippet';
+    snippet.innerHTML = hit.snippet; // 服务端已转义，只含 <mark>
+    item.append(meta, snippet);
+    item.addEventListener('click', () => {
+      els.searchResults.classList.add('hidden');
+      jumpToSearchHit(hit);
+    });
+    els.searchResults.appendChild(item);
+  });
+  els.searchResults.classList.remove('hidden');
+}
+
+async function jumpToSearchHit(hit) {
+  if (hit.document_id !== state.documentId) {
+    els.select.value = hit.document_id;
+    await loadDocument(hit.document_id);
+  }
+  if (hit.kind === 'chat') {
+    await resetSidebarToDocumentMode();
+    await setActiveChat(hit.chat_id);
+    els.sidebar.classList.remove('hidden');
+    els.sidebarResizer.classList.remove('hidden');
+    return;
+  }
+  if (hit.atom_id) await focusAtom(hit.atom_id);
+  if (hit.kind === 'node') {
+    // 节点在来源元素旁边：跳转后立即加载新视口内的节点，不等平移的防抖
+    await loadVisibleNodes(state.documentId);
+    const node = state.nodes.find(n => n.node_id === hit.node_id);
+    if (node && !document.querySelector(`.micro-chat[data-node-id-ref='${node.node_id}']`)) await openNodeConversation(node);
+  }
+}
+
+// 平移画布，让元素出现在视口上方三分之一处，并短暂高亮
+async function focusAtom(atomId) {
+  await ensureAtomLoaded(atomId);
+  const el = els.docHtml.querySelector(`[data-atom-id="${atomId}"]`);
+  if (!el) return;
+  const wrapperRect = els.canvasWrapper.getBoundingClientRect();
+  state.panY += wrapperRect.height / 3 - (el.getBoundingClientRect().top - wrapperRect.top);
+  setTransform();
+  el.classList.add('search-flash');
+  setTimeout(() => el.classList.remove('search-flash'), 2000);
+}
+
 async function resetSidebarToDocumentMode() {
     clearElementSelection();
     state.sidebarContext = {
         mode: 'document',
         conversation: [],
+        conversationId: null,
         sourceElement: null,
         sourceNodeId: null
     };
@@ -1092,6 +1814,7 @@ async function resetSidebarToDocumentMode() {
     
     const activeChat = state.chats.find(c => c.id === state.activeChatId);
     state.sidebarContext.conversation = activeChat ? activeChat.messages : [];
+    state.sidebarContext.conversationId = activeChat ? activeChat.conversation_id : null;
     await renderMessages(els.sidebarMessages, state.sidebarContext.conversation);
 }
 
@@ -1128,6 +1851,7 @@ async function setActiveChat(chatId) {
     const chat = state.chats.find(c => c.id === chatId);
     if (chat) {
         state.sidebarContext.conversation = chat.messages;
+        state.sidebarContext.conversationId = chat.conversation_id;
         await renderMessages(els.sidebarMessages, chat.messages);
         els.chatHistorySelect.value = chatId;
     }
@@ -1135,7 +1859,7 @@ async function setActiveChat(chatId) {
 
 async function createNewChat() {
     const newChat = {
-        id: crypto.randomUUID(),
+        id: newId(),
         name: `对话 ${state.chats.length + 1}`,
         messages: []
     };
@@ -1196,6 +1920,7 @@ function initSidebarChat() {
 
       let imageUrl = null;
       if (state.selectedElements.length > 0) {
+          payload.selected_element_ids = state.selectedElements.map(el => el.id);
           payload.selected_elements_html = state.selectedElements.map(el => el.html);
           for (const item of state.selectedElements) {
               const tempDiv = document.createElement('div');
@@ -1224,7 +1949,8 @@ function initSidebarChat() {
       console.log("[DEBUG] Sending from Sidebar. Payload:", JSON.stringify(payload, null, 2));
 
       try {
-          const res = await API.chat(payload);
+          const res = await requestChatReply(els.sidebarMessages, payload, thinkingIndicator, state.sidebarContext.conversationId);
+          if (res.conversation_id) state.sidebarContext.conversationId = res.conversation_id;
           
           if (res.first_user_message_override && currentConversationLength > 0) {
               const userMessageIndex = currentConversationLength - 1;
@@ -1240,6 +1966,7 @@ function initSidebarChat() {
               const activeChat = state.chats.find(c => c.id === state.activeChatId);
               if (activeChat) {
                   activeChat.messages = state.sidebarContext.conversation;
+                  activeChat.conversation_id = state.sidebarContext.conversationId;
                   await API.saveChat(state.documentId, activeChat);
               }
           }
@@ -1257,10 +1984,15 @@ function initSidebarChat() {
   els.sidebarDiscardBtn.addEventListener('click', async () => {
       if (confirm('确定要清空当前对话吗？')) {
           state.sidebarContext.conversation = [];
+          if (state.sidebarContext.conversationId) {
+              API.deleteConversation(state.sidebarContext.conversationId).catch(() => {});
+              state.sidebarContext.conversationId = null;
+          }
           if (state.sidebarContext.mode === 'document') {
               const activeChat = state.chats.find(c => c.id === state.activeChatId);
               if (activeChat) {
                   activeChat.messages = [];
+                  activeChat.conversation_id = null;
                   await API.saveChat(state.documentId, activeChat);
               }
           }
@@ -1274,11 +2006,12 @@ function initSidebarChat() {
   els.saveNodeFromSidebarBtn.addEventListener('click', async () => {
       if (state.sidebarContext.mode !== 'element' || !state.sidebarContext.sourceElement) return;
 
-      const { sourceElement, conversation, sourceNodeId } = state.sidebarContext;
+      const { sourceElement, conversation, conversationId, sourceNodeId } = state.sidebarContext;
       if (sourceNodeId) {
           const nodeToUpdate = state.nodes.find(n => n.node_id === sourceNodeId);
           if (nodeToUpdate) {
               nodeToUpdate.conversation_log = conversation;
+              if (conversationId) nodeToUpdate.conversation_id = conversationId;
               try {
                   await API.saveNode(state.documentId, nodeToUpdate);
               } catch(e) {
@@ -1286,7 +2019,7 @@ function initSidebarChat() {
               }
           }
       } else {
-          const node = await saveConversationAsNode(sourceElement, conversation);
+          const node = await saveConversationAsNode(sourceElement, conversation, conversationId);
           addNodeToCanvas(node);
       }
       await resetSidebarToDocumentMode();
@@ -1378,17 +2111,100 @@ function initSidebar() {
 
 function initDrawing() {
   let saveTimeout;
+  // 待提交的笔画操作 { documentId, op }：新笔画与重做提交 add，撤销提交 delete，
+  // 请求体只含变化的笔画；防抖后按文档依次提交，每个请求不超过 OPS_BATCH_CHARS，
+  // 失败的批次及其后的操作按原顺序放回队首，留待下次重试
+  const pendingOps = [];
+  const OPS_BATCH_CHARS = 60000;
+  let flushing = false;
+
+  const takePendingOps = () => {
+      const byDoc = new Map();
+      pendingOps.splice(0).forEach(({ documentId, op }) => {
+          if (!byDoc.has(documentId)) byDoc.set(documentId, []);
+          byDoc.get(documentId).push(op);
+      });
+      return byDoc;
+  };
 
-  const debouncedSaveDrawings = () => {
+  // 按序列化后的长度切分（点数据是 base64，字符数即字节数）；单条超限的操作单独成批
+  const splitOps = (ops) => {
+      const batches = [];
+      let batch = [];
+      let size = 2;
+      ops.forEach(op => {
+          const opSize = JSON.stringify(op).length + 1;
+          if (batch.length && size + opSize > OPS_BATCH_CHARS) {
+              batches.push(batch);
+              batch = [];
+              size = 2;
+          }
+          batch.push(op);
+          size += opSize;
+      });
+      if (batch.length) batches.push(batch);
+      return batches;
+  };
+
+  const requeueOps = (documentId, ops) => {
+      pendingOps.unshift(...ops.map(op => ({ documentId, op })));
+  };
+
+  const flushDrawingOps = async () => {
+      clearTimeout(saveTimeout);
+      // 上一次提交还没结束时稍后再来，保证同一文档的操作按顺序到达
+      if (flushing) { debouncedSaveDrawings(); return; }
+      flushing = true;
+      try {
+          for (const [documentId, ops] of takePendingOps()) {
+              const batches = splitOps(ops);
+              for (let i = 0; i < batches.length; i++) {
+                  try {
+                      await API.drawingOps(documentId, batches[i]);
+                  } catch (err) {
+                      console.error("保存绘图笔记失败:", err);
+                      requeueOps(documentId, batches.slice(i).flat());
+                      debouncedSaveDrawings();
+                      break;
+                  }
+              }
+          }
+      } finally {
+          flushing = false;
+      }
+  };
+
+  // 关闭页面时用 keepalive 发出剩余的操作；同时在途的 keepalive 请求体合计也不能超过 64 KB，
+  // 超出的部分只能尽力以普通请求发出。页面从往返缓存恢复时，失败的操作会在下次提交时重试
+  const flushDrawingOpsOnPageHide = () => {
       clearTimeout(saveTimeout);
-      saveTimeout = setTimeout(() => {
-          if (state.documentId) {
-              API.saveDrawings(state.documentId, state.drawing.paths).catch(err => {
+      let keepaliveBudget = OPS_BATCH_CHARS;
+      takePendingOps().forEach((ops, documentId) => {
+          splitOps(ops).forEach(batch => {
+              const size = JSON.stringify(batch).length;
+              const keepalive = size <= keepaliveBudget;
+              if (keepalive) keepaliveBudget -= size;
+              API.drawingOps(documentId, batch, { keepalive }).catch(err => {
                   console.error("保存绘图笔记失败:", err);
+                  requeueOps(documentId, batch);
+                  debouncedSaveDrawings();
               });
-          }
-      }, 1500); 
+          });
+      });
   };
+
+  const debouncedSaveDrawings = () => {
+      clearTimeout(saveTimeout);
+      saveTimeout = setTimeout(flushDrawingOps, 1500);
+  };
+
+  const queueDrawingOp = (op) => {
+      if (!state.documentId) return;
+      pendingOps.push({ documentId: state.documentId, op });
+      debouncedSaveDrawings();
+  };
+
+  window.addEventListener('pagehide', flushDrawingOpsOnPageHide);
   
   const updateUndoRedoButtonStates = () => {
       els.undoBtn.disabled = state.drawing.paths.length === 0;
@@ -1396,11 +2212,13 @@ function initDrawing() {
   };
   
   const undoLastPath = () => {
-      if (state.drawing.paths.length > 0) {
-          const lastPath = state.drawing.paths.pop();
+      // 其他客户端同步过来的笔画不参与撤销
+      const index = state.drawing.paths.map(p => !p.remote).lastIndexOf(true);
+      if (index !== -1) {
+          const [lastPath] = state.drawing.paths.splice(index, 1);
           state.drawing.redoStack.push(lastPath);
           redrawDrawingCanvas();
-          debouncedSaveDrawings();
+          queueDrawingOp({ op: 'delete', id: lastPath.id });
           updateUndoRedoButtonStates();
       }
   };
@@ -1410,7 +2228,7 @@ function initDrawing() {
           const pathToRedo = state.drawing.redoStack.pop();
           state.drawing.paths.push(pathToRedo);
           redrawDrawingCanvas();
-          debouncedSaveDrawings();
+          queueDrawingOp({ op: 'add', stroke: encodeStroke(pathToRedo) });
           updateUndoRedoButtonStates();
       }
   };
@@ -1467,6 +2285,7 @@ function initDrawing() {
       
       const startPoint = getTransformedCoords(e);
       state.drawing.currentPath = {
+          id: newId(),
           tool: state.drawing.activeTool,
           color: state.drawing.color,
           width: state.drawing.strokeWidth,
@@ -1491,12 +2310,15 @@ function initDrawing() {
       document.body.classList.remove('drawing-active');
       
       state.drawing.isDrawing = false;
-      if (state.drawing.currentPath.points.length > 1) {
-          state.drawing.paths.push(state.drawing.currentPath);
+      const path = state.drawing.currentPath;
+      if (path.points.length > 1) {
+          path.points = simplifyPoints(path.points, STROKE_SIMPLIFY_PX / state.zoom);
+          path.bbox = strokeBounds(path);
+          state.drawing.paths.push(path);
+          queueDrawingOp({ op: 'add', stroke: encodeStroke(path) });
       }
       state.drawing.currentPath = null;
       
-      debouncedSaveDrawings();
       updateUndoRedoButtonStates();
   };
   
@@ -1548,6 +2370,7 @@ function boot() {
   initSidebar();
   initSidebarChat();
   initSidebarDropZone();
+  initSearch();
   initDrawing();
   initToolbarToggle();
   